@@ -1,6 +1,150 @@
-from tokenize_utils import simpler_tokenization as tokenize, smart_tokenizer as smart_tokenize
-from math import log
-from scipy import spatial
+from tokenize_utils import default_analyzer, StemmingAnalyzer
+from cache_utils import SizedCacheInfo, SizedLRUCache
+from document import Document
+from postings import POSTING_CODECS, MAX_TF, Bitset, DecodedPostingsCache, InvertedIndexView, match_postings
+from snapshot import CopyOnWriteArray, GrowableArray, IndexSnapshot
+from pruning import PostingCursor, score_bounds, wand, TOLERANCE
+from ranking import Ranking, RANKING_FUNCTIONS
+from term_matrix import SegmentMatrix
+from segment import (SegmentReader, MappedSegment, WriteBuffer, BufferSnapshot, SegmentedPostings, StoredDocuments,
+                     TieredMergePolicy, merge_segments, write_segment)
+from math import sqrt
+from array import array
+from operator import itemgetter
+from collections import Counter, deque, namedtuple
+from functools import partial
+from itertools import chain, count, izip
+import heapq
+import multiprocessing
+import sys
+import threading
+import numpy as np
+from scipy import sparse, spatial
+
+SCORING_STRATEGIES = ('document', 'vectorized', 'term', 'wand', 'block_max_wand', 'matrix')
+# The strategies that can score with the statistics of a bigger collection (see collection_statistics).
+COLLECTION_SCORING_STRATEGIES = ('vectorized', 'term')
+DEFAULT_BATCH_SIZE = 2000
+RANKINGS = ('cosine', 'full_cosine') + tuple(sorted(RANKING_FUNCTIONS))
+OPERATORS = ('or', 'and')
+DEFAULT_BUFFER_SIZE = 10000
+DEFAULT_MERGE_FACTOR = 10
+DEFAULT_RESULT_CACHE_SIZE = 1024
+DEFAULT_RESULT_CACHE_BYTES = 16 * 1024 * 1024
+DEFAULT_POSTINGS_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_QUERY_BATCH_SIZE = 1024
+
+ResultCacheInfo = namedtuple('ResultCacheInfo', SizedCacheInfo._fields + ('invalidations',))
+
+# The query side of the cosine: the query's unique terms, how many times each appears, their IDFs, their TF*IDF
+# weights, and the norm of the query vector; and how many of the unique terms a document must have to match.
+# With a Ranking (see ranking.py), the weights are multiplicity * IDF, and the per-document statistics of the
+# ranking come along. snapshot is the IndexSnapshot the query is scored on.
+_QueryStatistics = namedtuple('_QueryStatistics', ['terms', 'multiplicities', 'idfs', 'weights', 'norm',
+                                                   'minimum_should_match', 'ranking', 'document_statistics',
+                                                   'snapshot'])
+
+
+
+# The statistics the IDFs and the average document length are computed from: the number of (not deleted) documents,
+# their total length, and a dictionary of the document frequencies of some terms. The statistics of several indexes
+# (like the shards of a collection, see sharding.py) are simply added up.
+CollectionStatistics = namedtuple('CollectionStatistics', ['num_of_docs', 'total_length', 'document_frequencies'])
+
+
+def _cosine_idfs(document_frequencies, num_of_docs):
+    """
+    :param document_frequencies: A NumPy array of document frequencies.
+    :return: A NumPy array of the normalized IDFs (see IREngine._idf_table), 1.0 for a term no document has.
+    """
+    document_frequencies = np.asarray(document_frequencies, dtype=float)
+    idfs = np.ones(len(document_frequencies))
+    present = np.flatnonzero(document_frequencies)
+    idfs[present] = 1.0 + np.log(num_of_docs / document_frequencies[present])
+    return idfs
+
+
+def _result_cache_entry_size(key, results):
+    """
+    :return: An estimate of the memory a result cache entry takes: the key's terms and the result texts.
+    """
+    query_terms = key[0]
+    return (sys.getsizeof(query_terms) + sum(sys.getsizeof(term) for term in query_terms) +
+            sys.getsizeof(results) + sum(sys.getsizeof(text) for text in results))
+
+
+_worker_analyzer = None
+
+
+def _init_indexing_worker(analyzer):
+    global _worker_analyzer
+    _worker_analyzer = analyzer
+
+
+def _index_batch(texts, analyzer=None):
+    """
+    Tokenizes a batch of texts and builds a small inverted index for it, in which the documents are numbered by their
+    position in the batch. Runs in the indexing worker processes of IREngine.add_documents.
+    :param texts: A list of document texts.
+    :param analyzer: The analyzer to tokenize with. Defaults to the one the worker process was initialized with.
+    :return: The documents' lengths and a {term: (document positions, term frequencies)} mapping, as array bytes
+    so they are cheap to send back to the parent process.
+    """
+    analyzer = analyzer or _worker_analyzer
+    lengths = array('I')
+    postings = {}
+    for position, text in enumerate(texts):
+        terms = analyzer.analyze(text)
+        lengths.append(len(terms))
+        for term, tf in Counter(terms).iteritems():
+            if term not in postings:
+                postings[term] = (array('I'), array('H'))
+            positions, tfs = postings[term]
+            positions.append(position)
+            tfs.append(min(tf, MAX_TF))
+    return lengths.tostring(), {term: (positions.tostring(), tfs.tostring())
+                                for term, (positions, tfs) in postings.iteritems()}
+
+
+def _resolve_minimum_should_match(num_of_terms, operator, minimum_should_match):
+    """
+    :param num_of_terms: Number of unique query terms.
+    :param operator: One of OPERATORS.
+    :param minimum_should_match: None, a number of terms, a negative number of terms that may be missing, or a
+    fraction (float) of the terms.
+    :return: The number of unique query terms a document must have, at least 1.
+    """
+    if operator not in OPERATORS:
+        raise ValueError('Unknown operator {!r}, expected one of {}'.format(operator, OPERATORS))
+    if operator == 'and':
+        if minimum_should_match is not None:
+            raise ValueError("minimum_should_match only applies to the 'or' operator")
+        return max(num_of_terms, 1)
+    if minimum_should_match is None:
+        return 1
+    if isinstance(minimum_should_match, float):
+        minimum_should_match = int(minimum_should_match * num_of_terms)
+    elif minimum_should_match < 0:
+        minimum_should_match += num_of_terms
+    return max(minimum_should_match, 1)
+
+
+def _top_k_indices(scores, k):
+    """
+    Picks the k highest scores like heapq.nlargest does: among tied scores, the earlier index wins.
+    :param scores: A 1-D NumPy array of scores.
+    :param k: Number of indices to select.
+    :return: The indices of the k highest scores, in descending order of score.
+    """
+    if k < len(scores):
+        threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > threshold)
+        ties = np.flatnonzero(scores == threshold)[:k - len(above)]
+        candidates = np.concatenate((above, ties))
+        candidates.sort()
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='mergesort')]
 
 
 class IREngine(object):
@@ -25,80 +169,1330 @@ class IREngine(object):
             ...
             "term9": {"document_id1": tf(int), "document_id2": tf(int)}
         }
-        We do not store the IDF for each term. It is useless to do so, because calculating the
-        length of a dictionary in CPython's implementation (and all other built-in data structures) is O(1).
+        This is only a read-only view (see postings.py). Internally every term maps to a posting list: a sorted
+        array of document numbers and a parallel array of term frequencies, either raw ('raw' posting codec) or
+        delta + variable-byte compressed in blocks ('vbyte' posting codec), in which case the postings are decoded
+        on the fly while scoring.
+        We do not store the IDF for each term. It is useless to do so, because the length of a posting list is O(1).
+
+    Segments:
+        The postings are split into segments, each covering a contiguous range of document numbers (see segment.py).
+        New documents go into a mutable write buffer. When it holds buffer_size documents it is sealed into an
+        immutable segment, and a background thread merges runs of similarly sized segments (TieredMergePolicy),
+        so there are only O(log n) segments and indexing never waits for a big merge.
+        A query is scored on every segment separately, with the global statistics - the IDF is computed from the
+        document frequency summed over all segments - and the top results of the segments are merged.
+
+    Global statistics:
+        When the index is a shard of a bigger collection, set_global_statistics installs the statistics of the whole
+        collection (see term_statistics.py), and queries compute the IDFs and the average document length from them,
+        so the scores of all the shards are comparable.
+
+    Deleted documents:
+        Deleting a document only sets its bit in the _deleted bitset. Scoring skips deleted documents and the
+        document frequencies do not count them, but their postings stay in place until the segments they are in
+        are merged, or the index is saved.
+
+    Analyzer:
+        The analyzer (see tokenize_utils) used to tokenize free text queries. Documents should be tokenized
+        with the same analyzer, otherwise query terms will not match the indexed terms.
+
+    Document numbers:
+        Every indexed document also gets an internal document number - its position in insertion order.
+        _doc_ids maps document numbers to document ids, and _doc_nums maps them back.
+        Per-document statistics are kept in compact arrays indexed by document number:
+        _doc_lengths holds the number of terms of each document, computed once when it is added.
+        The norm of each document's full TF*IDF vector is kept too. The IDF of every term drifts whenever a
+        document is added, so the norms are recomputed lazily, the first time they are needed after a change.
+
+    Result cache:
+        query_by_terms (and free_text_query) results are cached by the query's terms, in any order, and the query
+        options. Adding or deleting a document changes the scores of every query, so the whole cache is dropped
+        then; see result_cache_info for its counters.
+        Independently, the decoded posting lists of compressed segments are cached (see DecodedPostingsCache), which
+        speeds up new queries over hot terms too; see postings_cache_info.
+
+    Term-document matrices:
+        With the 'matrix' scoring strategy, every sealed segment is compiled (once, the first time it is queried)
+        into a sparse (documents x term ids) matrix of term frequencies (see term_matrix.py), and a query is a sparse
+        matrix-vector product over the columns of its terms. The weighted matrices - TF*IDF, its L2 normalized rows
+        for 'full_cosine', or a ranking's term scores - are derived from it when the index changes. New segments are
+        compiled as they are queried, and the matrices of merged segments are dropped with them.
+
+    Concurrency:
+        Queries never wait for writers. Writers (adding, deleting and updating documents, flushes, merges) take turns
+        under a write lock, and after every change they publish an IndexSnapshot (see snapshot.py) of the index: the
+        segments, the document lengths, the deleted documents and the document frequencies as of that change. Nothing a
+        snapshot refers to is ever changed: the sealed segments are immutable, the write buffer and the arrays are
+        append-only or copied on write, and its snapshot only sees the postings of the documents it had. A query takes
+        the current snapshot once, and scores on it from start to end, so it never sees a half applied change, and the
+        statistics derived from the index (the IDF table, the document norms, ...) are cached in the snapshot.
+        A document that was deleted (or replaced) after the snapshot was taken is left out of its results.
     """
 
-    def __init__(self):
+    def __init__(self, analyzer=None, posting_codec='raw', buffer_size=DEFAULT_BUFFER_SIZE,
+                 merge_factor=DEFAULT_MERGE_FACTOR, background_merges=True, result_cache_size=DEFAULT_RESULT_CACHE_SIZE,
+                 result_cache_bytes=DEFAULT_RESULT_CACHE_BYTES, postings_cache_bytes=DEFAULT_POSTINGS_CACHE_BYTES):
+        """
+        :param analyzer: The analyzer free text queries are tokenized with. Defaults to the shared Analyzer.
+        :param posting_codec: The posting list format of sealed segments, one of postings.POSTING_CODECS.
+        :param buffer_size: Number of documents in the write buffer before it is sealed into a segment.
+        :param merge_factor: Number of same sized segments that are merged together (see TieredMergePolicy).
+        :param background_merges: Whether segments are merged by a background thread, or right after every flush.
+        :param result_cache_size: Number of query results the result cache holds. 0 disables the cache.
+        :param result_cache_bytes: Total size in bytes of the query results the result cache holds.
+        :param postings_cache_bytes: Size in bytes of the decoded postings cache. 0 disables the cache. Only used with
+        compressed posting lists.
+        """
+        if posting_codec not in POSTING_CODECS:
+            raise ValueError('Unknown posting codec {!r}, expected one of {}'.format(posting_codec,
+                                                                                  sorted(POSTING_CODECS)))
+        if buffer_size < 1:
+            raise ValueError('buffer_size must be positive, got {}'.format(buffer_size))
         self.documents = {}
-        self.inverted_index = {}
+        self._posting_list_class = POSTING_CODECS[posting_codec]
+        self._buffer_size = buffer_size
+        self._merge_policy = TieredMergePolicy(merge_factor, buffer_size)
+        self._background_merges = background_merges
+        # _segments is never changed in place, only replaced, so a reader that grabbed it sees a consistent list.
+        self._segments = []
+        self._buffer = WriteBuffer(0)
+        # Writers take the write lock; _segments_lock guards swapping the segments and the snapshot, which merges do
+        # without the write lock.
+        self._write_lock = threading.RLock()
+        self._segments_lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self._merge_requested = threading.Event()
+        self._merge_thread = None
+        self._stop_merging = False
+        self.analyzer = analyzer or default_analyzer()
+        self._doc_ids = []
+        self._doc_nums = {}
+        self._doc_lengths = GrowableArray(np.uint32)
+        # Copied on the first delete after every publish, so that published snapshots keep their own.
+        self._deleted = Bitset()
+        # Every term gets an id the first time it is indexed. The document frequencies are kept up to date as
+        # documents are added and deleted; the IDF table is recomputed from them when it is stale (see _idf_table).
+        self._term_ids = {}
+        self._document_frequencies = CopyOnWriteArray(np.uint32)
+        self._generation = 0
+        self._result_cache = None
+        if result_cache_size:
+            self._result_cache = SizedLRUCache(result_cache_size, result_cache_bytes, _result_cache_entry_size)
+        self._result_cache_lock = threading.Lock()
+        self._result_cache_generation = 0
+        self._result_cache_invalidations = 0
+        self._postings_cache = DecodedPostingsCache(postings_cache_bytes) if postings_cache_bytes else None
+        self._global_statistics = None
+        self._segment_matrices = {}
+        self._segment_matrices_lock = threading.Lock()
+        self._snapshot = None
+        self._publish()
+
+    @property
+    def inverted_index(self):
+        snapshot = self._snapshot
+        return InvertedIndexView(SegmentedPostings(snapshot.segments), self._doc_ids, self._doc_nums, snapshot.deleted)
+
+    def snapshot(self):
+        """
+        :return: The current IndexSnapshot of the index. Queries given the same snapshot (see query_by_terms) are
+        scored on the same version of the index, however it changes meanwhile.
+        """
+        return self._snapshot
+
+    def _publish(self, changed=True, sealed=None):
+        """
+        Makes the changes of the writer visible to queries, by replacing the current snapshot with a snapshot of the
+        index now. Called with the write lock held.
+        :param changed: Whether documents were added or deleted (or the statistics changed), which changes the scores
+        and the statistics derived from the index. A flush only moves postings to another segment.
+        :param sealed: The segment the write buffer was sealed into, if flushing. It replaces the write buffer under
+        the same lock as the snapshot, so a merge never sees the segment and the buffer holding the same documents.
+        """
+        with self._segments_lock:
+            if sealed is not None:
+                self._segments = self._segments + [sealed]
+                self._buffer = WriteBuffer(len(self._doc_ids))
+            segments = tuple(self._segments) + (self._buffer.snapshot(),)
+            if not changed:
+                self._snapshot = self._snapshot._replace(segments=segments)
+                return
+            self._generation += 1
+            self._snapshot = IndexSnapshot(self._generation, segments, len(self.documents), self._doc_lengths.view(),
+                                           self._deleted, self._document_frequencies.publish(),
+                                           self._global_statistics, {})
+
+    def _searchable_segments(self):
+        """
+        :return: A tuple of the sealed segments followed by the write buffer's snapshot, in document number order.
+        """
+        return self._snapshot.segments
+
+    def flush(self):
+        """
+        Seals the write buffer into a segment, and lets the merge policy know there is a new segment.
+        """
+        with self._write_lock:
+            if not self._buffer.num_of_docs:
+                return
+            self._publish(changed=False, sealed=self._buffer.seal(self._posting_list_class))
+        if not self._background_merges:
+            self.merge()
+            return
+        if self._merge_thread is None:
+            self._merge_thread = threading.Thread(target=self._merge_in_background, name='IREngine-merge')
+            self._merge_thread.daemon = True
+            self._merge_thread.start()
+        self._merge_requested.set()
+
+    def _merge_in_background(self):
+        while True:
+            self._merge_requested.wait()
+            self._merge_requested.clear()
+            if self._stop_merging:
+                return
+            self.merge()
+
+    def merge(self):
+        """
+        Merges segments as long as the merge policy finds segments to merge.
+        Queries keep running on the old segments while a merge is in progress.
+        """
+        with self._merge_lock:
+            while True:
+                segments = self._segments
+                span = self._merge_policy.find_merge(segments)
+                if span is None:
+                    return
+                start, end = span
+                merged = merge_segments(segments[start:end], self._posting_list_class, self._snapshot.deleted)
+                with self._segments_lock:
+                    # Flushes only append segments, so the merged ones are still at the same positions.
+                    self._replace_segments(self._segments[:start] + [merged] + self._segments[end:])
+                if self._postings_cache is not None:
+                    self._postings_cache.discard_segments(segments[start:end])
+                self._discard_segment_matrices(segments[start:end])
+
+    def force_merge(self):
+        """
+        Flushes the write buffer and merges all the segments into a single segment, purging deleted documents.
+        """
+        self.flush()
+        with self._merge_lock:
+            segments = self._segments
+            deleted = self._snapshot.deleted
+            if len(segments) > 1 or deleted:
+                merged = merge_segments(segments, self._posting_list_class, deleted)
+                with self._segments_lock:
+                    self._replace_segments([merged] + self._segments[len(segments):])
+                if self._postings_cache is not None:
+                    self._postings_cache.discard_segments(segments)
+                self._discard_segment_matrices(segments)
+
+    def _replace_segments(self, segments):
+        """
+        Swaps merged segments in, without the write lock (a merge doesn't change what the index holds). The current
+        snapshot's sealed segments are always the same as _segments (a flush seals the write buffer and publishes under
+        _segments_lock), so only they are replaced in it; its write buffer may hold documents that are not published
+        yet. Called with _segments_lock held.
+        """
+        self._segments = segments
+        self._snapshot = self._snapshot._replace(segments=tuple(segments) + self._snapshot.segments[-1:])
+
+    def close(self):
+        """
+        Stops the background merge thread, once the merge it is running (if any) is done.
+        The engine can still be used; the thread is started again by the next flush.
+        """
+        if self._merge_thread is not None:
+            self._stop_merging = True
+            self._merge_requested.set()
+            self._merge_thread.join()
+            self._merge_thread = None
+            self._stop_merging = False
+
+    def save(self, path):
+        """
+        Saves the whole index - postings, document lengths, document ids and texts - to a single file.
+        See segment.py for the format. Deleted documents are left out, and the other documents are renumbered.
+        The document ids must be byte strings (a ValueError is raised otherwise), as they are read back as byte strings.
+        :param path: The file to write.
+        """
+        # Writers wait until the index is saved, so the documents are the ones of the snapshot.
+        with self._write_lock:
+            snapshot = self._snapshot
+            postings = SegmentedPostings(snapshot.segments)
+            doc_nums = np.arange(len(snapshot.doc_lengths))
+            deleted = snapshot.deleted.contains(doc_nums)
+            live_doc_nums = doc_nums[~deleted]
+            # The new number of every document, by its current number.
+            new_doc_nums = np.cumsum(~deleted) - 1
+
+            def live_postings():
+                for term in sorted(postings):
+                    term_doc_nums, tfs = postings[term].arrays()
+                    if snapshot.deleted:
+                        live = ~deleted[term_doc_nums]
+                        term_doc_nums, tfs = new_doc_nums[term_doc_nums[live]], tfs[live]
+                    if len(term_doc_nums):
+                        yield term, (term_doc_nums, tfs)
+
+            doc_ids = [self._doc_ids[doc_num] for doc_num in live_doc_nums]
+            write_segment(path, live_postings(), doc_ids, snapshot.doc_lengths[live_doc_nums],
+                          (self.documents[doc_id].text for doc_id in doc_ids))
+
+    @classmethod
+    def open(cls, path, analyzer=None, posting_codec='vbyte', **options):
+        """
+        Opens an index that was saved with save(). The file is memory-mapped, and postings and texts are only read
+        from it when they are needed, so this is much faster than indexing the documents again.
+        Documents can still be added to an opened index; they are kept in memory until it is saved again.
+        :param path: The file to open.
+        :param analyzer: The analyzer the saved documents were tokenized with.
+        :param posting_codec: The posting codec for segments added after opening. The saved postings are compressed.
+        :param options: Other IREngine options (buffer_size, merge_factor, background_merges, result_cache_size,
+        result_cache_bytes).
+        :return: An IREngine.
+        """
+        reader = SegmentReader(path)
+        engine = cls(analyzer, posting_codec, **options)
+        engine._doc_ids = reader.doc_ids()
+        engine._doc_nums = dict(izip(engine._doc_ids, count()))
+        engine._doc_lengths = GrowableArray(np.uint32, reader.doc_lengths())
+        engine._term_ids = dict(izip(reader.terms(), count()))
+        engine._document_frequencies = CopyOnWriteArray(np.uint32, reader.document_frequencies())
+        # The saved index is a single segment, and new documents are numbered after it.
+        engine._segments = [MappedSegment(reader)]
+        engine._buffer = WriteBuffer(reader.num_of_docs)
+        engine.documents = StoredDocuments(reader, engine._doc_ids, engine._doc_nums, engine.analyzer)
+        engine._publish()
+        return engine
 
     def add_document(self, document):
         """
         Adds a document to the documents dictionary of the engine. Also updates the inverted index accordingly.
         :param document: The to-be-indexed document (Document object type).
         """
-        if document.doc_id not in self.documents:
-            self.documents[document.doc_id] = document
-            self.update_inverted_index(document)
-            return True
-        print 'Error: {} is already indexed. No action will be taken.'.format(document.doc_id)
-        return False
+        with self._write_lock:
+            added = self._add_document(document)
+            if added:
+                self._publish()
+                if self._buffer.num_of_docs >= self._buffer_size:
+                    self.flush()
+        if not added:
+            print 'Error: {} is already indexed. No action will be taken.'.format(document.doc_id)
+        return added
+
+    def _add_document(self, document, terms=None):
+        """
+        Indexes the document, without publishing it. Called with the write lock held.
+        :param terms: The document's terms, if they were already analyzed (defaults to document.terms).
+        :return: False if a document with the same id is already indexed.
+        """
+        if document.doc_id in self.documents:
+            return False
+        terms = document.terms if terms is None else terms
+        self.documents[document.doc_id] = document
+        self._doc_nums[document.doc_id] = len(self._doc_ids)
+        self._doc_ids.append(document.doc_id)
+        self._doc_lengths.append(len(terms))
+        self._index_terms(self._doc_nums[document.doc_id], terms)
+        return True
+
+    def delete_document(self, doc_id):
+        """
+        Deletes a document. This only marks its number in the deleted documents bitset, so it takes O(1);
+        its postings are purged later, when its segment is merged.
+        :param doc_id: The id of the document to delete.
+        :return: True if the document was deleted, False if it is not indexed.
+        """
+        with self._write_lock:
+            deleted = self._delete_document(doc_id)
+            if deleted:
+                self._publish()
+        if not deleted:
+            print 'Error: {} is not indexed. No action will be taken.'.format(doc_id)
+        return deleted
+
+    def _delete_document(self, doc_id):
+        """
+        Deletes the document, without publishing the deletion. Called with the write lock held.
+        :return: False if the document is not indexed.
+        """
+        if doc_id not in self._doc_nums:
+            return False
+        if self._deleted is self._snapshot.deleted:
+            self._deleted = self._deleted.copy()
+        self._deleted.add(self._doc_nums[doc_id])
+        self._update_document_frequencies((term, -1) for term in set(self.documents[doc_id].terms))
+        del self.documents[doc_id]
+        del self._doc_nums[doc_id]
+        return True
+
+    def update_document(self, document):
+        """
+        Replaces the indexed document that has the same id with a new version of it, or adds the document if it is
+        not indexed. The old version is deleted, and the new one is indexed like a new document.
+        Both changes are published at once, so no snapshot has both versions, or neither.
+        :param document: The new version of the document (Document object type).
+        """
+        with self._write_lock:
+            self._delete_document(document.doc_id)
+            self._add_document(document)
+            self._publish()
+            if self._buffer.num_of_docs >= self._buffer_size:
+                self.flush()
+        return True
+
+    def add_documents(self, documents, workers=1, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Indexes many documents at once. The documents are cut into batches, and every batch is tokenized into a small
+        partial index by a pool of worker processes; the partial indexes are merged into the engine in order.
+        Tokenizing is by far the most expensive part of indexing, so it scales with the number of workers.
+        Documents whose id is already indexed are skipped, like add_document does.
+        :param documents: An iterable of (doc_id, text) tuples.
+        :param workers: Number of worker processes. With 1, the documents are tokenized and indexed in this process.
+        :param batch_size: Number of documents per batch.
+        :return: The number of documents that were added.
+        """
+        # Other writers wait until all the documents are added; queries see every batch as soon as it is merged.
+        with self._write_lock:
+            return self._add_documents(documents, workers, batch_size)
+
+    def _add_documents(self, documents, workers, batch_size):
+        num_of_docs_before = len(self._doc_ids)
+        batches = self._new_document_batches(documents, batch_size)
+        if workers <= 1:
+            # Without workers there is no partial index to ship, so the documents are indexed straight into the
+            # write buffer. Like a merged batch, the whole batch is published once.
+            for doc_ids, texts in batches:
+                for doc_id, text in izip(doc_ids, texts):
+                    self._add_document(Document(doc_id, text, self.analyzer, lazy=True), self.analyzer.analyze(text))
+                self._publish()
+                if self._buffer.num_of_docs >= self._buffer_size:
+                    self.flush()
+            return len(self._doc_ids) - num_of_docs_before
+        pool = multiprocessing.Pool(workers, initializer=_init_indexing_worker, initargs=(self.analyzer,))
+        try:
+            # Only a few batches are in flight at any time, so the input is consumed as it is indexed.
+            pending = deque()
+            for doc_ids, texts in batches:
+                pending.append((doc_ids, texts, pool.apply_async(_index_batch, (texts,))))
+                if len(pending) >= 2 * workers:
+                    doc_ids, texts, result = pending.popleft()
+                    self._merge_batch(doc_ids, texts, result.get())
+            while pending:
+                doc_ids, texts, result = pending.popleft()
+                self._merge_batch(doc_ids, texts, result.get())
+        finally:
+            pool.terminate()
+        return len(self._doc_ids) - num_of_docs_before
+
+    def _new_document_batches(self, documents, batch_size):
+        in_flight = set()
+        doc_ids, texts = [], []
+        for doc_id, text in documents:
+            if doc_id in self._doc_nums or doc_id in in_flight:
+                print 'Error: {} is already indexed. No action will be taken.'.format(doc_id)
+                continue
+            in_flight.add(doc_id)
+            doc_ids.append(doc_id)
+            texts.append(text)
+            if len(doc_ids) == batch_size:
+                yield doc_ids, texts
+                doc_ids, texts = [], []
+        if doc_ids:
+            yield doc_ids, texts
+
+    def _merge_batch(self, doc_ids, texts, partial_index):
+        """
+        Merges the partial index of a batch (see _index_batch) into the write buffer. The batch's documents get the
+        next document numbers, so appending their postings keeps every posting list sorted.
+        """
+        lengths, postings = partial_index
+        first_doc_num = len(self._doc_ids)
+        for doc_id, text in izip(doc_ids, texts):
+            self._doc_nums[doc_id] = len(self._doc_ids)
+            self._doc_ids.append(doc_id)
+            self.documents[doc_id] = Document(doc_id, text, self.analyzer, lazy=True)
+        self._doc_lengths.extend(np.frombuffer(lengths, dtype=np.uint32))
+        postings = {term: (np.frombuffer(positions, dtype=np.uint32) + first_doc_num,
+                           np.frombuffer(tfs, dtype=np.uint16))
+                    for term, (positions, tfs) in postings.iteritems()}
+        self._update_document_frequencies((term, len(doc_nums)) for term, (doc_nums, tfs) in postings.iteritems())
+        self._buffer.add_batch(first_doc_num, len(doc_ids), postings)
+        self._publish()
+        if self._buffer.num_of_docs >= self._buffer_size:
+            self.flush()
 
     def update_inverted_index(self, document):
         """
         Updates the inverted index when a new document is inserted.
         :param document: The new document (Document object type).
         """
-        for term in document.terms:
-            if term not in self.inverted_index:
-                # If the term is not present, we add it as a key, update doc frequency by one, and the tf for it by one.
-                self.inverted_index[term] = {}
-            if document.doc_id not in self.inverted_index[term]:
-                self.inverted_index[term][document.doc_id] = 1
-            else:
-                self.inverted_index[term][document.doc_id] += 1
+        self._index_terms(self._doc_nums[document.doc_id], document.terms)
 
-    def free_text_query(self, query_text, num_of_results=5, smart_tokenizer=False):
+    def _index_terms(self, doc_num, terms):
+        term_frequencies = Counter(terms)
+        self._update_document_frequencies((term, 1) for term in term_frequencies)
+        self._buffer.add_document(doc_num, term_frequencies.iteritems())
+
+    def _update_document_frequencies(self, changes):
+        """
+        :param changes: An iterable of (term, change of its document frequency) tuples.
+        """
+        term_ids = self._term_ids
+        document_frequencies = self._document_frequencies
+        add = document_frequencies.add
+        for term, change in changes:
+            term_id = term_ids.get(term)
+            if term_id is None:
+                term_id = term_ids[term] = len(document_frequencies)
+                document_frequencies.append(0)
+            add(term_id, change)
+
+    def refresh_statistics(self):
+        """
+        Recomputes the corpus statistics that depend on every document - the IDF table and the document norms -
+        right away. They are otherwise recomputed by the first query after the index changes; batch loaders can call
+        this once after loading, so that no query pays for it.
+        """
+        snapshot = self._snapshot
+        self._idf_table(snapshot)
+        self._document_norms(snapshot)
+
+    def free_text_query(self, query_text, num_of_results=5, smart_tokenizer=False, analyzer=None, operator='or',
+                        minimum_should_match=None, snapshot=None):
         """
         A function that implements a simple query with a document text.
-        It simply tokenizes the text using the IR's tokenizer, and passes it to the standard term-query.
-        :param smart_tokenizer: Determines whether should we use the smart (stemming) tokenizer.
+        It simply tokenizes the text using the IR's analyzer, and passes it to the standard term-query.
+        :param smart_tokenizer: Determines whether should we use the smart (stemming) analyzer.
         :param num_of_results: Number of top results to show.
         :param query_text: The query string. Can be a string of any length.
+        :param analyzer: An analyzer to tokenize this query with, instead of the engine's analyzer.
+        :param operator: 'or' or 'and' (see query_by_terms).
+        :param minimum_should_match: See query_by_terms.
+        :param snapshot: See query_by_terms.
         :returns a list of a documents in descending order of similarity to the input query.
         """
-        query_terms = smart_tokenize(query_text) if smart_tokenizer else tokenize(query_text)
-        return self.query_by_terms(query_terms, num_of_results)
+        if analyzer is None:
+            analyzer = default_analyzer(StemmingAnalyzer) if smart_tokenizer else self.analyzer
+        query_terms = analyzer.analyze(query_text)
+        return self.query_by_terms(query_terms, num_of_results, operator=operator,
+                                   minimum_should_match=minimum_should_match, snapshot=snapshot)
 
-    def query_by_terms(self, query_terms, num_of_results=5):
+    def query_by_terms(self, query_terms, num_of_results=5, scoring='vectorized', ranking='cosine', operator='or',
+                       minimum_should_match=None, snapshot=None):
         """
         A standard query on the IR engine. Accepts 1 to n query terms.
         :param query_terms: A list containing the terms (string) of the query.
         :param num_of_results: How many results (documents) should be fetched
+        :param scoring: The scoring strategy, one of SCORING_STRATEGIES:
+            'document' - scores one candidate document at a time, streaming the scores into a bounded heap.
+            'vectorized' - gathers the TF*IDF weights of all candidates into one NumPy matrix and computes all the
+                           similarities at once. Same rankings as 'document', without the per-document overhead.
+            'term' - walks each query term's postings exactly once, accumulating partial scores per document,
+                     then normalizes them. No per-candidate lookups in the inverted index at all.
+            'wand' - walks the postings of all the query terms together, and skips the documents whose score can
+                     not make the top results, using an upper bound of every term's score (see pruning.py).
+                     Same results as exhaustive scoring. Only for rankings that are a sum of per-term scores:
+                     'full_cosine' and the ranking functions; 'cosine' queries are scored like 'vectorized'.
+            'block_max_wand' - 'wand' with upper bounds for every block of postings, which skips much more.
+            'matrix' - multiplies the columns of the query terms in the term-document matrices of the segments (see
+                       term_document_matrix) by the query vector, and picks the top results with a partial sort.
+                       The matrices are compiled the first time they are needed, and reweighted after every change
+                       of the index, so it pays off for many queries between changes. Same results as 'vectorized',
+                       though tied scores may come in another order.
+        :param ranking: The similarity function, one of RANKINGS:
+            'cosine' - the cosine between the query and the document's vector projected on the query terms.
+            'full_cosine' - the cosine between the query and the document's full TF*IDF vector, using the
+                            precomputed document norms.
+            'bm25', 'bm25+' - Okapi BM25 and BM25+, with their default parameters (see ranking.py).
+            A Ranking instance can be passed too, like BM25(k1=1.5, b=0.5).
+        :param operator: Which documents match the query, one of OPERATORS:
+            'or' - documents that have at least one of the query terms (or minimum_should_match of them).
+            'and' - only documents that have all of the query terms.
+        :param minimum_should_match: With 'or', how many of the unique query terms a document must have:
+            a number of terms, a negative number of terms that may be missing, or a fraction (float) of the terms.
+        :param snapshot: The IndexSnapshot (see snapshot) to query. Defaults to the current one.
         :return: A list of the top `num_of_results` relevant documents.
         """
+        snapshot = snapshot or self._snapshot
+        if self._result_cache is None:
+            top_results = self._top_documents(query_terms, num_of_results, scoring, ranking, operator,
+                                              minimum_should_match, snapshot=snapshot)
+            return [str(document) for document, _ in top_results]
+        key = (tuple(sorted(query_terms)), num_of_results, scoring, ranking, operator, minimum_should_match)
+        results = self._cached_results(key, snapshot.generation)
+        if results is None:
+            top_results = self._top_documents(query_terms, num_of_results, scoring, ranking, operator,
+                                              minimum_should_match, snapshot=snapshot)
+            results = tuple(str(document) for document, _ in top_results)
+            self._cache_results(key, results, snapshot.generation)
+        return list(results)
+
+    def _cached_results(self, key, generation):
+        """
+        :param generation: The generation of the snapshot the query is on. The cache holds the results of a single
+        generation, the latest one it was asked for; the queries on older snapshots bypass it.
+        """
+        with self._result_cache_lock:
+            if self._result_cache_generation < generation:
+                if len(self._result_cache):
+                    self._result_cache.clear()
+                    self._result_cache_invalidations += 1
+                self._result_cache_generation = generation
+            if self._result_cache_generation != generation:
+                return None
+            return self._result_cache.get(key)
+
+    def _cache_results(self, key, results, generation):
+        """
+        :param generation: The generation of the snapshot the query was scored on. The results are not cached if a
+        document was added or deleted since.
+        """
+        with self._result_cache_lock:
+            if generation == self._result_cache_generation == self._generation:
+                self._result_cache.put(key, results)
+
+    def _posting_list(self, segment, term):
+        """
+        :return: The term's posting list in the segment (or None), through the decoded postings cache.
+        """
+        if self._postings_cache is None:
+            return segment.posting_list(term)
+        return self._postings_cache.posting_list(segment, term)
+
+    def postings_cache_info(self):
+        """
+        :return: A postings.DecodedPostingsCacheInfo tuple (hits, misses, evictions, rejections, maxbytes, currbytes,
+        decode_seconds, saved_seconds) of the decoded postings cache, or None if it is disabled.
+        """
+        return self._postings_cache.info() if self._postings_cache is not None else None
+
+    def result_cache_info(self):
+        """
+        :return: A ResultCacheInfo tuple (hits, misses, evictions, maxsize, currsize, maxbytes, currbytes,
+        invalidations) of the result cache, or None if it is disabled. invalidations counts the times the cache was
+        dropped because the index changed.
+        """
+        if self._result_cache is None:
+            return None
+        with self._result_cache_lock:
+            return ResultCacheInfo(*self._result_cache.info() + (self._result_cache_invalidations,))
+
+    def batch_query(self, queries, num_of_results=5, ranking='cosine', operator='or', minimum_should_match=None,
+                    analyzer=None, batch_size=DEFAULT_QUERY_BATCH_SIZE):
+        """
+        Runs many free text queries at once, much faster than one free_text_query after another: the posting list of a
+        term is fetched once for all the queries that have it, and all the queries are scored together by a product of
+        sparse matrices (see _batch_top_documents). Same results as query_by_terms, except that documents whose scores
+        tie up to rounding errors may come in another order.
+        :param queries: A list of query strings.
+        :param num_of_results: How many results to fetch for every query.
+        :param ranking: See query_by_terms.
+        :param operator: See query_by_terms.
+        :param minimum_should_match: See query_by_terms.
+        :param analyzer: An analyzer to tokenize the queries with, instead of the engine's analyzer.
+        :param batch_size: How many distinct queries are scored in every pass; bounds the size of the matrices.
+        :return: A list with the results (like query_by_terms) of every query, in order.
+        """
+        analyzer = analyzer or self.analyzer
+        # Repeated queries, and queries with the same terms in another order, are only scored once.
+        distinct_queries = {}
+        keys = []
+        for query_text in queries:
+            query_terms = analyzer.analyze(query_text)
+            key = tuple(sorted(query_terms))
+            distinct_queries.setdefault(key, query_terms)
+            keys.append(key)
+        results = {}
+        distinct_keys = list(distinct_queries)
+        # All the queries are scored on the same snapshot.
+        snapshot = self._snapshot
+        for start in xrange(0, len(distinct_keys), batch_size):
+            chunk = distinct_keys[start:start + batch_size]
+            top_results = self._batch_top_documents([distinct_queries[key] for key in chunk], num_of_results, ranking,
+                                                    operator, minimum_should_match, snapshot)
+            for key, query_results in izip(chunk, top_results):
+                results[key] = [str(document) for document, _ in query_results]
+        return [list(results[key]) for key in keys]
+
+    def _batch_top_documents(self, queries, num_of_results, ranking='cosine', operator='or',
+                             minimum_should_match=None, snapshot=None):
+        """
+        Scores many queries in one vectorized pass. The candidates' weights of every term of the batch make a sparse
+        (candidates x terms) matrix, and the queries' weights a sparse (terms x queries) matrix; their product holds
+        the dot product of every query with every candidate that shares a term with it, and nothing else.
+        For 'cosine', the candidates' norms over each query's terms are a product of the same shape, with the weights
+        squared. A term's posting list is fetched once per segment, whatever the number of queries that have it.
+        :param queries: A list of query term lists.
+        :param snapshot: The IndexSnapshot to score on. Defaults to the current one.
+        :return: A list of the top (document, similarity) tuples of every query, like _top_documents.
+        """
+        if not isinstance(ranking, Ranking):
+            if ranking not in RANKINGS:
+                raise ValueError('Unknown ranking {!r}, expected one of {}'.format(ranking, RANKINGS))
+            ranking = RANKING_FUNCTIONS.get(ranking, ranking)
+        snapshot = snapshot or self._snapshot
+        statistics = [self._query_statistics(query_terms, snapshot, _resolve_minimum_should_match(
+            len(set(query_terms)), operator, minimum_should_match), ranking) if query_terms else None
+            for query_terms in queries]
+        batch_terms = []
+        term_columns = {}
+        for query in statistics:
+            if query is not None:
+                for term in query.terms:
+                    if term not in term_columns:
+                        term_columns[term] = len(batch_terms)
+                        batch_terms.append(term)
+
+        # The postings of every term, with their weights, gathered as (document number, term column, weight).
+        doc_nums, columns, weights = [], [], []
+        lengths = snapshot.doc_lengths
+        idfs = self._term_idfs(batch_terms, snapshot) if not isinstance(ranking, Ranking) else None
+        document_statistics = self._document_statistics(ranking, snapshot) if isinstance(ranking, Ranking) else None
+        for segment in snapshot.segments:
+            for term, column in term_columns.iteritems():
+                posting_list = self._posting_list(segment, term)
+                if posting_list is None or not len(posting_list):
+                    continue
+                term_doc_nums, tfs = posting_list.arrays()
+                if snapshot.deleted:
+                    live = ~snapshot.deleted.contains(term_doc_nums)
+                    term_doc_nums, tfs = term_doc_nums[live], tfs[live]
+                if document_statistics is not None:
+                    weights.append(ranking.term_scores(tfs.astype(float), document_statistics[term_doc_nums]))
+                else:
+                    weights.append(tfs * idfs[column] / lengths[term_doc_nums])
+                doc_nums.append(term_doc_nums)
+                columns.append(np.full(len(term_doc_nums), column, dtype=np.int64))
+        if not doc_nums:
+            return [[] for _ in queries]
+        candidates, rows = np.unique(np.concatenate(doc_nums), return_inverse=True)
+        columns = np.concatenate(columns)
+        weights = np.concatenate(weights)
+        # (terms x candidates), so that the product is (queries x candidates), and every query's scores are a row.
+        document_matrix = sparse.csr_matrix((weights, (columns, rows)), shape=(len(term_columns), len(candidates)))
+
+        query_rows, query_columns, query_weights, query_multiplicities = [], [], [], []
+        for query_number, query in enumerate(statistics):
+            if query is None:
+                continue
+            query_rows.extend(term_columns[term] for term in query.terms)
+            query_columns.extend([query_number] * len(query.terms))
+            query_weights.append(query.weights if query.ranking is not None else query.multiplicities * query.weights)
+            query_multiplicities.append(query.multiplicities)
+        shape = (len(queries), len(term_columns))
+        query_matrix = sparse.csr_matrix((np.concatenate(query_weights), (query_columns, query_rows)), shape=shape)
+        scores = query_matrix * document_matrix
+        # The products below have the same sparsity structure as scores, so their entries line up with its entries.
+        if ranking == 'cosine':
+            multiplicity_matrix = sparse.csr_matrix((np.concatenate(query_multiplicities),
+                                                     (query_columns, query_rows)), shape=shape)
+            squared_norms = multiplicity_matrix * document_matrix.multiply(document_matrix).tocsr()
+            self._align_entries(scores, squared_norms)
+            scores.data /= np.sqrt(squared_norms.data)
+        elif ranking == 'full_cosine':
+            scores.data /= self._document_norms(snapshot)[candidates[scores.indices]]
+        if any(query is not None and query.minimum_should_match > 1 for query in statistics):
+            document_matrix.data[:] = 1
+            matches = sparse.csr_matrix((np.ones(len(query_rows)), (query_columns, query_rows)),
+                                        shape=shape) * document_matrix
+            self._align_entries(scores, matches)
+        else:
+            matches = None
+
         results = []
-        query_tf_idf_vector = self.calculate_tf_idf_for_query(query_terms)
-        term_to_idf_mapping = {term: self._calculate_term_idf(term) for term in query_terms}
-        relevant_doc_ids = self._get_relevant_doc_ids(query_terms)
-        for doc_id in relevant_doc_ids:
-            document = self.documents[doc_id]
-            document_vector = []
-            for query_term in query_terms:
-                # "I love all the restaurants, I especially recommend trying McDonalds"
-                # [[x,y], [a,b], [c,d]]
-                query_tf = 0
-                if query_term in self.inverted_index:
-                    query_tf = float(self.inverted_index[query_term].get(document.doc_id, 0)) / len(document.terms)
-                query_idf = term_to_idf_mapping[query_term]
-                document_vector.append(query_tf * query_idf)
-            similarity = 1 - spatial.distance.cosine(query_tf_idf_vector, document_vector)
-            results.append((document, similarity))
-        if num_of_results > len(results):
-            num_of_results = len(results)
-        top_results = sorted(results, key=lambda tup: tup[1], reverse=True)[:num_of_results]
-        return [str(top_result[0]) for top_result in top_results[:num_of_results]]
+        for query_number, query in enumerate(statistics):
+            if query is None:
+                results.append([])
+                continue
+            start, end = scores.indptr[query_number], scores.indptr[query_number + 1]
+            similarities = scores.data[start:end]
+            query_candidates = candidates[scores.indices[start:end]]
+            if matches is not None and query.minimum_should_match > 1:
+                matched = matches.data[start:end] >= query.minimum_should_match
+                similarities, query_candidates = similarities[matched], query_candidates[matched]
+            if query.ranking is None:
+                similarities = similarities / query.norm
+            # The candidates of a row are not sorted (sorting them all costs more than the rest of the scoring), so
+            # the ties are broken by document number explicitly.
+            if num_of_results < len(similarities):
+                threshold = np.partition(similarities, len(similarities) - num_of_results)[-num_of_results]
+                top_rows = np.flatnonzero(similarities >= threshold)
+            else:
+                top_rows = np.arange(len(similarities))
+            top_rows = top_rows[np.lexsort((query_candidates[top_rows], -similarities[top_rows]))[:num_of_results]]
+            results.append(self._resolve_documents(izip(query_candidates[top_rows].tolist(),
+                                                        similarities[top_rows].tolist())))
+        return results
+
+    def _resolve_documents(self, top_results):
+        """
+        :param top_results: An iterable of (document number, similarity) tuples.
+        :return: A list of (document, similarity) tuples, without the documents that were deleted (or replaced) since
+        the snapshot they were found in was taken.
+        """
+        resolved = []
+        for doc_num, similarity in top_results:
+            doc_id = self._doc_ids[doc_num]
+            document = self.documents.get(doc_id)
+            # Writers change documents before _doc_nums, so if the number still matches, this is the snapshot's version.
+            if document is not None and self._doc_nums.get(doc_id) == doc_num:
+                resolved.append((document, similarity))
+        return resolved
+
+    @staticmethod
+    def _align_entries(matrix, other):
+        """
+        Makes sure the entries of two sparse matrices with the same structure are stored in the same order.
+        """
+        if not np.array_equal(matrix.indices, other.indices):
+            matrix.sort_indices()
+            other.sort_indices()
+
+    def _top_documents(self, query_terms, num_of_results, scoring, ranking='cosine', operator='or',
+                       minimum_should_match=None, statistics=None, snapshot=None):
+        """
+        :param statistics: The CollectionStatistics (of at least the query terms) to compute the IDFs and the average
+        document length from, instead of the index's own. Only with COLLECTION_SCORING_STRATEGIES. 'full_cosine' still
+        divides by the documents' norms in this index. Defaults to the global statistics, if they are set.
+        :param snapshot: The IndexSnapshot to score on. Defaults to the current one.
+        :return: A list of the top (document, similarity) tuples, in descending order of similarity.
+        """
+        if not isinstance(ranking, Ranking):
+            if ranking not in RANKINGS:
+                raise ValueError('Unknown ranking {!r}, expected one of {}'.format(ranking, RANKINGS))
+            ranking = RANKING_FUNCTIONS.get(ranking, ranking)
+        minimum_should_match = _resolve_minimum_should_match(len(set(query_terms)), operator, minimum_should_match)
+        snapshot = snapshot or self._snapshot
+        global_statistics = snapshot.global_statistics
+        if statistics is None and global_statistics is not None:
+            statistics = global_statistics.statistics(query_terms)
+        if statistics is not None:
+            if scoring not in COLLECTION_SCORING_STRATEGIES:
+                raise ValueError('Scoring strategy {!r} can not score with collection statistics, expected one of '
+                                 '{}'.format(scoring, COLLECTION_SCORING_STRATEGIES))
+            score_segment = (self._top_in_segment_vectorized if scoring == 'vectorized'
+                             else self._top_in_segment_term_at_a_time)
+            return self._top_documents_by_segment(score_segment, query_terms, num_of_results, ranking,
+                                                  minimum_should_match, statistics, snapshot)
+        if scoring == 'document':
+            return self._top_documents_document_at_a_time(query_terms, num_of_results, ranking, minimum_should_match,
+                                                          snapshot)
+        if scoring == 'vectorized':
+            return self._top_documents_vectorized(query_terms, num_of_results, ranking, minimum_should_match, snapshot)
+        if scoring == 'term':
+            return self._top_documents_term_at_a_time(query_terms, num_of_results, ranking, minimum_should_match,
+                                                      snapshot)
+        if scoring in ('wand', 'block_max_wand'):
+            return self._top_documents_wand(query_terms, num_of_results, ranking, minimum_should_match,
+                                            block_max=scoring == 'block_max_wand', snapshot=snapshot)
+        if scoring == 'matrix':
+            return self._top_documents_matrix(query_terms, num_of_results, ranking, minimum_should_match, snapshot)
+        raise ValueError('Unknown scoring strategy {!r}, expected one of {}'.format(scoring, SCORING_STRATEGIES))
+
+    def _top_documents_document_at_a_time(self, query_terms, num_of_results, ranking, minimum_should_match=1,
+                                          snapshot=None):
+        """
+        The candidates are scored lazily and streamed into a bounded heap, so picking the top results costs
+        O(n log k) instead of sorting all n candidates, and the full results list is never materialized.
+        """
+        if isinstance(ranking, Ranking):
+            scores = self._score_documents_by_ranking(query_terms, ranking, minimum_should_match, snapshot)
+        else:
+            scores = self._score_documents(query_terms, ranking, minimum_should_match, snapshot)
+        return heapq.nlargest(num_of_results, scores, key=itemgetter(1))
+
+    def _top_documents_vectorized(self, query_terms, num_of_results, ranking, minimum_should_match=1, snapshot=None):
+        """
+        Builds, for every segment, a (candidates x unique query terms) matrix of document TF*IDF weights by walking
+        each query term's postings once, then computes the cosine similarity of every candidate in a single
+        vectorized operation.
+        When documents must match more than one term, the candidates are found first (see postings.match_postings)
+        and only their postings are looked up.
+        """
+        return self._top_documents_by_segment(self._top_in_segment_vectorized, query_terms, num_of_results, ranking,
+                                              minimum_should_match, snapshot=snapshot)
+
+    def _top_documents_term_at_a_time(self, query_terms, num_of_results, ranking, minimum_should_match=1,
+                                      snapshot=None):
+        """
+        Term-at-a-time scoring: every posting of every query term is visited exactly once, and its contribution
+        is added to the document's score accumulators.
+        """
+        return self._top_documents_by_segment(self._top_in_segment_term_at_a_time, query_terms, num_of_results,
+                                              ranking, minimum_should_match, snapshot=snapshot)
+
+    def _top_documents_wand(self, query_terms, num_of_results, ranking, minimum_should_match=1, block_max=False,
+                            snapshot=None):
+        """
+        Dynamic pruning with WAND (see pruning.wand). The full cosine is a sum of per-term scores: the query's weight
+        of the term times tf / (length * norm) of the document; so is a Ranking: the query's weight of the term times
+        its term_scores. The maximum of the latter over a posting list (and over every block of it) is the term's
+        upper bound; they are computed per segment the first time a term is queried after the index changes.
+        The documents that survive pruning are scored again exactly like 'vectorized' does, so the results are the
+        same, down to the order of tied scores.
+        """
+        if ranking == 'cosine' or minimum_should_match > 1:
+            return self._top_documents_vectorized(query_terms, num_of_results, ranking, minimum_should_match, snapshot)
+        score_segment = partial(self._top_in_segment_wand, heap=[], block_max=block_max)
+        return self._top_documents_by_segment(score_segment, query_terms, num_of_results, ranking, minimum_should_match,
+                                              snapshot=snapshot)
+
+    def _top_documents_matrix(self, query_terms, num_of_results, ranking, minimum_should_match=1, snapshot=None):
+        """
+        Scores the sealed segments with their term-document matrices. The write buffer changes with every added
+        document, so it is scored like 'vectorized' instead.
+        """
+        return self._top_documents_by_segment(self._top_in_segment_matrix, query_terms, num_of_results, ranking,
+                                              minimum_should_match, snapshot=snapshot)
+
+    def _top_in_segment_matrix(self, segment, query, num_of_results, document_norms):
+        if isinstance(segment, BufferSnapshot):
+            return self._top_in_segment_vectorized(segment, query, num_of_results, document_norms)
+        ranking = query.ranking
+        if ranking is None:
+            ranking = 'cosine' if document_norms is None else 'full_cosine'
+        segment_matrix = self._segment_matrix(segment)
+        term_ids = [self._term_ids.get(term, -1) for term in query.terms]
+        present = [column for column, term_id in enumerate(term_ids) if 0 <= term_id < segment_matrix.num_of_terms]
+        if not present:
+            return []
+        matrix = self._weighted_matrix(segment_matrix, ranking, query.snapshot)
+        columns = segment_matrix.columns(matrix, [term_ids[column] for column in present])
+        matches = np.bincount(columns.indices, minlength=segment_matrix.num_of_docs)
+        rows = np.flatnonzero(matches >= max(query.minimum_should_match, 1))
+        if not len(rows):
+            return []
+        if query.ranking is not None:
+            similarities = columns.dot(query.weights[present])[rows]
+        else:
+            multiplicities = query.multiplicities[present]
+            dot_products = columns.dot(multiplicities * query.weights[present])[rows]
+            if document_norms is None:
+                norms = np.sqrt(columns.multiply(columns).dot(multiplicities)[rows])
+                similarities = dot_products / (norms * query.norm)
+            else:
+                similarities = dot_products / query.norm
+        doc_nums = rows + segment_matrix.first_doc_num
+        deleted = query.snapshot.deleted
+        if deleted:
+            live = ~deleted.contains(doc_nums)
+            doc_nums, similarities = doc_nums[live], similarities[live]
+        top_rows = _top_k_indices(similarities, num_of_results)
+        return zip(doc_nums[top_rows].tolist(), similarities[top_rows].tolist())
+
+    def _segment_matrix(self, segment):
+        """
+        :return: The segment's SegmentMatrix, compiled the first time it is needed.
+        """
+        with self._segment_matrices_lock:
+            segment_matrix = self._segment_matrices.get(segment)
+            if segment_matrix is None:
+                segment_matrix = self._segment_matrices[segment] = SegmentMatrix(segment, self._term_ids)
+            return segment_matrix
+
+    def _discard_segment_matrices(self, segments):
+        with self._segment_matrices_lock:
+            for segment in segments:
+                self._segment_matrices.pop(segment, None)
+
+    def _weighted_matrix(self, segment_matrix, ranking, snapshot):
+        """
+        :param ranking: A Ranking, 'cosine' or 'full_cosine'.
+        :return: The segment's matrix of the ranking's document weights, for the snapshot of the index:
+            'cosine' - TF*IDF weights, tf * idf / length.
+            'full_cosine' - the TF*IDF weights divided by the document's norm, so every row is a unit vector.
+            A Ranking - its term_scores.
+        """
+        def weigh(tfs, doc_nums, term_ids):
+            if isinstance(ranking, Ranking):
+                return ranking.term_scores(tfs, self._document_statistics(ranking, snapshot)[doc_nums])
+            weights = tfs / snapshot.doc_lengths[doc_nums] * self._idf_table(snapshot)[term_ids]
+            if ranking == 'full_cosine':
+                weights /= self._document_norms(snapshot)[doc_nums]
+            return weights
+
+        return segment_matrix.weighted(ranking, snapshot.generation, weigh)
+
+    def term_document_matrix(self, ranking='cosine'):
+        """
+        Compiles the sealed segments into a single matrix (documents in the write buffer are only included after a
+        flush).
+        :param ranking: One of RANKINGS, or a Ranking instance. 'cosine' gives the TF*IDF weights, 'full_cosine'
+        their L2 normalized rows, and a ranking function its term scores.
+        :return: A SciPy CSR matrix of the weights, with a row per document number and a column per term id, and the
+        dictionary of the term ids.
+        """
+        if not isinstance(ranking, Ranking):
+            if ranking not in RANKINGS:
+                raise ValueError('Unknown ranking {!r}, expected one of {}'.format(ranking, RANKINGS))
+            ranking = RANKING_FUNCTIONS.get(ranking, ranking)
+        snapshot = self._snapshot
+        matrices = [(segment_matrix, self._weighted_matrix(segment_matrix, ranking, snapshot))
+                    for segment_matrix in map(self._segment_matrix, snapshot.segments[:-1])]
+        # Term ids are only ever added, so every segment has at most as many columns.
+        term_ids = dict(self._term_ids)
+        if not matrices:
+            return sparse.csr_matrix((0, len(term_ids))), term_ids
+        return sparse.vstack([segment_matrix.padded(matrix, len(term_ids)) for segment_matrix, matrix in matrices],
+                             format='csr'), term_ids
+
+    def _top_in_segment_wand(self, segment, query, num_of_results, document_norms, heap, block_max=False,
+                             scored_counts=None):
+        """
+        :param heap: The best scores so far, shared by all the segments of the query (see pruning.wand).
+        :param scored_counts: If given, a list the number of documents WAND scored is appended to.
+        """
+        ranking = query.ranking
+        if ranking is None:
+            # A term's score is weight * tf / (length * norm).
+            term_weights = query.multiplicities * query.weights * query.idfs / query.norm
+        else:
+            term_weights = query.weights
+        cursors = []
+        for term, weight in izip(query.terms, term_weights):
+            posting_list = self._posting_list(segment, term)
+            if posting_list is not None and len(posting_list):
+                bounds = self._term_score_bounds(segment, term, posting_list, query, document_norms)
+                cursors.append(PostingCursor(posting_list, weight, bounds))
+        lengths = query.snapshot.doc_lengths
+        statistics = query.document_statistics
+        deleted = query.snapshot.deleted
+
+        def score(doc_num, term_weights):
+            if doc_num in deleted:
+                return None
+            if ranking is not None:
+                return sum(weight * ranking.term_scores(tf, statistics[doc_num]) for weight, tf in term_weights)
+            return sum(weight * tf for weight, tf in term_weights) / (lengths[doc_num] * document_norms[doc_num])
+
+        scored = wand(cursors, num_of_results, score, heap, block_max)
+        if scored_counts is not None:
+            scored_counts.append(len(scored))
+        threshold = heap[0] - TOLERANCE if len(heap) == num_of_results else float('-inf')
+        doc_nums = np.array([doc_num for doc_num, similarity in scored if similarity >= threshold], dtype=np.uint32)
+        if not len(doc_nums):
+            return []
+        posting_lists = [self._posting_list(segment, term) for term in query.terms]
+        return self._top_candidates(doc_nums, self._candidate_tfs(posting_lists, doc_nums), query, num_of_results,
+                                    document_norms)
+
+    def _term_score_bounds(self, segment, term, posting_list, query, document_norms):
+        """
+        :return: The term's pruning.score_bounds in the segment for the query's ranking, without the query's weight.
+        """
+        key = ('score_bounds', segment, term, query.ranking)
+        bounds = query.snapshot.cache.get(key)
+        if bounds is None:
+            doc_nums, tfs = posting_list.arrays()
+            if query.ranking is None:
+                lengths = query.snapshot.doc_lengths[doc_nums]
+                normalized_weights = tfs / (lengths * document_norms[doc_nums])
+            else:
+                normalized_weights = query.ranking.term_scores(tfs.astype(float), query.document_statistics[doc_nums])
+            bounds = query.snapshot.cache[key] = score_bounds(doc_nums, normalized_weights)
+        return bounds
+
+    def _document_statistics(self, ranking, snapshot, statistics=None):
+        """
+        :param statistics: CollectionStatistics to take the average document length from, instead of this index.
+        :return: The ranking's per-document statistics (see Ranking.document_statistics), computed once per snapshot.
+        """
+        key = ('document_statistics', ranking)
+        if statistics is not None and statistics.num_of_docs:
+            key = ('document_statistics', ranking, float(statistics.total_length) / statistics.num_of_docs)
+        document_statistics = snapshot.cache.get(key)
+        if document_statistics is None:
+            if len(key) == 3:
+                average_length = key[2]
+            else:
+                live_lengths = self._live_lengths(snapshot)
+                average_length = live_lengths.mean() if len(live_lengths) else 1.0
+            document_statistics = snapshot.cache[key] = ranking.document_statistics(
+                snapshot.doc_lengths.astype(float), average_length)
+        return document_statistics
+
+    @staticmethod
+    def _live_lengths(snapshot):
+        """
+        :return: A NumPy array of the lengths of the documents that are not deleted.
+        """
+        lengths = snapshot.doc_lengths.astype(float)
+        return lengths[~snapshot.deleted.contains(np.arange(len(lengths)))] if snapshot.deleted else lengths
+
+    def collection_statistics(self, terms=None):
+        """
+        :param terms: The terms to get the document frequencies of. Defaults to every term some document has.
+        :return: The CollectionStatistics of the index (see _top_documents).
+        """
+        snapshot = self._snapshot
+        if terms is None:
+            document_frequencies = snapshot.document_frequencies.array()
+            # items() copies the dictionary at once, so terms a writer adds meanwhile don't break the iteration.
+            document_frequencies = {term: int(document_frequencies[term_id]) for term, term_id in self._term_ids.items()
+                                    if term_id < len(document_frequencies) and document_frequencies[term_id]}
+        else:
+            document_frequencies = {term: self._document_frequency(term, snapshot) for term in set(terms)}
+        return CollectionStatistics(snapshot.num_of_docs, int(self._live_lengths(snapshot).sum()),
+                                    document_frequencies)
+
+    def set_global_statistics(self, global_statistics):
+        """
+        Makes queries score with the statistics of the whole collection the index is a shard of, instead of its own.
+        Only COLLECTION_SCORING_STRATEGIES can be used then.
+        :param global_statistics: An object whose statistics(terms) returns the CollectionStatistics of the
+        collection, like a term_statistics.TermStatistics; or None to go back to the index's own statistics.
+        """
+        with self._write_lock:
+            self._global_statistics = global_statistics
+            # The scores of every query change, so the cached results are dropped.
+            self._publish()
+
+    def _top_documents_by_segment(self, score_segment, query_terms, num_of_results, ranking, minimum_should_match,
+                                  statistics=None, snapshot=None):
+        """
+        Scores each segment on its own, with the global statistics (IDFs, document lengths and norms), and merges
+        the top results of the segments. Segments are in document number order and the merge is stable, so tied
+        scores are ordered the same way as if the index were a single segment.
+        :param score_segment: A function (segment, query statistics, k, document norms or None) -> a list of the
+        segment's top (document number, similarity) tuples.
+        :param statistics: CollectionStatistics to score with instead of the index's own (see _top_documents).
+        :param snapshot: The IndexSnapshot to score on. Defaults to the current one.
+        """
+        snapshot = snapshot or self._snapshot
+        if not query_terms or num_of_results <= 0 or not len(snapshot.doc_lengths):
+            return []
+        query = self._query_statistics(query_terms, snapshot, minimum_should_match, ranking, statistics)
+        document_norms = None
+        if ranking == 'full_cosine':
+            document_norms = self._document_norms(snapshot)
+        segment_results = (score_segment(segment, query, num_of_results, document_norms)
+                           for segment in snapshot.segments)
+        top_results = heapq.nlargest(num_of_results, chain.from_iterable(segment_results), key=itemgetter(1))
+        return self._resolve_documents(top_results)
+
+    def _query_statistics(self, query_terms, snapshot, minimum_should_match=1, ranking=None, statistics=None):
+        """
+        A query term that appears m times in the query is kept once, with multiplicity m: weighting its
+        contributions by m gives the same cosine as repeating it m times.
+        :param snapshot: The IndexSnapshot the query is scored on.
+        :param ranking: A Ranking, or the name of a cosine ranking.
+        :param statistics: CollectionStatistics to compute the IDFs from, instead of the index's own.
+        """
+        term_counts = Counter(query_terms)
+        terms = list(term_counts)
+        multiplicities = np.array([term_counts[term] for term in terms], dtype=float)
+        if statistics is not None:
+            num_of_docs = statistics.num_of_docs
+            document_frequencies = [statistics.document_frequencies.get(term, 0) for term in terms]
+        if isinstance(ranking, Ranking):
+            if statistics is None:
+                num_of_docs = snapshot.num_of_docs
+                document_frequencies = [self._document_frequency(term, snapshot) for term in terms]
+            idfs = np.array([ranking.idf(df, num_of_docs) for df in document_frequencies], dtype=float)
+            return _QueryStatistics(terms, multiplicities, idfs, multiplicities * idfs, 1.0, minimum_should_match,
+                                    ranking, self._document_statistics(ranking, snapshot, statistics), snapshot)
+        if statistics is None:
+            idfs = self._term_idfs(terms, snapshot)
+        else:
+            idfs = _cosine_idfs(document_frequencies, num_of_docs)
+        weights = multiplicities / len(query_terms) * idfs
+        return _QueryStatistics(terms, multiplicities, idfs, weights, sqrt((weights * weights).dot(multiplicities)),
+                                minimum_should_match, None, None, snapshot)
+
+    def _top_in_segment_vectorized(self, segment, query, num_of_results, document_norms):
+        posting_lists = [self._posting_list(segment, term) for term in query.terms]
+        if query.minimum_should_match > 1:
+            doc_nums = match_postings(posting_lists, query.minimum_should_match)
+            if not len(doc_nums):
+                return []
+            tfs = self._candidate_tfs(posting_lists, doc_nums)
+        else:
+            arrays = [posting_list.arrays() if posting_list is not None else None for posting_list in posting_lists]
+            present = [term_arrays[0] for term_arrays in arrays if term_arrays is not None]
+            if not present:
+                return []
+            doc_nums = np.unique(np.concatenate(present))
+            tfs = np.zeros((len(doc_nums), len(query.terms)))
+            for column, term_arrays in enumerate(arrays):
+                if term_arrays is not None:
+                    term_doc_nums, term_tfs = term_arrays
+                    tfs[np.searchsorted(doc_nums, term_doc_nums), column] = term_tfs
+        return self._top_candidates(doc_nums, tfs, query, num_of_results, document_norms)
+
+    @staticmethod
+    def _candidate_tfs(posting_lists, doc_nums):
+        """
+        :return: A (candidates x query terms) matrix of term frequencies, looked up in the posting lists.
+        """
+        tfs = np.zeros((len(doc_nums), len(posting_lists)))
+        for column, posting_list in enumerate(posting_lists):
+            if posting_list is not None:
+                tfs[:, column] = posting_list.lookup(doc_nums)
+        return tfs
+
+    def _top_candidates(self, doc_nums, tfs, query, num_of_results, document_norms):
+        """
+        Computes the cosine similarity (or the ranking's score) of every candidate at once.
+        :param doc_nums: A sorted NumPy array of the candidates' document numbers.
+        :param tfs: A (candidates x query terms) matrix of term frequencies.
+        :return: A list of the top (document number, similarity) tuples of the candidates that are not deleted.
+        """
+        if query.ranking is not None:
+            statistics = query.document_statistics[doc_nums]
+            similarities = query.ranking.term_scores(tfs, statistics[:, np.newaxis]).dot(query.weights)
+        else:
+            lengths = query.snapshot.doc_lengths[doc_nums]
+            weights = tfs / lengths[:, np.newaxis] * query.idfs
+
+            dot_products = weights.dot(query.multiplicities * query.weights)
+            if document_norms is not None:
+                norms = document_norms[doc_nums]
+            else:
+                norms = np.sqrt((weights * weights).dot(query.multiplicities))
+            similarities = dot_products / (norms * query.norm)
+        deleted = query.snapshot.deleted
+        if deleted:
+            live = ~deleted.contains(doc_nums)
+            doc_nums, similarities = doc_nums[live], similarities[live]
+
+        top_rows = _top_k_indices(similarities, num_of_results)
+        return zip(doc_nums[top_rows].tolist(), similarities[top_rows].tolist())
+
+    def _top_in_segment_term_at_a_time(self, segment, query, num_of_results, document_norms):
+        """
+        For the projected cosine two accumulators are needed - the dot product and the squared norm of the
+        document's projection on the query terms - while the full cosine only accumulates the dot product and
+        divides by the precomputed norm.
+        The accumulators are dense arrays indexed by position in the segment. np.zeros gets its memory zeroed
+        lazily by the OS, so only the pages that the postings touch cost anything.
+        When documents must match more than one term, a third accumulator counts the terms each document has.
+        With a Ranking, every posting adds weight * term score to a single accumulator.
+        """
+        dot_products = np.zeros(segment.num_of_docs)
+        squared_norms = np.zeros(segment.num_of_docs)
+        if query.minimum_should_match > 1:
+            matches = np.zeros(segment.num_of_docs, dtype=np.int32)
+        touched = []
+        lengths = query.snapshot.doc_lengths
+        for term, multiplicity, idf, query_weight in izip(query.terms, query.multiplicities, query.idfs,
+                                                          query.weights):
+            posting_list = self._posting_list(segment, term)
+            if posting_list is None:
+                continue
+            doc_nums, tfs = posting_list.arrays()
+            positions = doc_nums - segment.first_doc_num
+            # A document appears at most once in a posting list, so the fancy-indexed += never collides.
+            if query.ranking is not None:
+                dot_products[positions] += query_weight * query.ranking.term_scores(
+                    tfs.astype(float), query.document_statistics[doc_nums])
+            else:
+                weights = tfs * idf / lengths[doc_nums]
+                dot_products[positions] += multiplicity * query_weight * weights
+                squared_norms[positions] += multiplicity * weights * weights
+            if query.minimum_should_match > 1:
+                matches[positions] += 1
+            touched.append(positions)
+        if not touched:
+            return []
+        positions = np.unique(np.concatenate(touched))
+        if query.minimum_should_match > 1:
+            positions = positions[matches[positions] >= query.minimum_should_match]
+        deleted = query.snapshot.deleted
+        if deleted:
+            positions = positions[~deleted.contains(positions + segment.first_doc_num)]
+        if query.ranking is not None:
+            similarities = dot_products[positions]
+        else:
+            if document_norms is not None:
+                norms = document_norms[positions + segment.first_doc_num]
+            else:
+                norms = np.sqrt(squared_norms[positions])
+            similarities = dot_products[positions] / (query.norm * norms)
+        top_rows = _top_k_indices(similarities, num_of_results)
+        return zip((positions[top_rows] + segment.first_doc_num).tolist(), similarities[top_rows].tolist())
+
+    def _score_documents(self, query_terms, ranking='cosine', minimum_should_match=1, snapshot=None):
+        """
+        Scores every document that shares at least one term (or minimum_should_match unique terms) with the query.
+        :param query_terms: A list containing the terms (string) of the query.
+        :param ranking: 'cosine' or 'full_cosine' (see query_by_terms).
+        :param minimum_should_match: How many of the unique query terms a document must have.
+        :param snapshot: The IndexSnapshot to score on. Defaults to the current one.
+        :return: A generator of (document, similarity) tuples, in no particular order.
+        """
+        snapshot = snapshot or self._snapshot
+        query_tf_idf_vector = self.calculate_tf_idf_for_query(query_terms, snapshot)
+        term_to_idf_mapping = dict(izip(query_terms, self._term_idfs(query_terms, snapshot).tolist()))
+        if ranking == 'full_cosine':
+            document_norms = self._document_norms(snapshot)
+            query_norm = np.linalg.norm(query_tf_idf_vector)
+        for segment in snapshot.segments:
+            posting_lists = {term: self._posting_list(segment, term) for term in query_terms}
+            for doc_num in self._get_relevant_doc_nums(query_terms, [segment], minimum_should_match, snapshot):
+                resolved = self._resolve_documents([(doc_num, None)])
+                if not resolved:
+                    continue
+                document = resolved[0][0]
+                document_vector = []
+                for query_term in query_terms:
+                    # "I love all the restaurants, I especially recommend trying McDonalds"
+                    # [[x,y], [a,b], [c,d]]
+                    query_tf = 0
+                    if posting_lists[query_term] is not None:
+                        query_tf = float(posting_lists[query_term].tf(doc_num)) / snapshot.doc_lengths[doc_num]
+                    query_idf = term_to_idf_mapping[query_term]
+                    document_vector.append(query_tf * query_idf)
+                if ranking == 'full_cosine':
+                    similarity = np.dot(query_tf_idf_vector, document_vector) / (query_norm * document_norms[doc_num])
+                else:
+                    similarity = 1 - spatial.distance.cosine(query_tf_idf_vector, document_vector)
+                yield document, similarity
+
+    def _score_documents_by_ranking(self, query_terms, ranking, minimum_should_match=1, snapshot=None):
+        """
+        The document at a time counterpart of _score_documents for a Ranking.
+        :return: A generator of (document, score) tuples, in no particular order.
+        """
+        snapshot = snapshot or self._snapshot
+        query = self._query_statistics(query_terms, snapshot, minimum_should_match, ranking)
+        for segment in snapshot.segments:
+            posting_lists = [self._posting_list(segment, term) for term in query.terms]
+            for doc_num in self._get_relevant_doc_nums(query_terms, [segment], minimum_should_match, snapshot):
+                score = 0.0
+                for posting_list, weight in izip(posting_lists, query.weights):
+                    if posting_list is not None:
+                        score += weight * ranking.term_scores(posting_list.tf(doc_num),
+                                                              query.document_statistics[doc_num])
+                for document, _ in self._resolve_documents([(doc_num, score)]):
+                    yield document, score
+
+    def _document_norms(self, snapshot=None):
+        """
+        Returns the norm of every document's full TF*IDF vector, indexed by document number.
+        Adding a document changes the IDF of every term, so the norms are computed (in one pass over the postings of
+        every segment) once per snapshot, the first time they are needed.
+        :return: A NumPy array of floats.
+        """
+        snapshot = snapshot or self._snapshot
+        norms = snapshot.cache.get('document_norms')
+        if norms is None:
+            norms_squared = np.zeros(len(snapshot.doc_lengths))
+            lengths = snapshot.doc_lengths
+            idfs = self._idf_table(snapshot)
+            term_ids = self._term_ids
+            for segment in snapshot.segments:
+                for term in segment.terms():
+                    idf = idfs[term_ids[term]]
+                    doc_nums, tfs = segment.posting_list(term).arrays()
+                    weights = tfs * idf / lengths[doc_nums]
+                    norms_squared[doc_nums] += weights * weights
+            norms = snapshot.cache['document_norms'] = np.sqrt(norms_squared)
+        return norms
 
     def _get_relevant_doc_ids(self, terms):
         """
@@ -111,30 +1505,86 @@ class IREngine(object):
         :returns a list of doc_ids (strings) that are relevant to the query (as in they have at least one term
         associated with the query).
         """
-        relevant_docs = set()
-        for term in terms:
-            if term in self.inverted_index:
-                [relevant_docs.add(doc_id) for doc_id in self.inverted_index[term].iterkeys()]
-        return relevant_docs
+        return set(self._doc_ids[doc_num] for doc_num in self._get_relevant_doc_nums(terms))
 
-    def _calculate_term_idf(self, term):
+    def _get_relevant_doc_nums(self, terms, segments=None, minimum_should_match=1, snapshot=None):
+        """
+        :param terms: The terms given in a query.
+        :param segments: The segments to look in. Defaults to all of them.
+        :param minimum_should_match: How many of the unique terms a document must have.
+        :param snapshot: The IndexSnapshot the segments are from. Defaults to the current one.
+        :return: A sorted NumPy array of the numbers of the (not deleted) documents that have at least one of the terms
+        (or minimum_should_match of them).
+        """
+        snapshot = snapshot or self._snapshot
+        if segments is None:
+            segments = snapshot.segments
+        if minimum_should_match > 1:
+            doc_nums = [match_postings([self._posting_list(segment, term) for term in set(terms)], minimum_should_match)
+                        for segment in segments]
+        else:
+            doc_nums = [self._posting_list(segment, term).arrays()[0]
+                        for segment in segments for term in set(terms) if term in segment]
+        if not doc_nums:
+            return np.array([], dtype=np.uint32)
+        doc_nums = np.unique(np.concatenate(doc_nums))
+        if snapshot.deleted:
+            doc_nums = doc_nums[~snapshot.deleted.contains(doc_nums)]
+        return doc_nums
+
+    def _term_id(self, term, snapshot):
         """
-        Calculates IDF for a given term. I chose the normalization method of taking the natural log
+        :return: The term's id, or -1 if no document of the snapshot has had the term.
+        """
+        term_id = self._term_ids.get(term, -1)
+        return term_id if term_id < len(snapshot.document_frequencies) else -1
+
+    def _document_frequency(self, term, snapshot=None):
+        """
+        :return: The number of (not deleted) documents that have the term, over all the segments.
+        """
+        snapshot = snapshot or self._snapshot
+        term_id = self._term_id(term, snapshot)
+        return int(snapshot.document_frequencies[term_id]) if term_id >= 0 else 0
+
+    def _idf_table(self, snapshot=None):
+        """
+        Calculates IDF for every term. I chose the normalization method of taking the natural log
         of (total number of documents) / (number of docs with term) because it is simple to implement and
         is considered one of the most effective normalization techniques.
+        The table is computed (in one vectorized pass over the document frequencies) once per snapshot, the first time
+        it is needed.
+        :return: A NumPy array of the normalized IDF values, indexed by term id. It has one more entry, the IDF of
+        a term that is not indexed, so that -1 can stand for such a term.
+        """
+        snapshot = snapshot or self._snapshot
+        idfs = snapshot.cache.get('idfs')
+        if idfs is None:
+            idfs = snapshot.cache['idfs'] = np.append(_cosine_idfs(snapshot.document_frequencies.array(),
+                                                                   snapshot.num_of_docs), 1.0)
+        return idfs
+
+    def _term_idfs(self, terms, snapshot=None):
+        """
+        :return: A NumPy array of the IDFs of the terms, read from the snapshot's IDF table (see _idf_table).
+        """
+        snapshot = snapshot or self._snapshot
+        return self._idf_table(snapshot)[[self._term_id(term, snapshot) for term in terms]]
+
+    def _calculate_term_idf(self, term):
+        """
         :param term: The term
-        :return: A normalized IDF value.
+        :return: The term's normalized IDF value (see _idf_table).
         """
-        num_of_docs_with_term = len(self.inverted_index.get(term, {}))
-        if term in self.inverted_index:
-            return 1.0 + log(float(len(self.documents)) / num_of_docs_with_term)
-        return 1.0
+        snapshot = self._snapshot
+        return float(self._idf_table(snapshot)[self._term_id(term, snapshot)])
 
-    def calculate_tf_idf_for_query(self, query_terms):
+    def calculate_tf_idf_for_query(self, query_terms, snapshot=None):
         """
         Calculates TF*IDF for a query, by creating a small mapped inverted index for the query (to get the tf),
         deriving and computing the formula's values from it.
         :param query_terms: The query terms (list of strings)
+        :param snapshot: The IndexSnapshot to take the IDFs from. Defaults to the current one.
         :return: A list of numbers which represents the TF*IDF vector of the query.
         """
         query_term_frequencies = {}
@@ -146,8 +1596,7 @@ class IREngine(object):
             else:
                 query_term_frequencies[query_term] += 1
         # Use the mapping to compute TF*IDF for the query
-        for query_term in query_terms:
+        for query_term, term_idf in izip(query_terms, self._term_idfs(query_terms, snapshot).tolist()):
             term_tf = float(query_term_frequencies[query_term]) / len(query_terms)
-            term_idf = self._calculate_term_idf(query_term)
             query_vector.append(term_tf * term_idf)
         return query_vector
@@ -0,0 +1,1133 @@
+"""
+Micro-benchmarks for the IR-Engine. Run `python benchmark.py <benchmark> --help` for the options of each one.
+The benchmarks run on a synthetic, Zipf-distributed tweet corpus, so they don't need the dataset file.
+"""
+import argparse
+import asynchat
+import asyncore
+import multiprocessing
+import os
+from bisect import bisect_left
+from functools import partial
+import heapq
+from itertools import chain, izip
+from operator import itemgetter
+import random
+import string
+import socket
+import sys
+import threading
+import time
+import traceback
+import urllib
+
+from nltk.corpus import stopwords
+from nltk.stem import PorterStemmer
+
+from document import Document
+from IREngine import IREngine, RANKINGS, SCORING_STRATEGIES, _resolve_minimum_should_match
+from ingest import read_tweets
+import server
+from sharding import ShardedEngine, shard_of
+from term_statistics import TermStatistics
+from tokenize_utils import Analyzer, StemmingAnalyzer, stem_cache_info, resize_stem_cache
+
+_STOPWORD_SAMPLE = ['the', 'a', 'is', 'I', 'to', 'and', 'my', 'you', 'it', 'in', 'for', 'of', 'on', 'me', 'so']
+
+
+def synthetic_tweets(num_of_docs, vocabulary_size=50000, words_per_doc=14, seed=1):
+    """
+    Generates tweet-like texts whose words follow a Zipf distribution, sprinkled with stopwords and punctuation.
+    :param num_of_docs: Number of texts to generate.
+    :param vocabulary_size: Number of distinct (non-stop) words.
+    :param words_per_doc: Average number of words per text.
+    :param seed: Random seed, so every run generates the same corpus.
+    :return: A generator of (doc_id, text) tuples.
+    """
+    rng = random.Random(seed)
+    vocabulary = [_synthetic_word(rng, rank) for rank in xrange(vocabulary_size)]
+    weights = [1.0 / rank for rank in xrange(1, vocabulary_size + 1)]
+    cumulative, total = [], 0.0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    for doc_num in xrange(num_of_docs):
+        words = []
+        for _ in xrange(max(1, int(rng.gauss(words_per_doc, 4)))):
+            if rng.random() < 0.35:
+                words.append(rng.choice(_STOPWORD_SAMPLE))
+            else:
+                words.append(vocabulary[bisect_left(cumulative, rng.random() * total)])
+        if rng.random() < 0.5:
+            words[-1] += rng.choice('!?.,')
+        yield str(1467810000 + doc_num), ' '.join(words)
+
+
+def _synthetic_word(rng, rank):
+    length = 3 + min(rank, 9999) % 7
+    word = ''.join(rng.choice(string.ascii_lowercase) for _ in xrange(length))
+    return word.capitalize() if rank % 11 == 0 else word
+
+
+def build_engine(num_of_docs, dataset=None, **engine_options):
+    """
+    Indexes the first `num_of_docs` tweets of the dataset file, or synthetic tweets if no dataset is given.
+    """
+    engine = IREngine(**engine_options)
+    tweets = read_tweets(dataset, num_of_docs) if dataset else synthetic_tweets(num_of_docs)
+    start = time.time()
+    for doc_id, text in tweets:
+        engine.add_document(Document(doc_id, text))
+    print 'indexed {:,} documents in {:.1f}s'.format(len(engine.documents), time.time() - start)
+    return engine
+
+
+def common_term_queries(engine, num_of_queries=20, terms_per_query=2, seed=2):
+    """
+    Builds queries out of the most frequent terms in the index, which have the largest candidate sets.
+    """
+    rng = random.Random(seed)
+    inverted_index = engine.inverted_index
+    terms = sorted(inverted_index, key=lambda term: len(inverted_index[term]), reverse=True)[:200]
+    return [rng.sample(terms, terms_per_query) for _ in xrange(num_of_queries)]
+
+
+def tweet_queries(engine, num_of_queries=50, terms_per_query=3, seed=3):
+    """
+    Builds queries out of the terms of random indexed tweets, the way a user would search for a tweet they saw,
+    so every query matches at least one document with all of its terms.
+    """
+    rng = random.Random(seed)
+    doc_ids = list(engine.documents)
+    queries = []
+    while len(queries) < num_of_queries:
+        terms = list(set(engine.documents[rng.choice(doc_ids)].terms))
+        if len(terms) >= terms_per_query:
+            queries.append(rng.sample(terms, terms_per_query))
+    return queries
+
+
+def _time_queries(function, queries):
+    start = time.time()
+    for query_terms in queries:
+        function(query_terms)
+    return (time.time() - start) / len(queries)
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def _report(label, count, unit, seconds):
+    print '{:<28} {:>12,.0f} {}/sec  ({:.3f}s)'.format(label, count / seconds if seconds else 0, unit, seconds)
+
+
+def _legacy_simpler_tokenization(text):
+    # The tokenizer as it was before the compiled Analyzer, for comparison.
+    words = text.translate(None, string.punctuation).split()
+    terms = []
+    for word in words:
+        word = unicode(word, 'utf-8', errors='ignore').strip()
+        word = word.encode('ascii', 'ignore').lower()
+        if word not in stopwords.words("english"):
+            terms.append(word)
+    return terms
+
+
+def bench_tokenize(args):
+    texts = [text for _, text in synthetic_tweets(args.docs)]
+    num_of_words = sum(len(text.split()) for text in texts)
+    start = time.time()
+    for text in texts[:args.legacy_docs]:
+        _legacy_simpler_tokenization(text)
+    legacy_words = sum(len(text.split()) for text in texts[:args.legacy_docs])
+    _report('before (per-word corpus read)', legacy_words, 'tokens', time.time() - start)
+    analyzer = Analyzer()
+    start = time.time()
+    for text in texts:
+        analyzer.analyze(text)
+    _report('after (Analyzer)', num_of_words, 'tokens', time.time() - start)
+    print 'term cache: {}'.format(analyzer.cache_info())
+
+
+def bench_stem(args):
+    texts = [text for _, text in synthetic_tweets(args.docs)]
+    words = [word.lower() for text in texts for word in text.translate(None, string.punctuation).split()]
+    start = time.time()
+    for text in texts[:args.legacy_docs]:
+        # What smart_tokenizer used to do: a fresh stemmer per call, and every word stemmed from scratch.
+        stemmer = PorterStemmer()
+        [stemmer.stem(word.lower()) for word in text.translate(None, string.punctuation).split()]
+    legacy_words = sum(len(text.split()) for text in texts[:args.legacy_docs])
+    _report('before (uncached stemming)', legacy_words, 'tokens', time.time() - start)
+    resize_stem_cache(args.cache_size)
+    analyzer = StemmingAnalyzer()
+    start = time.time()
+    for text in texts:
+        analyzer.analyze(text)
+    _report('after (StemmingAnalyzer)', len(words), 'tokens', time.time() - start)
+    print 'distinct words: {:,}'.format(len(set(words)))
+    print 'stem cache: {}'.format(stem_cache_info())
+
+
+def bench_topk(args):
+    engine = build_engine(args.docs)
+    queries = common_term_queries(engine)
+    candidates = sum(len(engine._get_relevant_doc_ids(terms)) for terms in queries) / len(queries)
+    print 'average candidates per query: {:,}'.format(candidates)
+    for k in args.k:
+        def full_sort(query_terms):
+            results = list(engine._score_documents(query_terms))
+            return sorted(results, key=lambda tup: tup[1], reverse=True)[:k]
+        sort_latency = _time_queries(full_sort, queries)
+        heap_latency = _time_queries(lambda query_terms: engine.query_by_terms(query_terms, k), queries)
+        print 'k={:<4} full sort {:8.2f}ms   heap {:8.2f}ms'.format(k, sort_latency * 1000, heap_latency * 1000)
+
+
+def _same_ranking(expected, actual, tolerance=1e-9):
+    """
+    Compares two lists of (document, score) tuples. Documents with tied scores may legitimately come back in a
+    different order, or a different subset of them may make the cut, so the scores are compared position by
+    position and the documents are only compared above the lowest score.
+    """
+    if len(expected) != len(actual):
+        return False
+    if any(abs(left[1] - right[1]) > tolerance for left, right in zip(expected, actual)):
+        return False
+    if not expected:
+        return True
+    cutoff = expected[-1][1] + tolerance
+    return (set(document.doc_id for document, score in expected if score > cutoff) ==
+            set(document.doc_id for document, score in actual if score > cutoff))
+
+
+def _compare_strategies(engine, queries, baseline, contenders, k=10, **query_options):
+    """
+    Checks that every contender returns the same top-k as the baseline strategy, and reports the latency of
+    each strategy.
+    """
+    def ranking(scoring, query_terms):
+        return engine._top_documents(query_terms, k, scoring, **query_options)
+
+    mismatches = {contender: 0 for contender in contenders}
+    for query_terms in queries:
+        expected = ranking(baseline, query_terms)
+        for contender in contenders:
+            if not _same_ranking(expected, ranking(contender, query_terms)):
+                mismatches[contender] += 1
+    for scoring in (baseline,) + tuple(contenders):
+        latency = _time_queries(lambda query_terms: ranking(scoring, query_terms), queries)
+        parity = '' if scoring == baseline else '  mismatching queries: {}/{}'.format(mismatches[scoring],
+                                                                                      len(queries))
+        print '{:<12} {:8.2f}ms/query{}'.format(scoring, latency * 1000, parity)
+
+
+def bench_cosine(args):
+    engine = build_engine(args.docs)
+    queries = common_term_queries(engine, terms_per_query=args.terms)
+    _compare_strategies(engine, queries, 'document', ('vectorized',), ranking=args.ranking)
+
+
+class _CountingDict(dict):
+    """
+    A dictionary that counts its key lookups (get, [] and in).
+    """
+
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.lookups = 0
+
+    def __getitem__(self, key):
+        self.lookups += 1
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self.lookups += 1
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        self.lookups += 1
+        return dict.__contains__(self, key)
+
+
+def _hash_lookups(engine, query_terms, scoring, ranking):
+    """
+    Counts the dictionary probes a query makes against the inverted index (the postings of every segment and the
+    term ids) and the per-document structures (the documents and their numbers), by swapping them for counting
+    dictionaries while the query runs. The query's own small dictionaries are not counted.
+    """
+    snapshot = engine.snapshot()
+    tables = [(engine, 'documents'), (engine, '_doc_nums'), (engine, '_term_ids')]
+    tables.extend((segment, '_postings') for segment in snapshot.segments)
+    originals = [getattr(owner, name) for owner, name in tables]
+    counting = [_CountingDict(original) for original in originals]
+    try:
+        for (owner, name), table in izip(tables, counting):
+            setattr(owner, name, table)
+        engine._top_documents(query_terms, 10, scoring, ranking, snapshot=snapshot)
+    finally:
+        for (owner, name), original in izip(tables, originals):
+            setattr(owner, name, original)
+    return sum(table.lookups for table in counting)
+
+
+def bench_accumulator(args):
+    engine = build_engine(args.docs)
+    queries = common_term_queries(engine, terms_per_query=args.terms)
+    for scoring in ('document', 'term'):
+        lookups = sum(_hash_lookups(engine, query_terms, scoring, args.ranking)
+                      for query_terms in queries) / len(queries)
+        print '{:<12} {:>12,} hash lookups/query'.format(scoring, lookups)
+    _compare_strategies(engine, queries, 'document', ('vectorized', 'term'), ranking=args.ranking)
+
+
+def _deep_size(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(key, seen) + _deep_size(value, seen) for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_size(item, seen) for item in obj)
+    return size
+
+
+def _merged_postings(engine):
+    """
+    Merges all of the engine's segments into one.
+    :return: The {term: posting list} dictionary of the merged segment.
+    """
+    engine.force_merge()
+    return engine._segments[0]._postings
+
+
+def bench_memory(args):
+    engine = build_engine(args.docs, args.dataset)
+    postings = _merged_postings(engine)
+    num_of_postings = sum(len(posting_list) for posting_list in postings.itervalues())
+    # Document ids and terms are shared with the documents and the analyzer's caches, so they are not counted.
+    shared = set(id(doc_id) for doc_id in engine.documents) | set(id(term) for term in postings)
+    as_dicts = {term: dict(postings.iteritems()) for term, postings in engine.inverted_index.iteritems()}
+    dict_bytes = _deep_size(as_dicts, set(shared))
+    array_bytes = sum(sys.getsizeof(posting_list) + sys.getsizeof(posting_list.doc_nums) +
+                      sys.getsizeof(posting_list.tfs) for posting_list in postings.itervalues())
+    array_bytes += sys.getsizeof(postings)
+    id_table_bytes = sys.getsizeof(engine._doc_ids) + sys.getsizeof(engine._doc_nums)
+    print 'postings: {:,}'.format(num_of_postings)
+    print 'dict of dicts:   {:8.1f} bytes/posting'.format(float(dict_bytes) / num_of_postings)
+    print 'posting arrays:  {:8.1f} bytes/posting (+{:.1f} for the doc id table)'.format(
+        float(array_bytes) / num_of_postings, float(id_table_bytes) / num_of_postings)
+
+
+def bench_compression(args):
+    engine = build_engine(args.docs, args.dataset, posting_codec='vbyte')
+    # Sealed segments hold fully encoded posting lists; only the write buffer is raw.
+    posting_lists = _merged_postings(engine).values()
+    num_of_postings = sum(len(posting_list) for posting_list in posting_lists)
+    compressed_bytes = sum(posting_list.compressed_size() for posting_list in posting_lists)
+    print 'postings: {:,}'.format(num_of_postings)
+    print 'raw arrays: {:,} bytes   vbyte: {:,} bytes   ratio {:.2f}x   ({:.2f} bytes/posting)'.format(
+        6 * num_of_postings, compressed_bytes, 6.0 * num_of_postings / compressed_bytes,
+        float(compressed_bytes) / num_of_postings)
+    long_lists = [posting_list for posting_list in posting_lists if len(posting_list) >= args.min_length]
+    long_postings = sum(len(posting_list) for posting_list in long_lists)
+    start = time.time()
+    for posting_list in long_lists:
+        posting_list.arrays()
+    _report('decode ({:,} lists >= {})'.format(len(long_lists), args.min_length), long_postings, 'postings',
+            time.time() - start)
+    queries = common_term_queries(engine)
+    latency = _time_queries(lambda query_terms: engine.query_by_terms(query_terms, 5, scoring='term'), queries)
+    print 'term-at-a-time query on compressed postings: {:.2f}ms'.format(latency * 1000)
+
+
+def bench_coldstart(args):
+    start = time.time()
+    engine = build_engine(args.docs, args.dataset)
+    rebuild_seconds = time.time() - start
+    engine.save(args.index)
+    queries = common_term_queries(engine)
+    del engine
+    start = time.time()
+    engine = IREngine.open(args.index)
+    open_seconds = time.time() - start
+    engine.query_by_terms(queries[0])
+    first_query_seconds = time.time() - start - open_seconds
+    print 'index file: {:,} bytes'.format(os.path.getsize(args.index))
+    print 'rebuild from scratch: {:8.3f}s'.format(rebuild_seconds)
+    print 'open saved index:     {:8.3f}s  (first query {:.3f}s later)'.format(open_seconds, first_query_seconds)
+
+
+def bench_parallel(args):
+    tweets = list(read_tweets(args.dataset, args.docs) if args.dataset else synthetic_tweets(args.docs))
+    print 'cpu count: {}'.format(multiprocessing.cpu_count())
+    baseline = None
+    for workers in args.workers:
+        engine = IREngine()
+        start = time.time()
+        engine.add_documents(tweets, workers=workers)
+        seconds = time.time() - start
+        baseline = baseline or seconds
+        print '{:>3} workers: {:10,.0f} docs/sec  ({:.2f}s, speedup {:.2f}x)'.format(
+            workers, len(tweets) / seconds, seconds, baseline / seconds)
+
+
+def bench_segments(args):
+    tweets = list(synthetic_tweets(args.docs))
+    queries = None
+    for buffer_size in args.buffer_size:
+        engine = IREngine(buffer_size=buffer_size, merge_factor=args.merge_factor)
+        start = time.time()
+        for doc_id, text in tweets:
+            engine.add_document(Document(doc_id, text))
+        index_seconds = time.time() - start
+        engine.flush()
+        engine.close()
+        queries = queries or common_term_queries(engine)
+        latency = _time_queries(lambda query_terms: engine.query_by_terms(query_terms, 10, scoring='term'), queries)
+        print 'buffer {:>7,}: {:8,.0f} docs/sec  {:>3} segments  {:6.2f}ms/query'.format(
+            buffer_size, len(tweets) / index_seconds, len(engine._segments), latency * 1000)
+    engine.force_merge()
+    latency = _time_queries(lambda query_terms: engine.query_by_terms(query_terms, 10, scoring='term'), queries)
+    print 'force merged:    {:>26} {:6.2f}ms/query'.format('1 segment ', latency * 1000)
+
+
+def bench_conjunctive(args):
+    engine = build_engine(args.docs, args.dataset, posting_codec=args.codec)
+    queries = tweet_queries(engine, terms_per_query=args.terms)
+    modes = [('or', None), ('or', -1), ('and', None)]
+    for operator, minimum_should_match in modes:
+        def query(query_terms):
+            return engine.query_by_terms(query_terms, 10, scoring=args.scoring, operator=operator,
+                                         minimum_should_match=minimum_should_match)
+        candidates = 0
+        for query_terms in queries:
+            required = _resolve_minimum_should_match(len(set(query_terms)), operator, minimum_should_match)
+            candidates += len(engine._get_relevant_doc_nums(query_terms, minimum_should_match=required))
+        candidates /= len(queries)
+        label = operator if minimum_should_match is None else '{} (should match {})'.format(operator,
+                                                                                           minimum_should_match)
+        print '{:<24} {:>10,} candidates/query  {:8.2f}ms/query'.format(label, candidates,
+                                                                          _time_queries(query, queries) * 1000)
+
+
+def _documents_scored(engine, query_terms, scoring, k):
+    """
+    :return: How many documents a query fully scores: every candidate for exhaustive scoring, and only the
+    documents that survive pruning for WAND.
+    """
+    if scoring not in ('wand', 'block_max_wand'):
+        return len(engine._get_relevant_doc_nums(query_terms))
+    scored_counts = []
+    score_segment = partial(engine._top_in_segment_wand, heap=[], block_max=scoring == 'block_max_wand',
+                            scored_counts=scored_counts)
+    engine._top_documents_by_segment(score_segment, query_terms, k, 'full_cosine', 1)
+    return sum(scored_counts)
+
+
+def bench_pruning(args):
+    engine = build_engine(args.docs, args.dataset, posting_codec=args.codec)
+    queries = common_term_queries(engine, args.queries // 2, args.terms) + tweet_queries(engine, args.queries // 2,
+                                                                                         args.terms)
+    # The norms and WAND's upper bounds are part of the index, computed once per change; not per query.
+    start = time.time()
+    for query_terms in queries:
+        engine._top_documents(query_terms, args.k, 'wand', 'full_cosine')
+    print 'norms and upper bounds: {:.2f}s'.format(time.time() - start)
+    for scoring in ('vectorized', 'wand', 'block_max_wand'):
+        mismatches = 0
+        latencies = []
+        for query_terms in queries:
+            start = time.time()
+            results = engine._top_documents(query_terms, args.k, scoring, 'full_cosine')
+            latencies.append(time.time() - start)
+            if not _same_ranking(engine._top_documents(query_terms, args.k, 'vectorized', 'full_cosine'), results):
+                mismatches += 1
+        scored = sum(_documents_scored(engine, query_terms, scoring, args.k) for query_terms in queries)
+        print '{:<16} {:>10,} docs scored/query  p50 {:7.2f}ms  p99 {:7.2f}ms  mismatching queries: {}/{}'.format(
+            scoring, scored / len(queries), _percentile(latencies, 50) * 1000, _percentile(latencies, 99) * 1000,
+            mismatches, len(queries))
+
+
+def bench_ranking(args):
+    engine = build_engine(args.docs, args.dataset, posting_codec=args.codec)
+    queries = tweet_queries(engine, args.queries, args.terms)
+    # The document norms and the ranking functions' document statistics are computed once per change of the index.
+    for ranking in RANKINGS:
+        engine._top_documents(queries[0], args.k, 'vectorized', ranking)
+    for scoring in args.scoring:
+        for ranking in RANKINGS:
+            latency = _time_queries(lambda query_terms: engine._top_documents(query_terms, args.k, scoring, ranking),
+                                    queries)
+            print '{:<16} {:<12} {:8,.0f} queries/sec  {:6.2f}ms/query'.format(scoring, ranking, 1 / latency,
+                                                                               latency * 1000)
+
+
+def zipf_query_log(queries, num_of_queries, exponent=1.0, seed=4):
+    """
+    Replays distinct queries with Zipf-distributed popularity: the i-th query is asked about 1 / i^exponent as often
+    as the first, like trending searches.
+    """
+    rng = random.Random(seed)
+    cumulative, total = [], 0.0
+    for rank in xrange(1, len(queries) + 1):
+        total += 1.0 / rank ** exponent
+        cumulative.append(total)
+    return [queries[bisect_left(cumulative, rng.random() * total)] for _ in xrange(num_of_queries)]
+
+
+def bench_cache(args):
+    engine = build_engine(args.docs, args.dataset, result_cache_size=args.cache_size,
+                          result_cache_bytes=args.cache_bytes)
+    engine.refresh_statistics()
+    query_log = zipf_query_log(tweet_queries(engine, args.distinct_queries, args.terms), args.queries, args.exponent)
+    result_cache = engine._result_cache
+    for label, cache in (('uncached', None), ('cached', result_cache)):
+        engine._result_cache = cache
+        new_tweets = synthetic_tweets(args.queries, seed=7)
+        latencies = []
+        for position, query_terms in enumerate(query_log, 1):
+            start = time.time()
+            engine.query_by_terms(query_terms, args.k, scoring=args.scoring)
+            latencies.append(time.time() - start)
+            if args.update_every and position % args.update_every == 0:
+                doc_id, text = next(new_tweets)
+                engine.add_document(Document('{}-{}-{}'.format(label, position, doc_id), text))
+        print '{:<9} {:8,.0f} queries/sec  p50 {:6.3f}ms  p99 {:6.3f}ms'.format(
+            label, len(latencies) / sum(latencies), _percentile(latencies, 50) * 1000,
+            _percentile(latencies, 99) * 1000)
+    info = engine.result_cache_info()
+    print 'hit ratio {:.1%}  {}'.format(float(info.hits) / (info.hits + info.misses), info)
+
+
+def bench_postings_cache(args):
+    engine = build_engine(args.docs, args.dataset, posting_codec='vbyte', result_cache_size=0)
+    engine.force_merge()
+    engine.save(args.index)
+    inverted_index = engine.inverted_index
+    terms = sorted(inverted_index, key=lambda term: len(inverted_index[term]), reverse=True)
+    # Every query pairs a hot term, picked with Zipf-distributed popularity, with a random term of the long tail,
+    # so hardly any query repeats: a result cache would not help, but the hot terms' postings are decoded again and
+    # again.
+    rng = random.Random(5)
+    hot_terms = zipf_query_log(terms[:args.hot_terms], args.queries)
+    query_log = [[hot_term, rng.choice(terms[args.hot_terms:])] for hot_term in hot_terms]
+    for label, cache_bytes in (('uncached', 0), ('cached', args.cache_bytes)):
+        engine = IREngine.open(args.index, result_cache_size=0, postings_cache_bytes=cache_bytes)
+        engine.refresh_statistics()
+        latencies = []
+        for query_terms in query_log:
+            start = time.time()
+            engine.query_by_terms(query_terms, args.k, scoring=args.scoring)
+            latencies.append(time.time() - start)
+        print '{:<9} {:8,.0f} queries/sec  p50 {:6.3f}ms  p99 {:6.3f}ms'.format(
+            label, len(latencies) / sum(latencies), _percentile(latencies, 50) * 1000,
+            _percentile(latencies, 99) * 1000)
+    info = engine.postings_cache_info()
+    print 'hit ratio {:.1%}  decoding took {:.2f}s, saved {:.2f}s  {}'.format(
+        float(info.hits) / (info.hits + info.misses), info.decode_seconds, info.saved_seconds, info)
+    os.remove(args.index)
+
+
+def bench_batch(args):
+    engine = build_engine(args.docs, args.dataset, result_cache_size=0)
+    engine.refresh_statistics()
+    queries = [' '.join(query_terms) for query_terms in tweet_queries(engine, args.queries, args.terms)]
+    for ranking in args.ranking:
+        start = time.time()
+        for query in queries:
+            engine.query_by_terms(engine.analyzer.analyze(query), args.k, ranking=ranking)
+        loop_seconds = time.time() - start
+        start = time.time()
+        engine.batch_query(queries, args.k, ranking, batch_size=args.batch_size)
+        batch_seconds = time.time() - start
+        query_terms = [engine.analyzer.analyze(query) for query in queries]
+        batch_results = engine._batch_top_documents(query_terms, args.k, ranking)
+        mismatches = sum(not _same_ranking(engine._top_documents(terms, args.k, 'vectorized', ranking), results)
+                         for terms, results in izip(query_terms, batch_results))
+        print '{:<12} loop {:7,.0f} queries/sec  batch {:7,.0f} queries/sec ({:4.1f}x)  mismatching: {}/{}'.format(
+            ranking, len(queries) / loop_seconds, len(queries) / batch_seconds, loop_seconds / batch_seconds,
+            mismatches, len(queries))
+
+
+def bench_matrix(args):
+    engine = build_engine(args.docs, args.dataset, posting_codec=args.codec, result_cache_size=0)
+    engine.flush()
+    engine.merge()
+    engine.refresh_statistics()
+    queries = tweet_queries(engine, args.queries, args.terms)
+    start = time.time()
+    for segment in engine._segments:
+        engine._segment_matrix(segment)
+    print 'compiled {} segments in {:.2f}s, {:,} bytes'.format(
+        len(engine._segments), time.time() - start,
+        sum(segment_matrix.memory_size() for segment_matrix in engine._segment_matrices.itervalues()))
+    for ranking in args.ranking:
+        # The matrices are reweighted once per change of the index, like the document norms; not per query.
+        start = time.time()
+        engine._top_documents(queries[0], args.k, 'matrix', ranking)
+        print '{}: reweighted in {:.2f}s'.format(ranking, time.time() - start)
+        _compare_strategies(engine, queries, 'vectorized', ('term', 'matrix'), args.k, ranking=ranking)
+
+
+def bench_sharded(args):
+    tweets = list(read_tweets(args.dataset, args.docs) if args.dataset else synthetic_tweets(args.docs))
+    engine = IREngine(result_cache_size=0)
+    start = time.time()
+    engine.add_documents(tweets)
+    print 'single engine: indexed {:,.0f} documents/sec'.format(len(tweets) / (time.time() - start))
+    queries = tweet_queries(engine, args.queries, args.terms)
+    for num_of_shards in args.shards:
+        with ShardedEngine(num_of_shards, result_cache_size=0) as sharded:
+            start = time.time()
+            sharded.add_documents(tweets)
+            print '{} shards: indexed {:,.0f} documents/sec'.format(num_of_shards, len(tweets) / (time.time() - start))
+            for ranking in args.ranking:
+                mismatches = 0
+                for query_terms in queries:
+                    expected = engine._top_documents(query_terms, args.k, 'vectorized', ranking)
+                    actual = sharded._top_documents(query_terms, args.k, 'vectorized', ranking)
+                    if any(abs(left[1] - right[2]) > 1e-9 for left, right in izip(expected, actual)):
+                        mismatches += 1
+                single_latency = _time_queries(lambda query_terms: engine._top_documents(
+                    query_terms, args.k, 'vectorized', ranking), queries)
+                sharded_latency = _time_queries(lambda query_terms: sharded._top_documents(
+                    query_terms, args.k, 'vectorized', ranking), queries)
+                print '  {:<12} single {:6.2f}ms/query  sharded {:6.2f}ms/query  mismatching scores: {}/{}'.format(
+                    ranking, single_latency * 1000, sharded_latency * 1000, mismatches, len(queries))
+
+
+def _sharded_top_documents(shards, query_terms, k, ranking, global_statistics):
+    statistics = global_statistics.statistics(query_terms)
+    results = [shard._top_documents(query_terms, k, 'vectorized', ranking, statistics=statistics) for shard in shards]
+    return heapq.nlargest(k, chain.from_iterable(results), key=itemgetter(1))
+
+
+def bench_term_statistics(args):
+    tweets = list(read_tweets(args.dataset, args.docs) if args.dataset else synthetic_tweets(args.docs))
+    shards = [IREngine(result_cache_size=0) for _ in xrange(args.shards)]
+    for shard_number, shard in enumerate(shards):
+        shard.add_documents(tweet for tweet in tweets if shard_of(tweet[0], args.shards) == shard_number)
+    exact = TermStatistics.merge([TermStatistics.of_engine(shard) for shard in shards])
+    terms = list(exact.document_frequencies)
+    print '{:,} documents in {} shards, {:,} terms; exact table: {:,} bytes'.format(
+        len(tweets), args.shards, len(terms), exact.memory_size())
+    queries = tweet_queries(shards[0], args.queries, args.terms)
+    expected = [_sharded_top_documents(shards, query_terms, args.k, args.ranking, exact) for query_terms in queries]
+    for exact_terms in args.exact_terms:
+        for sketch_width in args.sketch_width:
+            frequent_terms = set(chain.from_iterable(TermStatistics.of_engine(shard).frequent_terms(exact_terms)
+                                                     for shard in shards))
+            start = time.time()
+            table = TermStatistics.merge([TermStatistics.of_engine(shard, frequent_terms, sketch_width, args.depth)
+                                          for shard in shards])
+            elapsed = time.time() - start
+            errors = [table.document_frequency(term) - exact.document_frequencies[term] for term in terms
+                      if term not in table.document_frequencies]
+            relative_errors = [float(table.document_frequency(term)) / exact.document_frequencies[term] - 1
+                               for term in terms if term not in table.document_frequencies]
+            overlap = sum(len(set(document.doc_id for document, _ in left) &
+                              set(document.doc_id for document, _ in _sharded_top_documents(
+                                  shards, query_terms, args.k, args.ranking, table)))
+                          for left, query_terms in izip(expected, queries))
+            print ('exact {:>6,} width {:>7,}: {:>10,} bytes ({:5.1%})  built in {:.2f}s  sketched terms {:>7,}  '
+                   'df error mean {:6.2f} max {:>5,}  relative {:6.1%}  top-{} overlap {:6.1%}').format(
+                len(table.document_frequencies), sketch_width, table.memory_size(),
+                float(table.memory_size()) / exact.memory_size(), elapsed, len(errors),
+                float(sum(errors)) / len(errors) if errors else 0.0, max(errors) if errors else 0,
+                sum(relative_errors) / len(relative_errors) if relative_errors else 0.0, args.k,
+                float(overlap) / sum(len(results) for results in expected))
+
+
+def _live_in_snapshot(engine, snapshot, results):
+    """
+    :param results: Results (see IREngine._top_documents) scored on the snapshot.
+    :return: The results whose document is still the indexed version, and the number of them that were not live in
+    the snapshot: added after it was taken, or deleted before.
+    """
+    current, torn = [], 0
+    for document, score in results:
+        doc_num = engine._doc_nums.get(document.doc_id)
+        if engine.documents.get(document.doc_id) is not document or doc_num is None:
+            continue
+        current.append((document, score))
+        if doc_num >= len(snapshot.doc_lengths) or doc_num in snapshot.deleted:
+            torn += 1
+    return current, torn
+
+
+def _consistent_snapshot(snapshot):
+    """
+    :return: Whether the snapshot counts its live documents right, and its segments (the write buffer's snapshot
+    included) hold consecutive ranges of document numbers, so no document is in two of them.
+    """
+    if snapshot.num_of_docs != len(snapshot.doc_lengths) - len(snapshot.deleted):
+        return False
+    end_doc_num = 0
+    for segment in snapshot.segments:
+        if segment.first_doc_num != end_doc_num:
+            return False
+        end_doc_num += segment.num_of_docs
+    return True
+
+
+def bench_concurrency(args):
+    # Query results are the texts of the documents, and tweets repeat, so every text is tagged with its doc id: a
+    # document that shows up twice in a result is then a repeated text.
+    tweets = [(doc_id, '{} {}'.format(text, doc_id))
+              for doc_id, text in (read_tweets(args.dataset, args.docs + args.writes) if args.dataset
+                                   else synthetic_tweets(args.docs + args.writes))]
+    # The writers and the readers share the analyzer, whose cache is much smaller than the vocabulary, and the queries
+    # go through the result cache, so both are used and evicted from by every thread.
+    engine = IREngine(Analyzer(cache_size=args.analyzer_cache), buffer_size=args.buffer_size,
+                      merge_factor=args.merge_factor)
+    engine.add_documents(tweets[:args.docs])
+    queries = tweet_queries(engine, args.queries, args.terms)
+    query_texts = [' '.join(query_terms) for query_terms in queries]
+    rng = random.Random(0)
+    start = time.time()
+    for _ in xrange(args.queries):
+        engine.free_text_query(rng.choice(query_texts), args.k)
+    print 'idle index: {:,.0f} queries/sec'.format(args.queries / (time.time() - start))
+
+    stop = threading.Event()
+    errors = []
+    counters = {'writes': 0, 'queries': 0, 'torn': 0, 'inconsistent': 0, 'bad_snapshots': 0, 'duplicates': 0}
+    latencies = []
+
+    def write(writer_number):
+        # Every writer adds its own share of the new tweets, and deletes and updates only documents of its own share
+        # (of the initial tweets and the ones it added), so no two writers touch the same document.
+        rng = random.Random(writer_number)
+        own = [doc_id for doc_id, _ in tweets[writer_number:args.docs:args.writers]]
+        try:
+            for doc_id, text in tweets[args.docs + writer_number::args.writers]:
+                engine.add_document(Document(doc_id, text, engine.analyzer))
+                own.append(doc_id)
+                dice = rng.random()
+                if dice < args.delete_ratio:
+                    engine.delete_document(own.pop(rng.randrange(len(own))))
+                elif dice < args.delete_ratio + args.update_ratio:
+                    doc_id = rng.choice(own)
+                    text = '{} {}'.format(rng.choice(tweets)[1], doc_id)
+                    engine.update_document(Document(doc_id, text, engine.analyzer))
+                counters['writes'] += 1
+        except Exception:
+            errors.append(traceback.format_exc())
+
+    def read(reader_number):
+        rng = random.Random(1000 + reader_number)
+        try:
+            while not stop.is_set():
+                snapshot = engine.snapshot()
+                if not _consistent_snapshot(snapshot):
+                    counters['bad_snapshots'] += 1
+                query_text, ranking = rng.choice(query_texts), rng.choice(args.ranking)
+                query_start = time.time()
+                texts = engine.free_text_query(query_text, args.k, snapshot=snapshot)
+                latencies.append(time.time() - query_start)
+                if len(set(texts)) != len(texts):
+                    counters['duplicates'] += 1
+                # The same query on the same snapshot, while the writers go on, gets the same results with every
+                # strategy. The scores are compared, so these skip the result cache.
+                query_terms = engine.analyzer.analyze(query_text)
+                first = engine._top_documents(query_terms, args.k, 'vectorized', ranking, snapshot=snapshot)
+                second = engine._top_documents(query_terms, args.k, rng.choice(args.scoring), ranking,
+                                               snapshot=snapshot)
+                for results in (first, second):
+                    if len(set(document.doc_id for document, _ in results)) != len(results):
+                        counters['duplicates'] += 1
+                first, first_torn = _live_in_snapshot(engine, snapshot, first)
+                second, second_torn = _live_in_snapshot(engine, snapshot, second)
+                # A document deleted between the two checks would be in one of them only.
+                kept = set(document.doc_id for document, _ in first) & set(document.doc_id for document, _ in second)
+                if not _same_ranking([result for result in first if result[0].doc_id in kept],
+                                     [result for result in second if result[0].doc_id in kept]):
+                    counters['inconsistent'] += 1
+                counters['torn'] += first_torn + second_torn
+                counters['queries'] += 3
+        except Exception:
+            errors.append(traceback.format_exc())
+
+    writers = [threading.Thread(target=write, args=(number,)) for number in xrange(args.writers)]
+    readers = [threading.Thread(target=read, args=(number,)) for number in xrange(args.readers)]
+    start = time.time()
+    for thread in writers + readers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    elapsed = time.time() - start
+    stop.set()
+    for thread in readers:
+        thread.join()
+    engine.close()
+    print ('{} writers, {} readers: {:,.0f} writes/sec, {:,.0f} queries/sec, query p50 {:.2f}ms p99 {:.2f}ms max '
+           '{:.2f}ms').format(args.writers, args.readers, counters['writes'] / elapsed, counters['queries'] / elapsed,
+                              _percentile(latencies, 50) * 1000, _percentile(latencies, 99) * 1000,
+                              max(latencies) * 1000)
+    print ('{} errors, {} inconsistent snapshots, {} results with duplicate documents, {} results not live in their '
+           'snapshot, {} of {} repeated queries with other results').format(
+        len(errors), counters['bad_snapshots'], counters['duplicates'], counters['torn'], counters['inconsistent'],
+        counters['queries'] // 3)
+    print 'analyzer cache: {}'.format(engine.analyzer.cache_info())
+    print 'result cache: {}'.format(engine.result_cache_info())
+    for error in errors[:3]:
+        print error
+
+    # The index the writers left behind scores like an index built from scratch out of the same documents.
+    rebuilt = IREngine(result_cache_size=0)
+    rebuilt.add_documents((doc_id, document.text) for doc_id, document in engine.documents.items())
+    mismatches = sum(not _same_ranking(engine._top_documents(query_terms, args.k, 'vectorized', ranking),
+                                       rebuilt._top_documents(query_terms, args.k, 'vectorized', ranking))
+                     for query_terms in queries for ranking in args.ranking)
+    print 'final index versus rebuilt: {} of {} queries with other results'.format(
+        mismatches, len(queries) * len(args.ranking))
+
+
+class _LoadClient(asynchat.async_chat):
+    """
+    One connection of the load generator: sends a request, waits for the response, and sends the next one, over a
+    kept-alive connection.
+    """
+
+    def __init__(self, address, requests, latencies, statuses, socket_map):
+        asynchat.async_chat.__init__(self, map=socket_map)
+        self._requests = requests
+        self._latencies = latencies
+        self._statuses = statuses
+        self._incoming = []
+        self._status = None
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def handle_connect(self):
+        self._send_next()
+
+    def _send_next(self):
+        if not self._requests:
+            self.close()
+            return
+        self._start = time.time()
+        self.set_terminator('\r\n\r\n')
+        self.push('GET {} HTTP/1.1\r\nHost: benchmark\r\n\r\n'.format(self._requests.pop()))
+
+    def collect_incoming_data(self, data):
+        self._incoming.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self._incoming)
+        self._incoming = []
+        if self._status is None:
+            lines = data.split('\r\n')
+            self._status = int(lines[0].split()[1])
+            length = [int(line.split(':')[1]) for line in lines if line.lower().startswith('content-length:')][0]
+            self.set_terminator(length)
+            return
+        self._latencies.append(time.time() - self._start)
+        self._statuses[self._status] = self._statuses.get(self._status, 0) + 1
+        self._status = None
+        self._send_next()
+
+
+def generate_load(address, paths, concurrency):
+    """
+    Requests every path once, over `concurrency` connections that each wait for a response before sending the next
+    request (a closed loop).
+    :return: The seconds it took, the latency of every request, and a dictionary of how many responses had every
+    status.
+    """
+    socket_map = {}
+    requests = list(reversed(paths))
+    latencies, statuses = [], {}
+    start = time.time()
+    for _ in xrange(concurrency):
+        _LoadClient(address, requests, latencies, statuses, socket_map)
+    asyncore.loop(timeout=1.0, use_poll=True, map=socket_map)
+    return time.time() - start, latencies, statuses
+
+
+def check_threaded_queries(engine, query_texts, threads, k):
+    """
+    Runs free text queries from several threads at once, the way the server's pool threads do, and compares their
+    results with the same queries run from a single thread. The threads share the analyzer and its caches.
+    :return: The number of queries that raised, and the number of queries with other results.
+    """
+    expected = [engine.free_text_query(query_text, k) for query_text in query_texts]
+    errors = []
+    mismatches = [0]
+
+    def run(offset):
+        for index in xrange(offset, len(query_texts), threads):
+            try:
+                results = engine.free_text_query(query_texts[index], k)
+            except Exception:
+                errors.append(traceback.format_exc())
+                continue
+            if results != expected[index]:
+                mismatches[0] += 1
+
+    workers = [threading.Thread(target=run, args=(offset,)) for offset in xrange(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        print errors[0]
+    return len(errors), mismatches[0]
+
+
+def bench_server(args):
+    engine = build_engine(args.docs, args.dataset, result_cache_size=0,
+                          analyzer=Analyzer(cache_size=args.analyzer_cache))
+    engine.refresh_statistics()
+    query_server = server.start_in_background(engine, port=0, threads=args.threads, batch_size=args.batch_size,
+                                              max_pending=args.max_pending)
+    queries = tweet_queries(engine, args.requests, args.terms)
+    paths = ['/search?' + urllib.urlencode({'q': ' '.join(query_terms), 'k': args.k, 'scoring': args.scoring})
+             for query_terms in queries]
+    errors, mismatches = check_threaded_queries(engine, [' '.join(query_terms) for query_terms in queries],
+                                                args.threads, args.k)
+    info = engine.analyzer.cache_info()
+    print ('{} threads: {} errors, {} of {} queries with other results, analyzer cache {:,} of {:,} entries, '
+           '{:,} evictions').format(args.threads, errors, mismatches, len(queries), info.currsize, info.maxsize,
+                                    info.evictions)
+    # The load generator runs in its own process, so that it doesn't compete with the server for the GIL.
+    load_generator = multiprocessing.Pool(1)
+    for concurrency in args.concurrency:
+        seconds, latencies, statuses = load_generator.apply(generate_load, (query_server.address, paths, concurrency))
+        print ('{:>4} connections: {:7,.0f} requests/sec  p50 {:7.2f}ms  p95 {:7.2f}ms  p99 {:7.2f}ms  '
+               'statuses {}').format(concurrency, len(latencies) / seconds, _percentile(latencies, 50) * 1000,
+                                     _percentile(latencies, 95) * 1000, _percentile(latencies, 99) * 1000,
+                                     statuses)
+    load_generator.close()
+    stats = query_server.stats()
+    print '{} batches for {} queries, {} rejected'.format(stats['batches'], stats['queries'], stats['rejected'])
+    query_server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    benchmarks = parser.add_subparsers()
+
+    tokenize_parser = benchmarks.add_parser('tokenize', help='tokens/sec of the old tokenizer and the Analyzer')
+    tokenize_parser.add_argument('--docs', type=int, default=100000)
+    tokenize_parser.add_argument('--legacy-docs', type=int, default=1000,
+                                 help='the old tokenizer is very slow, so it only runs on a prefix of the corpus')
+    tokenize_parser.set_defaults(func=bench_tokenize)
+
+    stem_parser = benchmarks.add_parser('stem', help='tokens/sec of stemming with and without the stem cache')
+    stem_parser.add_argument('--docs', type=int, default=100000)
+    stem_parser.add_argument('--legacy-docs', type=int, default=10000)
+    stem_parser.add_argument('--cache-size', type=int, default=200000)
+    stem_parser.set_defaults(func=bench_stem)
+
+    topk_parser = benchmarks.add_parser('topk', help='query latency of full sorting versus top-k heap selection')
+    topk_parser.add_argument('--docs', type=int, default=100000, help='use 1000000 for the production-size index')
+    topk_parser.add_argument('--k', type=int, nargs='+', default=[5, 50, 500])
+    topk_parser.set_defaults(func=bench_topk)
+
+    cosine_parser = benchmarks.add_parser('cosine', help='parity and latency of per-document versus '
+                                                         'vectorized cosine scoring')
+    cosine_parser.add_argument('--docs', type=int, default=100000)
+    cosine_parser.add_argument('--terms', type=int, default=3, help='terms per query')
+    cosine_parser.add_argument('--ranking', default='cosine', choices=RANKINGS)
+    cosine_parser.set_defaults(func=bench_cosine)
+
+    accumulator_parser = benchmarks.add_parser('accumulator', help='hash lookups and latency of document-at-a-time '
+                                                                   'versus term-at-a-time scoring')
+    accumulator_parser.add_argument('--docs', type=int, default=100000)
+    accumulator_parser.add_argument('--terms', type=int, default=3, help='terms per query')
+    accumulator_parser.add_argument('--ranking', default='cosine', choices=RANKINGS)
+    accumulator_parser.set_defaults(func=bench_accumulator)
+
+    memory_parser = benchmarks.add_parser('memory', help='bytes per posting of the inverted index')
+    memory_parser.add_argument('--docs', type=int, default=100000)
+    memory_parser.add_argument('--dataset', help='path to tweets.csv; use with --docs 1600000 for the full file')
+    memory_parser.set_defaults(func=bench_memory)
+
+    compression_parser = benchmarks.add_parser('compression', help='compression ratio and decode throughput of '
+                                                                   'delta + variable-byte posting lists')
+    compression_parser.add_argument('--docs', type=int, default=100000)
+    compression_parser.add_argument('--dataset', help='path to tweets.csv')
+    compression_parser.add_argument('--min-length', type=int, default=1000,
+                                    help='only time decoding lists at least this long')
+    compression_parser.set_defaults(func=bench_compression)
+
+    coldstart_parser = benchmarks.add_parser('coldstart', help='opening a saved index versus indexing again')
+    coldstart_parser.add_argument('--docs', type=int, default=100000)
+    coldstart_parser.add_argument('--dataset', help='path to tweets.csv')
+    coldstart_parser.add_argument('--index', default='benchmark.index', help='where to save the index')
+    coldstart_parser.set_defaults(func=bench_coldstart)
+
+    parallel_parser = benchmarks.add_parser('parallel', help='bulk indexing throughput by number of workers')
+    parallel_parser.add_argument('--docs', type=int, default=200000)
+    parallel_parser.add_argument('--dataset', help='path to tweets.csv')
+    parallel_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parallel_parser.set_defaults(func=bench_parallel)
+
+    conjunctive_parser = benchmarks.add_parser('conjunctive', help='candidates and latency of disjunctive versus '
+                                                                   'conjunctive queries')
+    conjunctive_parser.add_argument('--docs', type=int, default=200000)
+    conjunctive_parser.add_argument('--dataset', help='path to tweets.csv')
+    conjunctive_parser.add_argument('--terms', type=int, default=3, help='terms per query')
+    conjunctive_parser.add_argument('--codec', default='raw', choices=('raw', 'vbyte'))
+    conjunctive_parser.add_argument('--scoring', default='vectorized', choices=SCORING_STRATEGIES)
+    conjunctive_parser.set_defaults(func=bench_conjunctive)
+
+    pruning_parser = benchmarks.add_parser('pruning', help='documents scored and latency percentiles of exhaustive '
+                                                           'scoring versus (Block-Max) WAND')
+    pruning_parser.add_argument('--docs', type=int, default=200000)
+    pruning_parser.add_argument('--dataset', help='path to tweets.csv')
+    pruning_parser.add_argument('--queries', type=int, default=100)
+    pruning_parser.add_argument('--terms', type=int, default=2, help='terms per query')
+    pruning_parser.add_argument('--k', type=int, default=5)
+    pruning_parser.add_argument('--codec', default='raw', choices=('raw', 'vbyte'))
+    pruning_parser.set_defaults(func=bench_pruning)
+
+    ranking_parser = benchmarks.add_parser('ranking', help='query throughput of the cosine rankings versus BM25 '
+                                                           'and BM25+')
+    ranking_parser.add_argument('--docs', type=int, default=200000)
+    ranking_parser.add_argument('--dataset', help='path to tweets.csv')
+    ranking_parser.add_argument('--queries', type=int, default=100)
+    ranking_parser.add_argument('--terms', type=int, default=3, help='terms per query')
+    ranking_parser.add_argument('--k', type=int, default=10)
+    ranking_parser.add_argument('--codec', default='raw', choices=('raw', 'vbyte'))
+    ranking_parser.add_argument('--scoring', nargs='+', default=['vectorized', 'term', 'block_max_wand'],
+                                choices=SCORING_STRATEGIES)
+    ranking_parser.set_defaults(func=bench_ranking)
+
+    cache_parser = benchmarks.add_parser('cache', help='query throughput with and without the result cache, '
+                                                       'replaying a Zipf-distributed query log')
+    cache_parser.add_argument('--docs', type=int, default=100000)
+    cache_parser.add_argument('--dataset', help='path to tweets.csv')
+    cache_parser.add_argument('--queries', type=int, default=20000, help='length of the query log')
+    cache_parser.add_argument('--distinct-queries', type=int, default=5000)
+    cache_parser.add_argument('--exponent', type=float, default=1.0, help='of the Zipf distribution')
+    cache_parser.add_argument('--terms', type=int, default=2, help='terms per query')
+    cache_parser.add_argument('--k', type=int, default=10)
+    cache_parser.add_argument('--scoring', default='vectorized', choices=SCORING_STRATEGIES)
+    cache_parser.add_argument('--cache-size', type=int, default=1024)
+    cache_parser.add_argument('--cache-bytes', type=int, default=16 * 1024 * 1024)
+    cache_parser.add_argument('--update-every', type=int, default=0,
+                              help='add a document every this many queries, which invalidates the cache')
+    cache_parser.set_defaults(func=bench_cache)
+
+    postings_cache_parser = benchmarks.add_parser('postings-cache', help='query throughput of a saved, compressed '
+                                                                         'index with and without the decoded '
+                                                                         'postings cache')
+    postings_cache_parser.add_argument('--docs', type=int, default=200000)
+    postings_cache_parser.add_argument('--dataset', help='path to tweets.csv')
+    postings_cache_parser.add_argument('--index', default='benchmark.index', help='where to save the index')
+    postings_cache_parser.add_argument('--queries', type=int, default=5000)
+    postings_cache_parser.add_argument('--hot-terms', type=int, default=1000,
+                                       help='number of frequent terms the queries are built around')
+    postings_cache_parser.add_argument('--k', type=int, default=10)
+    postings_cache_parser.add_argument('--scoring', default='vectorized', choices=SCORING_STRATEGIES)
+    postings_cache_parser.add_argument('--cache-bytes', type=int, default=64 * 1024 * 1024)
+    postings_cache_parser.set_defaults(func=bench_postings_cache)
+
+    batch_parser = benchmarks.add_parser('batch', help='query throughput of batch_query versus a loop of single '
+                                                       'queries')
+    batch_parser.add_argument('--docs', type=int, default=100000)
+    batch_parser.add_argument('--dataset', help='path to tweets.csv')
+    batch_parser.add_argument('--queries', type=int, default=5000)
+    batch_parser.add_argument('--terms', type=int, default=3, help='terms per query')
+    batch_parser.add_argument('--k', type=int, default=10)
+    batch_parser.add_argument('--ranking', nargs='+', default=['cosine', 'bm25'], choices=RANKINGS)
+    batch_parser.add_argument('--batch-size', type=int, default=1024, help='queries scored per pass')
+    batch_parser.set_defaults(func=bench_batch)
+
+    matrix_parser = benchmarks.add_parser('matrix', help='query latency of the term-document matrices versus '
+                                                         'posting list scoring')
+    matrix_parser.add_argument('--docs', type=int, default=200000)
+    matrix_parser.add_argument('--dataset', help='path to tweets.csv')
+    matrix_parser.add_argument('--queries', type=int, default=500)
+    matrix_parser.add_argument('--terms', type=int, default=3, help='terms per query')
+    matrix_parser.add_argument('--k', type=int, default=10)
+    matrix_parser.add_argument('--codec', default='raw', choices=('raw', 'vbyte'))
+    matrix_parser.add_argument('--ranking', nargs='+', default=['cosine', 'full_cosine', 'bm25'], choices=RANKINGS)
+    matrix_parser.set_defaults(func=bench_matrix)
+
+    sharded_parser = benchmarks.add_parser('sharded', help='indexing throughput, query latency and score parity of '
+                                                           'a ShardedEngine versus a single engine')
+    sharded_parser.add_argument('--docs', type=int, default=100000)
+    sharded_parser.add_argument('--dataset', help='path to tweets.csv')
+    sharded_parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    sharded_parser.add_argument('--queries', type=int, default=500)
+    sharded_parser.add_argument('--terms', type=int, default=3, help='terms per query')
+    sharded_parser.add_argument('--k', type=int, default=10)
+    sharded_parser.add_argument('--ranking', nargs='+', default=['cosine', 'bm25'], choices=RANKINGS)
+    sharded_parser.set_defaults(func=bench_sharded)
+
+    term_statistics_parser = benchmarks.add_parser('term-statistics', help='accuracy versus memory of the global '
+                                                                           'term statistics with a count-min sketch')
+    term_statistics_parser.add_argument('--docs', type=int, default=100000)
+    term_statistics_parser.add_argument('--dataset', help='path to tweets.csv')
+    term_statistics_parser.add_argument('--shards', type=int, default=4)
+    term_statistics_parser.add_argument('--queries', type=int, default=500)
+    term_statistics_parser.add_argument('--terms', type=int, default=3, help='terms per query')
+    term_statistics_parser.add_argument('--k', type=int, default=10)
+    term_statistics_parser.add_argument('--ranking', default='bm25', choices=RANKINGS)
+    term_statistics_parser.add_argument('--exact-terms', type=int, nargs='+', default=[1000, 10000],
+                                        help='most frequent terms of every shard kept exactly')
+    term_statistics_parser.add_argument('--sketch-width', type=int, nargs='+', default=[4096, 16384, 65536])
+    term_statistics_parser.add_argument('--depth', type=int, default=4, help='rows of the sketch')
+    term_statistics_parser.set_defaults(func=bench_term_statistics)
+
+    concurrency_parser = benchmarks.add_parser('concurrency', help='stress test of queries on snapshots while '
+                                                                   'writers add, delete and update documents')
+    concurrency_parser.add_argument('--docs', type=int, default=50000, help='documents indexed before the test')
+    concurrency_parser.add_argument('--dataset', help='path to tweets.csv')
+    concurrency_parser.add_argument('--writes', type=int, default=20000, help='documents added during the test')
+    concurrency_parser.add_argument('--writers', type=int, default=2)
+    concurrency_parser.add_argument('--readers', type=int, default=4)
+    concurrency_parser.add_argument('--delete-ratio', type=float, default=0.2, help='deletes per added document')
+    concurrency_parser.add_argument('--update-ratio', type=float, default=0.2, help='updates per added document')
+    concurrency_parser.add_argument('--buffer-size', type=int, default=2000,
+                                    help='small, so that flushes and merges happen during the test')
+    concurrency_parser.add_argument('--merge-factor', type=int, default=2,
+                                    help='small, so that merges run alongside the flushes')
+    concurrency_parser.add_argument('--queries', type=int, default=200)
+    concurrency_parser.add_argument('--terms', type=int, default=2, help='terms per query')
+    concurrency_parser.add_argument('--k', type=int, default=10)
+    concurrency_parser.add_argument('--analyzer-cache', type=int, default=1000,
+                                    help='term cache size of the analyzer, much smaller than the vocabulary')
+    # 'full_cosine' and 'matrix' recompute statistics of the whole index after every change, which dominates when
+    # there are writes between every two queries.
+    concurrency_parser.add_argument('--ranking', nargs='+', default=['cosine', 'bm25'], choices=RANKINGS)
+    concurrency_parser.add_argument('--scoring', nargs='+', default=['term', 'block_max_wand'],
+                                    choices=SCORING_STRATEGIES, help='strategies the queries are checked with')
+    concurrency_parser.set_defaults(func=bench_concurrency)
+
+    server_parser = benchmarks.add_parser('server', help='requests/sec and latency percentiles of the query server '
+                                                         'by number of concurrent connections')
+    server_parser.add_argument('--docs', type=int, default=100000)
+    server_parser.add_argument('--dataset', help='path to tweets.csv')
+    server_parser.add_argument('--requests', type=int, default=2000, help='requests per concurrency level')
+    server_parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64, 256])
+    server_parser.add_argument('--terms', type=int, default=3, help='terms per query')
+    server_parser.add_argument('--k', type=int, default=10)
+    server_parser.add_argument('--scoring', default='vectorized', choices=SCORING_STRATEGIES)
+    server_parser.add_argument('--threads', type=int, default=server.DEFAULT_THREADS)
+    server_parser.add_argument('--batch-size', type=int, default=server.DEFAULT_BATCH_SIZE)
+    server_parser.add_argument('--max-pending', type=int, default=server.DEFAULT_MAX_PENDING)
+    server_parser.add_argument('--analyzer-cache', type=int, default=1000,
+                               help='term cache size of the query analyzer, smaller than the vocabulary of the '
+                                    'queries so that the server threads evict each other\'s entries')
+    server_parser.set_defaults(func=bench_server)
+
+    segments_parser = benchmarks.add_parser('segments', help='indexing throughput and query latency by write '
+                                                             'buffer size')
+    segments_parser.add_argument('--docs', type=int, default=200000)
+    segments_parser.add_argument('--buffer-size', type=int, nargs='+', default=[1000, 10000, 100000])
+    segments_parser.add_argument('--merge-factor', type=int, default=10)
+    segments_parser.set_defaults(func=bench_segments)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
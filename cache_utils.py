@@ -0,0 +1,329 @@
+# A small package of cache structures shared by the tokenizers and the engine.
+from collections import namedtuple
+import random
+
+import numpy as np
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+# Names for the fields of a link in the LRU's circular doubly linked list.
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that evicts the least recently used entry once it holds `maxsize` entries.
+    Python 2 has no functools.lru_cache, so this is the same design: a dictionary pointing into a circular
+    doubly linked list, where the root's next link is the oldest entry and its previous link is the newest.
+    Both a hit and an insertion are O(1).
+    """
+
+    def __init__(self, maxsize):
+        if maxsize <= 0:
+            raise ValueError('maxsize must be positive, got {}'.format(maxsize))
+        self._maxsize = maxsize
+        self._map = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Fetches the value of `key` and marks it as the most recently used entry.
+        :param key: The key to look up.
+        :param default: Returned (and counted as a miss) when the key is not cached.
+        :return: The cached value, or `default`.
+        """
+        link = self._map.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        link_prev, link_next = link[_PREV], link[_NEXT]
+        link_prev[_NEXT] = link_next
+        link_next[_PREV] = link_prev
+        root = self._root
+        last = root[_PREV]
+        last[_NEXT] = root[_PREV] = link
+        link[_PREV] = last
+        link[_NEXT] = root
+        return link[_VALUE]
+
+    def put(self, key, value):
+        """
+        Caches `value` under `key`, evicting the least recently used entry if the cache is full.
+        """
+        link = self._map.get(key)
+        if link is not None:
+            link[_VALUE] = value
+            return
+        root = self._root
+        if len(self._map) >= self._maxsize:
+            # Reuse the old root as the new entry and promote the oldest entry to be the new root.
+            root[_KEY] = key
+            root[_VALUE] = value
+            self._map[key] = root
+            self._root = root[_NEXT]
+            del self._map[self._root[_KEY]]
+            self._root[_KEY] = self._root[_VALUE] = None
+            self.evictions += 1
+            return
+        last = root[_PREV]
+        link = [last, root, key, value]
+        last[_NEXT] = root[_PREV] = self._map[key] = link
+
+    def resize(self, maxsize):
+        """
+        Changes the capacity of the cache, evicting the least recently used entries if it shrinks.
+        """
+        if maxsize <= 0:
+            raise ValueError('maxsize must be positive, got {}'.format(maxsize))
+        self._maxsize = maxsize
+        while len(self._map) > maxsize:
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        """
+        Removes the least recently used entry.
+        :return: Its key.
+        """
+        oldest = self._root[_NEXT]
+        oldest[_PREV][_NEXT] = oldest[_NEXT]
+        oldest[_NEXT][_PREV] = oldest[_PREV]
+        del self._map[oldest[_KEY]]
+        self.evictions += 1
+        return oldest[_KEY]
+
+    def discard(self, key):
+        """
+        Removes `key` from the cache, if it is there. Not counted as an eviction.
+        """
+        link = self._map.pop(key, None)
+        if link is not None:
+            link[_PREV][_NEXT] = link[_NEXT]
+            link[_NEXT][_PREV] = link[_PREV]
+        return link is not None
+
+    def keys(self):
+        """
+        :return: A list of the cached keys, from the least to the most recently used.
+        """
+        return list(self._iter_oldest())
+
+    def _iter_oldest(self):
+        link = self._root[_NEXT]
+        while link is not self._root:
+            yield link[_KEY]
+            link = link[_NEXT]
+
+    def clear(self):
+        self._map.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+    def info(self):
+        """
+        :return: A CacheInfo tuple with the hit, miss and eviction counters and the current size.
+        """
+        return CacheInfo(self.hits, self.misses, self.evictions, self._maxsize, len(self._map))
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __len__(self):
+        return len(self._map)
+
+
+SizedCacheInfo = namedtuple('SizedCacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize', 'maxbytes',
+                                               'currbytes'])
+
+
+class SizedLRUCache(LRUCache):
+    """
+    An LRUCache that is bounded by the total size of its entries as well as by their number. It evicts the least
+    recently used entries until a new entry fits in both bounds. An entry that is bigger than `maxbytes` on its own
+    is not cached at all.
+    """
+
+    def __init__(self, maxsize, maxbytes, sizeof):
+        """
+        :param maxsize: The maximum number of entries.
+        :param maxbytes: The maximum total size of the entries.
+        :param sizeof: A function (key, value) -> the size of an entry, in bytes.
+        """
+        super(SizedLRUCache, self).__init__(maxsize)
+        if maxbytes <= 0:
+            raise ValueError('maxbytes must be positive, got {}'.format(maxbytes))
+        self._maxbytes = maxbytes
+        self._sizeof = sizeof
+        self._sizes = {}
+        self._currbytes = 0
+
+    def put(self, key, value):
+        """
+        Caches `value` under `key`, evicting the least recently used entries until it fits.
+        """
+        size = self._sizeof(key, value)
+        self.discard(key)
+        if size > self._maxbytes:
+            return
+        while self._map and (len(self._map) >= self._maxsize or self._currbytes + size > self._maxbytes):
+            self._evict_oldest()
+        root = self._root
+        last = root[_PREV]
+        link = [last, root, key, value]
+        last[_NEXT] = root[_PREV] = self._map[key] = link
+        self._sizes[key] = size
+        self._currbytes += size
+
+    def _evict_oldest(self):
+        key = super(SizedLRUCache, self)._evict_oldest()
+        self._currbytes -= self._sizes.pop(key)
+        return key
+
+    def discard(self, key):
+        if not super(SizedLRUCache, self).discard(key):
+            return False
+        self._currbytes -= self._sizes.pop(key)
+        return True
+
+    def clear(self):
+        super(SizedLRUCache, self).clear()
+        self._sizes.clear()
+        self._currbytes = 0
+
+    def info(self):
+        """
+        :return: A SizedCacheInfo tuple with the hit, miss and eviction counters, and the current size in entries and
+        in bytes.
+        """
+        return SizedCacheInfo(self.hits, self.misses, self.evictions, self._maxsize, len(self._map), self._maxbytes,
+                              self._currbytes)
+
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts of many keys in a fixed amount of memory: `depth` rows of `width` counters, where every key
+    increments one counter per row, picked by a different hash function per row. A key's estimate is the smallest of
+    its counters; collisions only ever make it too high.
+    """
+
+    def __init__(self, width, depth=4, seed=0):
+        if width <= 0 or depth <= 0:
+            raise ValueError('width and depth must be positive, got {} and {}'.format(width, depth))
+        self.width = width
+        self.depth = depth
+        self.seed = seed
+        self._counters = np.zeros((depth, width), dtype=np.uint32)
+        rng = random.Random(seed)
+        self._hash_parameters = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(_MERSENNE_PRIME))
+                                 for _ in xrange(depth)]
+        self.total = 0
+
+    def _columns(self, key):
+        value = hash(key) & 0xFFFFFFFFFFFFFFFF
+        return [(multiplier * value + offset) % _MERSENNE_PRIME % self.width
+                for multiplier, offset in self._hash_parameters]
+
+    def add(self, key, count=1):
+        """
+        Adds `count` to the key's counters.
+        """
+        counters = self._counters
+        for row, column in enumerate(self._columns(key)):
+            counters[row, column] += count
+        self.total += count
+
+    def estimate(self, key):
+        """
+        :return: An upper bound of the key's count, usually exact for frequent keys.
+        """
+        counters = self._counters
+        return int(min(counters[row, column] for row, column in enumerate(self._columns(key))))
+
+    def halve(self):
+        """
+        Halves every counter, so that old counts fade away.
+        """
+        self._counters >>= 1
+        self.total //= 2
+
+    def merge(self, other):
+        """
+        Adds the counts of another sketch with the same width, depth and seed, as if its keys were added to this one.
+        """
+        if (other.width, other.depth, other.seed) != (self.width, self.depth, self.seed):
+            raise ValueError('Can not merge a {}x{} sketch with seed {} into a {}x{} sketch with seed {}'.format(
+                other.depth, other.width, other.seed, self.depth, self.width, self.seed))
+        self._counters += other._counters
+        self.total += other.total
+
+    def memory_size(self):
+        """
+        :return: The number of bytes the counters take.
+        """
+        return self._counters.nbytes
+
+
+TinyLFUCacheInfo = namedtuple('TinyLFUCacheInfo', SizedCacheInfo._fields + ('rejections',))
+
+
+class TinyLFUCache(SizedLRUCache):
+    """
+    A SizedLRUCache with TinyLFU admission (Einziger et al., 2017). A CountMinSketch estimates how often every key
+    was asked for recently, cached or not. A new entry is only admitted if it was asked for more often than each of
+    the least recently used entries it would evict; otherwise it is rejected and the cache is left as is. A one-off
+    access (like a scan over every key) can not flush entries that are used all the time, which plain LRU lets
+    happen. The counts are halved every `sample_size` accesses, so keys that stop being popular fade out.
+    """
+
+    def __init__(self, maxsize, maxbytes, sizeof, sketch_width=4096, sample_size=None):
+        """
+        :param sketch_width: The number of counters in every row of the frequency sketch. Should be a few times the
+        number of entries the cache holds.
+        :param sample_size: The number of accesses between halvings of the counts. Defaults to 10 * sketch_width.
+        """
+        super(TinyLFUCache, self).__init__(maxsize, maxbytes, sizeof)
+        self._sketch = CountMinSketch(sketch_width)
+        self._sample_size = sample_size or 10 * sketch_width
+        self.rejections = 0
+
+    def get(self, key, default=None):
+        self._sketch.add(key)
+        if self._sketch.total >= self._sample_size:
+            self._sketch.halve()
+        return super(TinyLFUCache, self).get(key, default)
+
+    def put(self, key, value):
+        """
+        Caches `value` under `key` if it is asked for more often than the entries it would evict.
+        :return: Whether the entry was admitted.
+        """
+        size = self._sizeof(key, value)
+        if key not in self._map:
+            frequency = self._sketch.estimate(key)
+            excess_entries = len(self._map) + 1 - self._maxsize
+            excess_bytes = self._currbytes + size - self._maxbytes
+            if size > self._maxbytes:
+                self.rejections += 1
+                return False
+            for victim in self._iter_oldest():
+                if excess_entries <= 0 and excess_bytes <= 0:
+                    break
+                if self._sketch.estimate(victim) >= frequency:
+                    self.rejections += 1
+                    return False
+                excess_entries -= 1
+                excess_bytes -= self._sizes[victim]
+        super(TinyLFUCache, self).put(key, value)
+        return True
+
+    def info(self):
+        """
+        :return: A TinyLFUCacheInfo tuple: the SizedCacheInfo counters, and the number of rejected entries.
+        """
+        return TinyLFUCacheInfo(*super(TinyLFUCache, self).info() + (self.rejections,))
@@ -1,14 +1,19 @@
-from tokenize_utils import simpler_tokenization as tokenize
+from tokenize_utils import default_analyzer
 
 
 class Document(object):
-    def __init__(self, doc_id, text):
+    def __init__(self, doc_id, text, analyzer=None, lazy=False):
+        """
+        :param lazy: Don't tokenize the text until the terms are needed. Used for documents loaded from a saved
+        index, which are usually only fetched to display their text.
+        """
         self._doc_id = doc_id
         self._text = text
-        self._terms = self._parse_text()
+        self._analyzer = analyzer or default_analyzer()
+        self._terms = None if lazy else self._parse_text()
 
     def _parse_text(self):
-        return tokenize(self._text)
+        return self._analyzer.analyze(self._text)
 
     @property
     def doc_id(self):
@@ -20,10 +25,12 @@ class Document(object):
 
     @property
     def terms(self):
+        if self._terms is None:
+            self._terms = self._parse_text()
         return self._terms
 
     def __repr__(self):
-        return "{id}: {text} ({terms})".format(id=self._doc_id, text=self._text, terms=self._terms)
+        return "{id}: {text} ({terms})".format(id=self._doc_id, text=self._text, terms=self.terms)
 
     def __str__(self):
         return self._text
@@ -0,0 +1,52 @@
+# Streaming ingestion of the tweets dataset: rows are read, cleaned, tokenized and indexed a batch at a time, so
+# indexing the whole file never holds more than one batch of it in memory on top of the index itself.
+import csv
+import time
+from itertools import islice
+
+from IREngine import DEFAULT_BATCH_SIZE
+
+
+def clean_text(text):
+    return text.replace("\"", "").replace("\'", "")
+
+
+def read_tweets(path, limit=None, offset=0):
+    """
+    Streams tweets out of the dataset CSV file.
+    :param path: The dataset file.
+    :param limit: Maximal number of tweets to read (None reads until the end of the file).
+    :param offset: Number of tweets to skip first.
+    :return: A generator of (doc_id, text) tuples.
+    """
+    with open(path, 'rb') as dataset:
+        csv_reader = csv.reader(dataset)
+        next(csv_reader)  # The header
+        stop = offset + limit if limit is not None else None
+        for row in islice(csv_reader, offset, stop):
+            yield row[0], clean_text(row[5])
+
+
+def index_documents(engine, tweets, progress_every=10000, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Indexes a stream of tweets, reporting the progress about every `progress_every` documents.
+    The tweets are added a batch at a time (see IREngine.add_documents), so the index is published once per batch
+    rather than once per tweet, and the progress is reported after the batch that crosses every `progress_every`.
+    :param engine: The IREngine to index the tweets in.
+    :param tweets: An iterable of (doc_id, text) tuples.
+    :param progress_every: How often to print the progress (0 to never print it).
+    :param batch_size: Number of tweets per batch.
+    :return: The number of documents that were indexed.
+    """
+    start = time.time()
+    num_of_docs = 0
+    tweets = iter(tweets)
+    batch = list(islice(tweets, batch_size))
+    while batch:
+        reported = num_of_docs // progress_every if progress_every else 0
+        num_of_docs += engine.add_documents(batch, batch_size=batch_size)
+        if progress_every and num_of_docs // progress_every > reported:
+            print '{:,} documents indexed ({:,.0f} docs/sec)'.format(num_of_docs,
+                                                                     num_of_docs / (time.time() - start))
+        batch = list(islice(tweets, batch_size))
+    return num_of_docs
@@ -1,31 +1,65 @@
 """Main script for running the IR-Engine. Dependencies and how-tos can be found in the README.txt"""
 
-from document import Document
 from IREngine import IREngine
-import csv
+from ingest import read_tweets, index_documents
+from server import DEFAULT_THREADS, serve
+import argparse
+import os
+import time
 
 DATASET_FILE_NAME = 'tweets.csv'
 
-documents = {}
-with open(DATASET_FILE_NAME, 'rb') as dataset:
-    csv_reader = csv.reader(dataset)
-    header = next(csv_reader)
-    for i in xrange(1000):  # Load first 1000 documents
-        row = next(csv_reader)
-        documents[row[0]] = row[5].replace("\"", "").replace("\'", "")
-    # documents = {row[0]: row[5].replace("\"", "").replace("\'", "") for row in csv_reader} - Loads all documents
-
-search_engine = IREngine()
-print 'Welcome to Simple-Search!'
-print 'Processing documents. This might take a while.'
-for document_id, text in documents.iteritems():
-    search_engine.add_document(Document(document_id, text))
-print 'Done!'
-while True:
-    query = raw_input("Enter your query: ")
-    num_of_results = int(raw_input("How many results show be fetched? : "))
-    results = search_engine.free_text_query(query, num_of_results)
-    for num, result in enumerate(results):
-        print '{0}: {1}'.format(num+1, result)
 
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Simple-Search: an interactive search over the tweets dataset.')
+    parser.add_argument('--dataset', default=DATASET_FILE_NAME, help='the tweets CSV file')
+    parser.add_argument('--limit', type=int, default=1000,
+                        help='number of documents to load (default: %(default)s, 0 loads all documents)')
+    parser.add_argument('--offset', type=int, default=0, help='number of documents to skip first')
+    parser.add_argument('--index', help='a saved index file: opened if it exists, otherwise created after loading')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes to tokenize the documents with')
+    parser.add_argument('--serve', type=int, metavar='PORT', help='serve queries over HTTP on PORT instead')
+    parser.add_argument('--host', default='127.0.0.1', help='the address to serve on (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help='number of threads to score served queries with (default: %(default)s)')
+    return parser.parse_args()
 
+
+def load_search_engine(arguments):
+    if arguments.index and os.path.exists(arguments.index):
+        print 'Opening the saved index {}.'.format(arguments.index)
+        return IREngine.open(arguments.index)
+    search_engine = IREngine()
+    print 'Processing documents. This might take a while.'
+    start = time.time()
+    tweets = read_tweets(arguments.dataset, arguments.limit or None, arguments.offset)
+    if arguments.workers > 1:
+        num_of_docs = search_engine.add_documents(tweets, workers=arguments.workers)
+    else:
+        num_of_docs = index_documents(search_engine, tweets)
+    elapsed = time.time() - start
+    print 'Indexed {:,} documents in {:.1f}s ({:,.0f} docs/sec).'.format(num_of_docs, elapsed,
+                                                                        num_of_docs / elapsed if elapsed else 0)
+    if arguments.index:
+        search_engine.save(arguments.index)
+    return search_engine
+
+
+def main():
+    arguments = parse_arguments()
+    print 'Welcome to Simple-Search!'
+    search_engine = load_search_engine(arguments)
+    print 'Done!'
+    if arguments.serve is not None:
+        serve(search_engine, arguments.host, arguments.serve, threads=arguments.threads)
+        return
+    while True:
+        query = raw_input("Enter your query: ")
+        num_of_results = int(raw_input("How many results show be fetched? : "))
+        results = search_engine.free_text_query(query, num_of_results)
+        for num, result in enumerate(results):
+            print '{0}: {1}'.format(num+1, result)
+
+
+if __name__ == '__main__':
+    main()
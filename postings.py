@@ -0,0 +1,659 @@
+# Posting list storage for the inverted index.
+from array import array
+from bisect import bisect_left
+from collections import Mapping, namedtuple
+from itertools import chain, izip
+import sys
+import threading
+import time
+
+import numpy as np
+
+from cache_utils import TinyLFUCache
+
+MAX_TF = 0xFFFF  # The largest term frequency an array('H') can hold.
+BLOCK_SIZE = 128  # Postings per compressed block.
+
+
+def vbyte_encode(values):
+    """
+    Variable-byte encodes non-negative integers: 7 bits per byte, least significant group first, with the high
+    bit set on the last byte of every number. Small numbers (like the gaps between document numbers of a
+    frequent term) take a single byte.
+    :param values: A sequence of integers smaller than 2**35.
+    :return: The encoded bytes (string).
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    num_of_bytes = np.ones(len(values), dtype=np.int64)
+    for bits in (7, 14, 21, 28):
+        num_of_bytes += values >= (1 << bits)
+    starts = np.cumsum(num_of_bytes) - num_of_bytes
+    encoded = np.empty(num_of_bytes.sum(), dtype=np.uint8)
+    for group in xrange(5):
+        has_group = num_of_bytes > group
+        encoded[starts[has_group] + group] = (values[has_group] >> np.uint64(7 * group)) & np.uint64(0x7F)
+    encoded[starts + num_of_bytes - 1] |= 0x80
+    return encoded.tostring()
+
+
+def _lookup_sorted(doc_nums, tfs, probes):
+    """
+    :return: The term frequencies of the probed document numbers (0 where absent), by binary searching all the
+    (sorted) probes at once.
+    """
+    if not len(doc_nums):
+        return np.zeros(len(probes), dtype=np.uint16)
+    positions = np.minimum(np.searchsorted(doc_nums, probes), len(doc_nums) - 1)
+    return np.where(doc_nums[positions] == probes, tfs[positions], 0).astype(np.uint16)
+
+
+def vbyte_decode(data):
+    """
+    Decodes a string produced by vbyte_encode, all numbers at once.
+    :return: A NumPy array of the decoded integers.
+    """
+    encoded = np.frombuffer(data, dtype=np.uint8)
+    if not len(encoded):
+        return np.array([], dtype=np.uint64)
+    ends = np.flatnonzero(encoded & 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    shifts = (np.arange(len(encoded)) - np.repeat(starts, ends - starts + 1)) * 7
+    groups = (encoded & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(groups, starts)
+
+
+class PostingList(object):
+    """
+    The postings of a single term, stored as two parallel arrays:
+    doc_nums - the (internal) numbers of the documents containing the term, sorted in ascending order.
+    tfs - the frequency of the term in each of those documents.
+    A posting costs 6 bytes this way, compared to well over a hundred as an entry of a dictionary.
+    """
+    __slots__ = ('doc_nums', 'tfs')
+
+    def __init__(self, doc_nums=None, tfs=None):
+        self.doc_nums = doc_nums if doc_nums is not None else array('I')
+        self.tfs = tfs if tfs is not None else array('H')
+
+    @classmethod
+    def from_arrays(cls, doc_nums, tfs):
+        """
+        Builds a list out of sorted document numbers and their term frequencies (NumPy arrays).
+        """
+        return cls(array('I', np.asarray(doc_nums, dtype=np.uint32).tostring()),
+                   array('H', np.minimum(tfs, MAX_TF).astype(np.uint16).tostring()))
+
+    def add(self, doc_num, tf):
+        """
+        Appends a posting. Document numbers are handed out in increasing order, so appending keeps the list sorted.
+        :param doc_num: The document's number, which must be larger than all the document numbers in the list.
+        :param tf: The frequency of the term in the document (capped at MAX_TF).
+        """
+        self.doc_nums.append(doc_num)
+        self.tfs.append(min(tf, MAX_TF))
+
+    def extend(self, doc_nums, tfs):
+        """
+        Appends many postings at once (see add).
+        :param doc_nums: A sorted NumPy array of document numbers, all larger than those in the list.
+        :param tfs: A NumPy array of the matching term frequencies.
+        """
+        self.doc_nums.fromstring(np.asarray(doc_nums, dtype=np.uint32).tostring())
+        self.tfs.fromstring(np.minimum(tfs, MAX_TF).astype(np.uint16).tostring())
+
+    def tf(self, doc_num):
+        """
+        :return: The frequency of the term in the document, or 0 if the document does not contain the term.
+        """
+        position = bisect_left(self.doc_nums, doc_num)
+        if position < len(self.doc_nums) and self.doc_nums[position] == doc_num:
+            return self.tfs[position]
+        return 0
+
+    def arrays(self):
+        """
+        :return: NumPy views (no copy) of the document numbers and the term frequencies.
+        """
+        return np.frombuffer(self.doc_nums, dtype=np.uint32), np.frombuffer(self.tfs, dtype=np.uint16)
+
+    def block_arrays(self, block):
+        """
+        :return: NumPy views of the document numbers and term frequencies of the block'th run of BLOCK_SIZE postings,
+        the same runs a CompressedPostingList encodes as blocks.
+        """
+        doc_nums, tfs = self.arrays()
+        return doc_nums[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE], tfs[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE]
+
+    def lookup(self, doc_nums):
+        """
+        :param doc_nums: A sorted NumPy array of document numbers.
+        :return: A NumPy array of the frequency of the term in each of the documents, 0 where it does not appear.
+        """
+        return _lookup_sorted(np.frombuffer(self.doc_nums, dtype=np.uint32), np.frombuffer(self.tfs, dtype=np.uint16),
+                              doc_nums)
+
+    def __len__(self):
+        return len(self.doc_nums)
+
+    def __iter__(self):
+        return izip(self.doc_nums, self.tfs)
+
+
+class AppendablePostingList(object):
+    """
+    A posting list of the write buffer, which the writer appends to while queries read it, without locking.
+    The postings live in arrays with spare room. The writer only writes past the end of the postings, and then
+    publishes the new length together with the arrays, in a single assignment; when the arrays are full, it copies the
+    postings to bigger ones, and the old ones stay as they are for the queries that still read them. So a reader
+    never sees a half written posting.
+    The arrays are array.arrays, which are much cheaper than NumPy arrays to create and to set a posting in, and are
+    never resized in place (only replaced), so the NumPy views readers take of them stay valid.
+    Only one thread may append at a time.
+    """
+    __slots__ = ('_published',)
+
+    def __init__(self):
+        # (document numbers, term frequencies, number of postings). Most posting lists of the buffer stay short, so a
+        # new list starts with room for a few postings.
+        self._published = (array('I', [0]) * 4, array('H', [0]) * 4, 0)
+
+    def _room(self, num_of_postings):
+        """
+        :return: The arrays to append num_of_postings postings to, and the current number of postings.
+        """
+        doc_nums, tfs, length = self._published
+        if length + num_of_postings > len(doc_nums):
+            spare = max(num_of_postings, length)
+            doc_nums, tfs = doc_nums[:length], tfs[:length]
+            doc_nums.extend(array('I', [0]) * spare)
+            tfs.extend(array('H', [0]) * spare)
+        return doc_nums, tfs, length
+
+    def add(self, doc_num, tf):
+        """
+        Appends a posting (see PostingList.add).
+        """
+        doc_nums, tfs, length = self._published
+        if length == len(doc_nums):
+            doc_nums, tfs, length = self._room(1)
+        doc_nums[length] = doc_num
+        tfs[length] = min(tf, MAX_TF)
+        self._published = (doc_nums, tfs, length + 1)
+
+    def extend(self, doc_nums, tfs):
+        """
+        Appends many postings at once (see PostingList.extend).
+        """
+        storage_doc_nums, storage_tfs, length = self._room(len(doc_nums))
+        np.frombuffer(storage_doc_nums, dtype=np.uint32)[length:length + len(doc_nums)] = doc_nums
+        np.frombuffer(storage_tfs, dtype=np.uint16)[length:length + len(doc_nums)] = np.minimum(tfs, MAX_TF)
+        self._published = (storage_doc_nums, storage_tfs, length + len(doc_nums))
+
+    @property
+    def first_doc_num(self):
+        doc_nums, _, length = self._published
+        return doc_nums[0] if length else sys.maxsize
+
+    def snapshot(self, end_doc_num):
+        """
+        :return: A PostingList of NumPy views (no copy) of the postings of the documents numbered below end_doc_num.
+        """
+        doc_nums, tfs, length = self._published
+        doc_nums, tfs = np.frombuffer(doc_nums, dtype=np.uint32), np.frombuffer(tfs, dtype=np.uint16)
+        if length and doc_nums[length - 1] >= end_doc_num:
+            length = int(np.searchsorted(doc_nums[:length], end_doc_num))
+        return PostingList(doc_nums[:length], tfs[:length])
+
+    def arrays(self):
+        doc_nums, tfs, length = self._published
+        return np.frombuffer(doc_nums, dtype=np.uint32)[:length], np.frombuffer(tfs, dtype=np.uint16)[:length]
+
+    def copy(self):
+        """
+        :return: A PostingList of a copy of the postings.
+        """
+        doc_nums, tfs, length = self._published
+        return PostingList(doc_nums[:length], tfs[:length])
+
+    def __len__(self):
+        return self._published[2]
+
+
+class CompressedPostingList(object):
+    """
+    A posting list compressed with delta + variable-byte encoding.
+    The postings are cut into blocks of BLOCK_SIZE. Every block is encoded as the gaps between consecutive document
+    numbers followed by the term frequencies; the first gap of a block is relative to the last document number of
+    the previous block, so the whole list decodes with one cumulative sum.
+    For every block a skip header is kept: the last document number in it and the offset of its bytes. Looking up
+    a single document only decodes the block that may contain it.
+    Postings are appended to an uncompressed tail, which is encoded as a block whenever it fills up. A sealed list
+    (see seal) has no tail, and its last block may be short; appending to it decodes that block back into the tail.
+    The encoded bytes may be any read-only buffer (like a slice of a memory-mapped index file), and are only copied
+    when postings are appended to them.
+    """
+    __slots__ = ('_data', '_block_last_doc_nums', '_block_offsets', '_encoded_length', '_tail_doc_nums', '_tail_tfs')
+
+    def __init__(self, data=None, block_last_doc_nums=None, block_offsets=None, encoded_length=0):
+        self._data = data if data is not None else bytearray()
+        self._block_last_doc_nums = block_last_doc_nums if block_last_doc_nums is not None else array('I')
+        self._block_offsets = block_offsets if block_offsets is not None else array('I')
+        self._encoded_length = encoded_length
+        self._tail_doc_nums = array('I')
+        self._tail_tfs = array('H')
+
+    @classmethod
+    def from_arrays(cls, doc_nums, tfs):
+        """
+        Builds a sealed list out of sorted document numbers and their term frequencies.
+        """
+        doc_nums = np.asarray(doc_nums, dtype=np.uint32)
+        tfs = np.asarray(tfs, dtype=np.uint16)
+        posting_list = cls()
+        for start in xrange(0, len(doc_nums), BLOCK_SIZE):
+            posting_list._tail_doc_nums = array('I', doc_nums[start:start + BLOCK_SIZE].tostring())
+            posting_list._tail_tfs = array('H', tfs[start:start + BLOCK_SIZE].tostring())
+            posting_list._encode_tail()
+        return posting_list
+
+    def add(self, doc_num, tf):
+        """
+        Appends a posting (see PostingList.add).
+        """
+        if not self._tail_doc_nums and self._encoded_length % BLOCK_SIZE:
+            self._reopen_last_block()
+        self._tail_doc_nums.append(doc_num)
+        self._tail_tfs.append(min(tf, MAX_TF))
+        if len(self._tail_doc_nums) == BLOCK_SIZE:
+            self._encode_tail()
+
+    def extend(self, doc_nums, tfs):
+        """
+        Appends many postings at once (see PostingList.extend), a block at a time.
+        """
+        doc_nums = np.asarray(doc_nums, dtype=np.uint32)
+        tfs = np.minimum(tfs, MAX_TF).astype(np.uint16)
+        if len(doc_nums) and not self._tail_doc_nums and self._encoded_length % BLOCK_SIZE:
+            self._reopen_last_block()
+        start = 0
+        while start < len(doc_nums):
+            end = start + BLOCK_SIZE - len(self._tail_doc_nums)
+            self._tail_doc_nums.fromstring(doc_nums[start:end].tostring())
+            self._tail_tfs.fromstring(tfs[start:end].tostring())
+            start = end
+            if len(self._tail_doc_nums) == BLOCK_SIZE:
+                self._encode_tail()
+
+    def seal(self):
+        """
+        Encodes the tail as a (possibly short) last block, so that all the postings are compressed.
+        """
+        if self._tail_doc_nums:
+            self._encode_tail()
+
+    def parts(self):
+        """
+        :return: What a sealed list is made of, to be stored and passed back to the constructor:
+        (encoded bytes, skip header last document numbers, skip header offsets, number of postings).
+        """
+        self.seal()
+        return self._data, self._block_last_doc_nums, self._block_offsets, self._encoded_length
+
+    def _encode_tail(self):
+        if not isinstance(self._data, bytearray):
+            self._data = bytearray(self._data)
+        doc_nums = np.frombuffer(self._tail_doc_nums, dtype=np.uint32).astype(np.int64)
+        previous = self._block_last_doc_nums[-1] if self._block_last_doc_nums else 0
+        gaps = np.diff(doc_nums, prepend=previous)
+        self._block_offsets.append(len(self._data))
+        self._block_last_doc_nums.append(self._tail_doc_nums[-1])
+        self._data += vbyte_encode(np.concatenate((gaps, np.frombuffer(self._tail_tfs, dtype=np.uint16))))
+        self._encoded_length += len(self._tail_doc_nums)
+        self._tail_doc_nums = array('I')
+        self._tail_tfs = array('H')
+
+    def _reopen_last_block(self):
+        # Keeps every encoded block but the last one full, which is what arrays() relies on.
+        block = len(self._block_offsets) - 1
+        doc_nums, tfs = self.block_arrays(block)
+        self._data = bytearray(self._data[:self._block_offsets[block]])
+        self._block_offsets.pop()
+        self._block_last_doc_nums.pop()
+        self._encoded_length -= len(doc_nums)
+        self._tail_doc_nums = array('I', doc_nums.tostring())
+        self._tail_tfs = array('H', tfs.tostring())
+
+    def arrays(self):
+        """
+        Decodes the whole list.
+        :return: NumPy arrays of the document numbers and the term frequencies.
+        """
+        tail_doc_nums = np.frombuffer(self._tail_doc_nums, dtype=np.uint32)
+        tail_tfs = np.frombuffer(self._tail_tfs, dtype=np.uint16)
+        if not self._encoded_length:
+            return tail_doc_nums, tail_tfs
+        values = vbyte_decode(self._data)
+        full_blocks, last_block_length = divmod(self._encoded_length, BLOCK_SIZE)
+        blocks = values[:full_blocks * 2 * BLOCK_SIZE].reshape(-1, 2, BLOCK_SIZE)
+        last_block = values[full_blocks * 2 * BLOCK_SIZE:]
+        gaps = np.concatenate((blocks[:, 0, :].ravel(), last_block[:last_block_length]))
+        tfs = np.concatenate((blocks[:, 1, :].ravel(), last_block[last_block_length:]))
+        return (np.concatenate((np.cumsum(gaps).astype(np.uint32), tail_doc_nums)),
+                np.concatenate((tfs.astype(np.uint16), tail_tfs)))
+
+    def block_arrays(self, block):
+        """
+        Decodes a single block, using its skip header.
+        :param block: The block's index. The uncompressed tail is the block after the last encoded one.
+        :return: NumPy arrays of the block's document numbers and term frequencies.
+        """
+        if block == len(self._block_offsets):
+            return (np.frombuffer(self._tail_doc_nums, dtype=np.uint32),
+                    np.frombuffer(self._tail_tfs, dtype=np.uint16))
+        start = self._block_offsets[block]
+        end = self._block_offsets[block + 1] if block + 1 < len(self._block_offsets) else len(self._data)
+        gaps, tfs = vbyte_decode(self._data[start:end]).reshape(2, -1)
+        gaps[0] += self._block_last_doc_nums[block - 1] if block else 0
+        return np.cumsum(gaps).astype(np.uint32), tfs.astype(np.uint16)
+
+    def find_block(self, doc_num):
+        """
+        :return: The index of the only block that may contain the document, according to the skip headers.
+        """
+        return bisect_left(self._block_last_doc_nums, doc_num)
+
+    def tf(self, doc_num):
+        """
+        :return: The frequency of the term in the document, or 0 if the document does not contain the term.
+        """
+        doc_nums, tfs = self.block_arrays(self.find_block(doc_num))
+        position = np.searchsorted(doc_nums, doc_num)
+        if position < len(doc_nums) and doc_nums[position] == doc_num:
+            return int(tfs[position])
+        return 0
+
+    def lookup(self, doc_nums):
+        """
+        Looks up many documents at once (see PostingList.lookup). The skip headers route every document to the one
+        block that may contain it, and blocks that no document falls in are never decoded.
+        """
+        tfs = np.zeros(len(doc_nums), dtype=np.uint16)
+        if not len(doc_nums):
+            return tfs
+        blocks = np.searchsorted(np.frombuffer(self._block_last_doc_nums, dtype=np.uint32), doc_nums)
+        # doc_nums is sorted, so the documents of every block are a contiguous run.
+        boundaries = np.concatenate(([0], np.flatnonzero(np.diff(blocks)) + 1, [len(doc_nums)]))
+        if 4 * (len(boundaries) - 1) > len(self._block_offsets):
+            # Most blocks are needed anyway, and decoding the whole list at once is much faster than block by block.
+            return _lookup_sorted(*(self.arrays() + (doc_nums,)))
+        for start, end in izip(boundaries[:-1].tolist(), boundaries[1:].tolist()):
+            block_doc_nums, block_tfs = self.block_arrays(int(blocks[start]))
+            tfs[start:end] = _lookup_sorted(block_doc_nums, block_tfs, doc_nums[start:end])
+        return tfs
+
+    def compressed_size(self):
+        """
+        :return: The number of bytes the postings take, counting the skip headers and the uncompressed tail.
+        """
+        return (len(self._data) + 4 * (len(self._block_offsets) + len(self._block_last_doc_nums)) +
+                6 * len(self._tail_doc_nums))
+
+    def __len__(self):
+        return self._encoded_length + len(self._tail_doc_nums)
+
+    def __iter__(self):
+        doc_nums, tfs = self.arrays()
+        return izip(doc_nums.tolist(), tfs.tolist())
+
+
+POSTING_CODECS = {'raw': PostingList, 'vbyte': CompressedPostingList}
+
+
+DecodedPostingsCacheInfo = namedtuple('DecodedPostingsCacheInfo', ['hits', 'misses', 'evictions', 'rejections',
+                                                                   'maxbytes', 'currbytes', 'decode_seconds',
+                                                                   'saved_seconds'])
+
+
+def _decoded_size(key, entry):
+    # 6 bytes per posting, and roughly the overhead of the PostingList, its arrays and the cache entry.
+    return 6 * len(entry[0]) + 400
+
+
+class DecodedPostingsCache(object):
+    """
+    Keeps the decoded postings of the compressed posting lists of sealed segments, so that the lists of hot terms are
+    not decoded again by every query. Sealed segments never change, so an entry never goes stale; the entries of
+    segments that were merged away are discarded (see discard_segments).
+    Eviction is TinyLFU (see cache_utils.TinyLFUCache) within a budget of bytes: a list is only admitted if its term
+    is asked for more often than the lists it would evict, so rare terms don't push out the hot ones.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, maxbytes, min_length=BLOCK_SIZE):
+        """
+        :param maxbytes: The budget of the decoded postings, in bytes (6 per posting).
+        :param min_length: Lists shorter than this are a single block, which decodes about as fast as it is looked up,
+        so they are not cached.
+        """
+        self._cache = TinyLFUCache(sys.maxsize, maxbytes, _decoded_size, sketch_width=max(1024, maxbytes // 4096))
+        self._min_length = min_length
+        self._lock = threading.Lock()
+        self.decode_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    def posting_list(self, segment, term):
+        """
+        :return: The term's posting list in the segment, decoded into a PostingList if it is compressed, or None.
+        """
+        posting_list = segment.posting_list(term)
+        if not isinstance(posting_list, CompressedPostingList) or len(posting_list) < self._min_length:
+            return posting_list
+        key = (segment, term)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self.saved_seconds += entry[1]
+                return entry[0]
+        start = time.time()
+        decoded = PostingList.from_arrays(*posting_list.arrays())
+        decode_seconds = time.time() - start
+        with self._lock:
+            self.decode_seconds += decode_seconds
+            self._cache.put(key, (decoded, decode_seconds))
+        return decoded
+
+    def discard_segments(self, segments):
+        """
+        Drops the posting lists of segments that are no longer searched.
+        """
+        segments = set(segments)
+        with self._lock:
+            for key in self._cache.keys():
+                if key[0] in segments:
+                    self._cache.discard(key)
+
+    def info(self):
+        """
+        :return: A DecodedPostingsCacheInfo tuple. decode_seconds is the time spent decoding lists that were not
+        cached, and saved_seconds the time it took to decode the lists that were served from the cache.
+        """
+        with self._lock:
+            info = self._cache.info()
+            return DecodedPostingsCacheInfo(info.hits, info.misses, info.evictions, info.rejections, info.maxbytes,
+                                            info.currbytes, self.decode_seconds, self.saved_seconds)
+
+
+def match_postings(posting_lists, minimum_should_match):
+    """
+    Finds the documents that appear in at least `minimum_should_match` of the posting lists.
+    Every such document appears in at least one of the len(posting_lists) - minimum_should_match + 1 shortest lists,
+    so only those are merged into the candidates. Then the other lists are probed with the candidates, from the
+    shortest up, and a candidate is dropped as soon as the remaining lists can no longer get it to the minimum.
+    When all the lists must match, this is an intersection starting from the rarest term, and the candidates only
+    shrink as it goes.
+    :param posting_lists: A list of posting lists, with None for a term that has no postings.
+    :param minimum_should_match: How many of the lists a document must appear in, at least 1.
+    :return: A sorted NumPy array of document numbers.
+    """
+    present = sorted((posting_list for posting_list in posting_lists if posting_list is not None), key=len)
+    num_of_seeds = len(present) - minimum_should_match + 1
+    if num_of_seeds <= 0:
+        return np.array([], dtype=np.uint32)
+    seeds = [posting_list.arrays()[0] for posting_list in present[:num_of_seeds]]
+    if len(seeds) == 1:
+        candidates, matches = seeds[0], np.ones(len(seeds[0]), dtype=np.int32)
+    else:
+        candidates, matches = np.unique(np.concatenate(seeds), return_counts=True)
+    remaining = len(present) - num_of_seeds
+    for posting_list in present[num_of_seeds:]:
+        remaining -= 1
+        matches = matches + (posting_list.lookup(candidates) > 0)
+        reachable = matches + remaining >= minimum_should_match
+        candidates, matches = candidates[reachable], matches[reachable]
+        if not len(candidates):
+            break
+    return candidates[matches >= minimum_should_match]
+
+
+class MultiPostingList(object):
+    """
+    The postings of a term in several segments, seen as a single posting list. Segments cover disjoint, increasing
+    ranges of document numbers, so the parts are simply concatenated.
+    """
+    __slots__ = ('_parts',)
+
+    def __init__(self, parts):
+        self._parts = parts
+
+    def arrays(self):
+        if len(self._parts) == 1:
+            return self._parts[0].arrays()
+        doc_nums, tfs = zip(*[part.arrays() for part in self._parts])
+        return np.concatenate(doc_nums), np.concatenate(tfs)
+
+    def tf(self, doc_num):
+        for part in self._parts:
+            tf = part.tf(doc_num)
+            if tf:
+                return tf
+        return 0
+
+    def __len__(self):
+        return sum(len(part) for part in self._parts)
+
+    def __iter__(self):
+        return chain.from_iterable(self._parts)
+
+
+class Bitset(object):
+    """
+    A set of document numbers, one bit per document. Used to mark deleted documents.
+    The bits live in a NumPy array that is replaced, never resized, when it grows, so arrays handed out by
+    contains() stay valid.
+    """
+    __slots__ = ('_bits', '_count')
+
+    def __init__(self):
+        self._bits = np.zeros(0, dtype=np.uint8)
+        self._count = 0
+
+    def add(self, value):
+        """
+        :return: True if the value was not in the set before.
+        """
+        byte, mask = value >> 3, 0x80 >> (value & 7)
+        if byte >= len(self._bits):
+            bits = np.zeros(max(byte + 1, 2 * len(self._bits)), dtype=np.uint8)
+            bits[:len(self._bits)] = self._bits
+            self._bits = bits
+        if self._bits[byte] & mask:
+            return False
+        self._bits[byte] |= mask
+        self._count += 1
+        return True
+
+    def contains(self, values):
+        """
+        :param values: A NumPy array of document numbers.
+        :return: A boolean NumPy array, True where the document number is in the set.
+        """
+        result = np.zeros(len(values), dtype=bool)
+        if self._count:
+            bits = self._bits
+            inside = values < 8 * len(bits)
+            inside_values = values[inside]
+            result[inside] = bits[inside_values >> 3] & (0x80 >> (inside_values & 7)) != 0
+        return result
+
+    def __contains__(self, value):
+        byte = value >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] & (0x80 >> (value & 7)))
+
+    def __len__(self):
+        return self._count
+
+    def copy(self):
+        bitset = Bitset()
+        bitset._bits = self._bits.copy()
+        bitset._count = self._count
+        return bitset
+
+
+class PostingsView(Mapping):
+    """
+    A read-only {doc_id: tf} view of a PostingList, for code written against the old dictionary based index.
+    Postings of deleted documents are left out.
+    """
+
+    def __init__(self, posting_list, doc_ids, doc_nums, deleted=None):
+        self._posting_list = posting_list
+        self._doc_ids = doc_ids
+        self._doc_nums = doc_nums
+        self._deleted = deleted
+
+    def __getitem__(self, doc_id):
+        tf = self._posting_list.tf(self._doc_nums[doc_id])
+        if not tf:
+            raise KeyError(doc_id)
+        return tf
+
+    def __iter__(self):
+        return (doc_id for doc_id, _ in self.iteritems())
+
+    def __len__(self):
+        if not self._deleted:
+            return len(self._posting_list)
+        return len(self._posting_list) - int(self._deleted.contains(self._posting_list.arrays()[0]).sum())
+
+    def iteritems(self):
+        doc_ids = self._doc_ids
+        if not self._deleted:
+            return ((doc_ids[doc_num], tf) for doc_num, tf in self._posting_list)
+        deleted = self._deleted
+        return ((doc_ids[doc_num], tf) for doc_num, tf in self._posting_list if doc_num not in deleted)
+
+
+class InvertedIndexView(Mapping):
+    """
+    A read-only {term: {doc_id: tf}} view of the engine's posting lists.
+    """
+
+    def __init__(self, postings, doc_ids, doc_nums, deleted=None):
+        self._postings = postings
+        self._doc_ids = doc_ids
+        self._doc_nums = doc_nums
+        self._deleted = deleted
+
+    def __getitem__(self, term):
+        return PostingsView(self._postings[term], self._doc_ids, self._doc_nums, self._deleted)
+
+    def __contains__(self, term):
+        return term in self._postings
+
+    def __iter__(self):
+        return iter(self._postings)
+
+    def __len__(self):
+        return len(self._postings)
@@ -0,0 +1,156 @@
+# Dynamic pruning for top-k retrieval: WAND and Block-Max WAND over posting list cursors.
+# Both need a ranking that is a sum of per-term scores, each with a known upper bound.
+from bisect import bisect_left
+from heapq import heappush, heapreplace
+from operator import attrgetter
+
+import numpy as np
+
+from postings import BLOCK_SIZE
+
+END = 1 << 32  # Past the last document number; where a cursor ends up when its postings run out.
+
+# Upper bounds and scores are computed with different floating point operations, so they may disagree in the last
+# bits. A document is only skipped when its bound is below the threshold by more than this.
+TOLERANCE = 1e-9
+
+
+def score_bounds(doc_nums, normalized_weights):
+    """
+    Computes the upper bounds WAND needs for a posting list.
+    :param doc_nums: The posting list's document numbers.
+    :param normalized_weights: The score of each posting, without the query's weight of the term.
+    :return: (the maximum of the weights, the last document number of every block of BLOCK_SIZE postings, the
+    maximum of the weights in every block), the last two as lists.
+    """
+    starts = np.arange(0, len(doc_nums), BLOCK_SIZE)
+    block_last_doc_nums = doc_nums[np.minimum(starts + BLOCK_SIZE, len(doc_nums)) - 1]
+    block_maxima = np.maximum.reduceat(normalized_weights, starts)
+    return float(block_maxima.max()), block_last_doc_nums.tolist(), block_maxima.tolist()
+
+
+class PostingCursor(object):
+    """
+    A position in a posting list, which only moves forward. It moves block by block (see
+    CompressedPostingList.block_arrays), and only decodes the blocks it lands in: the block bounds tell it where every
+    block ends without decoding it.
+    """
+    __slots__ = ('weight', 'max_score', 'doc_num', '_posting_list', '_block_last_doc_nums', '_block_maxima', '_block',
+                 '_doc_nums', '_tfs', '_position')
+
+    def __init__(self, posting_list, weight, bounds):
+        """
+        :param posting_list: A PostingList or a CompressedPostingList.
+        :param weight: The query's weight of the term. A posting's score is its normalized weight times this.
+        :param bounds: The posting list's score_bounds.
+        """
+        max_weight, self._block_last_doc_nums, self._block_maxima = bounds
+        self.weight = weight
+        self.max_score = weight * max_weight
+        self._posting_list = posting_list
+        self._load_block(0)
+
+    def _load_block(self, block):
+        self._block = block
+        if block == len(self._block_last_doc_nums):
+            self.doc_num = END
+            return
+        doc_nums, tfs = self._posting_list.block_arrays(block)
+        self._doc_nums = doc_nums.tolist()
+        self._tfs = tfs.tolist()
+        self._position = 0
+        self.doc_num = self._doc_nums[0]
+
+    def tf(self):
+        return self._tfs[self._position]
+
+    def advance(self, target):
+        """
+        Moves to the first posting whose document number is at least target.
+        """
+        if target <= self.doc_num:
+            return
+        if target > self._block_last_doc_nums[self._block]:
+            self._load_block(bisect_left(self._block_last_doc_nums, target, self._block + 1))
+            if self.doc_num == END:
+                return
+        self._position = bisect_left(self._doc_nums, target, self._position)
+        self.doc_num = self._doc_nums[self._position]
+
+    def block_bound(self, doc_num):
+        """
+        :return: The upper bound of the score of any posting in the block that may contain the document, and the
+        last document number of that block. Nothing is decoded.
+        """
+        block = bisect_left(self._block_last_doc_nums, doc_num, self._block)
+        if block == len(self._block_last_doc_nums):
+            return 0.0, END
+        return self.weight * self._block_maxima[block], self._block_last_doc_nums[block]
+
+
+def wand(cursors, num_of_results, score, heap, block_max=False):
+    """
+    Finds the documents that may make the top results, skipping the ones that provably can not.
+    The cursors are kept sorted by document number. Summing their maximum scores in that order, the pivot is the
+    first cursor at which the sum reaches the threshold (the lowest score in the heap of the best scores so far);
+    no document before the pivot's document can reach it, so the cursors before the pivot jump straight to it.
+    With block_max, the pivot document is checked once more against the maxima of the blocks it falls in, which are
+    much tighter than the maxima of whole lists; if it fails, all the cursors jump past the end of the first block.
+    :param cursors: A list of PostingCursors, one per query term.
+    :param num_of_results: The k of the top-k.
+    :param score: A function (document number, [(weight, tf) of the terms the document has]) -> score, or None for
+    a document that should be skipped (a deleted one).
+    :param heap: A min-heap of the best scores found so far, shared by the calls for every segment of the query.
+    :param block_max: Whether to use Block-Max WAND.
+    :return: A list of (document number, score) of every document that was scored, in document number order.
+    """
+    cursors = [cursor for cursor in cursors if cursor.doc_num != END]
+    doc_num_of = attrgetter('doc_num')
+    scored = []
+    while cursors:
+        cursors.sort(key=doc_num_of)
+        threshold = heap[0] - TOLERANCE if len(heap) == num_of_results else float('-inf')
+        bound = 0.0
+        for pivot, cursor in enumerate(cursors):
+            bound += cursor.max_score
+            if bound >= threshold:
+                break
+        else:
+            break
+        pivot_doc_num = cursors[pivot].doc_num
+        last = pivot
+        while last + 1 < len(cursors) and cursors[last + 1].doc_num == pivot_doc_num:
+            last += 1
+
+        if block_max:
+            bound, block_end = 0.0, END
+            for cursor in cursors[:last + 1]:
+                block_score, block_last_doc_num = cursor.block_bound(pivot_doc_num)
+                bound += block_score
+                block_end = min(block_end, block_last_doc_num)
+            if bound < threshold:
+                # No document up to the end of the shortest of these blocks can make it, unless it has a term of
+                # a later cursor.
+                target = block_end + 1
+                if last + 1 < len(cursors):
+                    target = min(target, cursors[last + 1].doc_num)
+                for cursor in cursors[:last + 1]:
+                    cursor.advance(target)
+                cursors = [cursor for cursor in cursors if cursor.doc_num != END]
+                continue
+
+        if cursors[0].doc_num == pivot_doc_num:
+            document_score = score(pivot_doc_num, [(cursor.weight, cursor.tf()) for cursor in cursors[:last + 1]])
+            if document_score is not None:
+                scored.append((pivot_doc_num, document_score))
+                if len(heap) < num_of_results:
+                    heappush(heap, document_score)
+                elif document_score > heap[0]:
+                    heapreplace(heap, document_score)
+            for cursor in cursors[:last + 1]:
+                cursor.advance(pivot_doc_num + 1)
+        else:
+            for cursor in cursors[:pivot]:
+                cursor.advance(pivot_doc_num)
+        cursors = [cursor for cursor in cursors if cursor.doc_num != END]
+    return scored
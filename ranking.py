@@ -0,0 +1,88 @@
+# Pluggable ranking functions.
+# The cosine rankings ('cosine' and 'full_cosine') are built into the engine. The ranking functions here score a
+# document as a sum over the query terms of (query weight of the term) * (score of the term in the document),
+# which lets every scoring strategy use them - term at a time accumulators and WAND included.
+import numpy as np
+
+
+class Ranking(object):
+    """
+    The interface of an additive ranking function. A document's score is the sum, over the unique query terms, of
+        multiplicity in the query * idf(term) * term_scores(tf, statistic of the document)
+    The per-document statistics (like BM25's length normalization) are computed once for the whole index by
+    document_statistics, and recomputed only when documents are added or deleted, so scoring a posting costs a
+    handful of arithmetic operations.
+    term_scores only uses arithmetic operators, so it works on NumPy arrays and on plain numbers alike.
+    """
+
+    def idf(self, document_frequency, num_of_docs):
+        """
+        :param document_frequency: The number of documents that have the term.
+        :param num_of_docs: The number of documents in the index.
+        :return: The weight of the term.
+        """
+        raise NotImplementedError
+
+    def document_statistics(self, doc_lengths, average_length):
+        """
+        :param doc_lengths: A float NumPy array of the documents' lengths, by document number.
+        :param average_length: The average length of the (not deleted) documents.
+        :return: A NumPy array of the per-document value term_scores takes, by document number.
+        """
+        return doc_lengths
+
+    def term_scores(self, tfs, document_statistics):
+        """
+        :param tfs: Term frequencies.
+        :param document_statistics: The matching documents' statistics (see document_statistics).
+        :return: The score of the term in each of the documents. A tf of 0 must score 0.
+        """
+        raise NotImplementedError
+
+
+class BM25(Ranking):
+    """
+    Okapi BM25. A term's score saturates as its frequency grows, and is discounted in documents longer than
+    average:
+        idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average length))
+    The denominator's length part is the per-document statistic. The IDF is Lucene's, which is never negative.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+
+    def idf(self, document_frequency, num_of_docs):
+        return np.log(1.0 + (num_of_docs - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def document_statistics(self, doc_lengths, average_length):
+        return self.k1 * (1.0 - self.b + self.b * doc_lengths / average_length)
+
+    def term_scores(self, tfs, document_statistics):
+        return tfs * (self.k1 + 1.0) / (tfs + document_statistics)
+
+    def __repr__(self):
+        return '{}(k1={}, b={})'.format(type(self).__name__, self.k1, self.b)
+
+
+class BM25Plus(BM25):
+    """
+    BM25+ (Lv and Zhai, 2011). BM25 punishes long documents so much that a long document that has a term can score
+    lower than a short one that does not; BM25+ adds delta to the score of every term a document has.
+    """
+
+    def __init__(self, k1=1.2, b=0.75, delta=1.0):
+        super(BM25Plus, self).__init__(k1, b)
+        self.delta = delta
+
+    def idf(self, document_frequency, num_of_docs):
+        return np.log((num_of_docs + 1.0) / max(document_frequency, 1))
+
+    def term_scores(self, tfs, document_statistics):
+        return tfs * (self.k1 + 1.0) / (tfs + document_statistics) + self.delta * (tfs > 0)
+
+    def __repr__(self):
+        return '{}(k1={}, b={}, delta={})'.format(type(self).__name__, self.k1, self.b, self.delta)
+
+
+RANKING_FUNCTIONS = {'bm25': BM25(), 'bm25+': BM25Plus()}
@@ -0,0 +1,430 @@
+# Index segments: the on-disk segment format, the in-memory segment types and the merge policy.
+# An index is saved as a single segment file, which is memory-mapped when it is opened.
+import mmap
+import os
+import struct
+from math import log
+from array import array
+from collections import Mapping, MutableMapping
+from itertools import chain, count, izip
+
+import numpy as np
+
+from document import Document
+from postings import AppendablePostingList, CompressedPostingList, MultiPostingList, PostingList
+
+MAGIC = 'IRENGINE'
+FORMAT_VERSION = 1
+
+# The sections of a segment file, in the order they appear in the header's section table.
+SECTIONS = ('terms', 'term_entries', 'postings', 'doc_lengths', 'doc_ids', 'text_offsets', 'texts')
+# magic, format version, number of documents, number of terms, then an (offset, length) pair per section.
+HEADER = struct.Struct('<8sIII' + 'QQ' * len(SECTIONS))
+
+# For every term (in the same order as the terms section): where its postings start in the file, the length of
+# the encoded bytes, the number of blocks and the number of postings. The postings of a term are its skip headers
+# (the last document number of every block, then the offset of every block) followed by the encoded bytes.
+TERM_ENTRY = np.dtype([('offset', '<u8'), ('length', '<u8'), ('blocks', '<u4'), ('df', '<u4')])
+
+_SEPARATOR = '\0'
+
+
+def _to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else str(value)
+
+
+def write_segment(path, postings, doc_ids, doc_lengths, texts):
+    """
+    Writes a segment file. The file is written next to its destination and renamed over it when complete, so a
+    crash never leaves a half-written index behind.
+    Document ids and texts are stored as (utf-8) byte strings.
+    :param path: Where to write the segment.
+    :param postings: An iterable of (term, (document numbers, term frequencies)) tuples of NumPy arrays, sorted by
+    term.
+    :param doc_ids: The document ids, by document number. They must be byte strings, since they are read back as byte
+    strings.
+    :param doc_lengths: An array('I') of the documents' lengths, by document number.
+    :param texts: An iterable of the documents' texts, by document number.
+    """
+    for doc_id in doc_ids:
+        if not isinstance(doc_id, str):
+            # It would be read back as a byte string (a unicode id as its utf-8 encoding), and the document could no
+            # longer be found by its id.
+            raise ValueError('Only documents with byte string ids can be saved, got the id {!r}'.format(doc_id))
+    temporary_path = path + '.tmp'
+    sections = {}
+    with open(temporary_path, 'wb') as segment_file:
+        segment_file.write('\0' * HEADER.size)
+
+        def write_section(name, data):
+            sections[name] = (segment_file.tell(), len(data))
+            segment_file.write(data)
+
+        terms = []
+        entries = []
+        postings_start = segment_file.tell()
+        for term, (doc_nums, tfs) in postings:
+            data, block_last_doc_nums, block_offsets, length = CompressedPostingList.from_arrays(doc_nums, tfs).parts()
+            terms.append(_to_bytes(term))
+            entries.append((segment_file.tell(), len(data), len(block_offsets), length))
+            segment_file.write(block_last_doc_nums.tostring())
+            segment_file.write(block_offsets.tostring())
+            segment_file.write(data)
+        sections['postings'] = (postings_start, segment_file.tell() - postings_start)
+        write_section('terms', _SEPARATOR.join(terms))
+        write_section('term_entries', np.array(entries, dtype=TERM_ENTRY).tostring())
+        write_section('doc_lengths', np.asarray(doc_lengths, dtype='<u4').tostring())
+        write_section('doc_ids', _SEPARATOR.join(_to_bytes(doc_id) for doc_id in doc_ids))
+
+        texts_start = segment_file.tell()
+        text_offsets = array('L', [0])
+        for text in texts:
+            segment_file.write(_to_bytes(text))
+            text_offsets.append(segment_file.tell() - texts_start)
+        sections['texts'] = (texts_start, text_offsets[-1])
+        write_section('text_offsets', np.asarray(text_offsets, dtype='<u8').tostring())
+
+        segment_file.seek(0)
+        section_table = [value for name in SECTIONS for value in sections[name]]
+        segment_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(doc_ids), len(terms), *section_table))
+    os.rename(temporary_path, path)
+
+
+class SegmentReader(object):
+    """
+    Reads a segment file through a read-only memory map, so opening it costs next to nothing: the operating system
+    pages the postings and the texts in lazily, when they are first read.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as segment_file:
+            self._mmap = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < HEADER.size:
+            raise ValueError('{} is not an IR-Engine index'.format(path))
+        header = HEADER.unpack_from(self._mmap)
+        magic, version, self.num_of_docs, self.num_of_terms = header[:4]
+        if magic != MAGIC:
+            raise ValueError('{} is not an IR-Engine index'.format(path))
+        if version != FORMAT_VERSION:
+            raise ValueError('{} has index format version {}, expected {}'.format(path, version, FORMAT_VERSION))
+        self._sections = dict(izip(SECTIONS, izip(header[4::2], header[5::2])))
+        self._term_entries = np.frombuffer(self._mmap, dtype=TERM_ENTRY, count=self.num_of_terms,
+                                           offset=self._sections['term_entries'][0])
+        self._text_offsets = np.frombuffer(self._mmap, dtype='<u8', count=self.num_of_docs + 1,
+                                           offset=self._sections['text_offsets'][0])
+
+    def _section(self, name):
+        offset, length = self._sections[name]
+        return self._mmap[offset:offset + length]
+
+    def terms(self):
+        """
+        :return: A list of the segment's terms, in sorted order.
+        """
+        return self._section('terms').split(_SEPARATOR) if self.num_of_terms else []
+
+    def document_frequencies(self):
+        """
+        :return: A NumPy array of the terms' document frequencies, in the order of terms().
+        """
+        return self._term_entries['df']
+
+    def doc_ids(self):
+        """
+        :return: A list of the document ids, by document number.
+        """
+        return self._section('doc_ids').split(_SEPARATOR) if self.num_of_docs else []
+
+    def doc_lengths(self):
+        """
+        :return: An array('I') of the documents' lengths, by document number.
+        """
+        return array('I', self._section('doc_lengths'))
+
+    def posting_list(self, term_number):
+        """
+        :param term_number: The position of the term in terms().
+        :return: The term's CompressedPostingList, whose encoded bytes are left in the memory map.
+        """
+        offset, length, blocks, df = self._term_entries[term_number].tolist()
+        block_last_doc_nums = array('I', self._mmap[offset:offset + 4 * blocks])
+        block_offsets = array('I', self._mmap[offset + 4 * blocks:offset + 8 * blocks])
+        data = buffer(self._mmap, offset + 8 * blocks, length)
+        return CompressedPostingList(data, block_last_doc_nums, block_offsets, df)
+
+    def text(self, doc_num):
+        start, end = self._text_offsets[doc_num:doc_num + 2].tolist()
+        texts_start = self._sections['texts'][0]
+        return self._mmap[texts_start + start:texts_start + end]
+
+
+class MemorySegment(object):
+    """
+    A sealed segment: the immutable postings of a contiguous range of document numbers.
+    Every segment type has the same interface: first_doc_num, num_of_docs, posting_list(term), terms() and `in`.
+    Posting lists hold global document numbers, so the postings of adjacent segments can simply be concatenated.
+    """
+
+    def __init__(self, first_doc_num, num_of_docs, postings):
+        self.first_doc_num = first_doc_num
+        self.num_of_docs = num_of_docs
+        self._postings = postings
+
+    def posting_list(self, term):
+        """
+        :return: The term's posting list, or None if no document in the segment has the term.
+        """
+        return self._postings.get(term)
+
+    def terms(self):
+        return self._postings.iterkeys()
+
+    def __contains__(self, term):
+        return term in self._postings
+
+
+class MappedSegment(object):
+    """
+    A sealed segment read from a segment file (see SegmentReader). A posting list is only built (without decoding
+    it) the first time its term is looked up.
+    """
+
+    def __init__(self, reader):
+        self.first_doc_num = 0
+        self.num_of_docs = reader.num_of_docs
+        self._reader = reader
+        self._term_numbers = dict(izip(reader.terms(), count()))
+        self._loaded = {}
+
+    def posting_list(self, term):
+        posting_list = self._loaded.get(term)
+        if posting_list is None and term in self._term_numbers:
+            posting_list = self._loaded[term] = self._reader.posting_list(self._term_numbers[term])
+        return posting_list
+
+    def terms(self):
+        return iter(self._term_numbers)
+
+    def __contains__(self, term):
+        return term in self._term_numbers
+
+
+class WriteBuffer(object):
+    """
+    The only mutable segment, which new documents are indexed into. Its posting lists are appendable arrays (see
+    postings.AppendablePostingList), so appending is cheap. Once it holds enough documents, the engine seals it into a
+    MemorySegment and starts a new buffer.
+    Queries do not read the buffer itself, but a BufferSnapshot of it (see snapshot), which the writer keeps appending
+    to the buffer under.
+    """
+
+    def __init__(self, first_doc_num):
+        self.first_doc_num = first_doc_num
+        self.num_of_docs = 0
+        self._postings = {}
+
+    def add_document(self, doc_num, term_frequencies):
+        """
+        :param doc_num: The document's number, the next one after the documents already in the buffer.
+        :param term_frequencies: An iterable of the document's (term, tf) tuples.
+        """
+        postings = self._postings
+        for term, tf in term_frequencies:
+            posting_list = postings.get(term)
+            if posting_list is None:
+                posting_list = postings[term] = AppendablePostingList()
+            posting_list.add(doc_num, tf)
+        self.num_of_docs = doc_num + 1 - self.first_doc_num
+
+    def add_batch(self, first_doc_num, num_of_docs, postings):
+        """
+        :param first_doc_num: The number of the batch's first document.
+        :param num_of_docs: The number of documents in the batch.
+        :param postings: A {term: (document numbers, term frequencies)} mapping of NumPy arrays.
+        """
+        for term, (doc_nums, tfs) in postings.iteritems():
+            if term not in self._postings:
+                self._postings[term] = AppendablePostingList()
+            self._postings[term].extend(doc_nums, tfs)
+        self.num_of_docs = first_doc_num + num_of_docs - self.first_doc_num
+
+    def seal(self, posting_list_class):
+        """
+        :param posting_list_class: The posting list type (see postings.POSTING_CODECS) of the sealed segment.
+        :return: A MemorySegment with the buffer's postings.
+        """
+        if posting_list_class is PostingList:
+            postings = {term: posting_list.copy() for term, posting_list in self._postings.iteritems()}
+        else:
+            postings = {term: posting_list_class.from_arrays(*posting_list.arrays())
+                        for term, posting_list in self._postings.iteritems()}
+        return MemorySegment(self.first_doc_num, self.num_of_docs, postings)
+
+    def snapshot(self):
+        """
+        :return: A BufferSnapshot of the documents in the buffer now.
+        """
+        return BufferSnapshot(self._postings, self.first_doc_num, self.num_of_docs)
+
+
+class BufferSnapshot(object):
+    """
+    The write buffer as it was when the snapshot was taken: the postings of its first num_of_docs documents. The
+    writer keeps appending to the same posting lists, so they are cut at the snapshot's last document as they are
+    looked up. Has the interface of a sealed segment.
+    """
+
+    def __init__(self, postings, first_doc_num, num_of_docs):
+        self.first_doc_num = first_doc_num
+        self.num_of_docs = num_of_docs
+        self._postings = postings
+        self._end_doc_num = first_doc_num + num_of_docs
+
+    def posting_list(self, term):
+        posting_list = self._postings.get(term)
+        if posting_list is None or posting_list.first_doc_num >= self._end_doc_num:
+            return None
+        return posting_list.snapshot(self._end_doc_num)
+
+    def terms(self):
+        # items() copies the dictionary at once, so terms the writer adds meanwhile don't break the iteration.
+        return (term for term, posting_list in self._postings.items()
+                if posting_list.first_doc_num < self._end_doc_num)
+
+    def __contains__(self, term):
+        posting_list = self._postings.get(term)
+        return posting_list is not None and posting_list.first_doc_num < self._end_doc_num
+
+
+def merge_segments(segments, posting_list_class, deleted=None):
+    """
+    Merges adjacent segments into one. This is where deleted documents are physically purged: their postings are
+    not copied to the merged segment. Their document numbers stay in its range.
+    :param segments: A list of segments covering a contiguous range of document numbers, in order.
+    :param posting_list_class: The posting list type of the merged segment.
+    :param deleted: A Bitset of deleted document numbers.
+    :return: A MemorySegment.
+    """
+    terms = set()
+    for segment in segments:
+        terms.update(segment.terms())
+    postings = {}
+    for term in terms:
+        parts = [segment.posting_list(term) for segment in segments if term in segment]
+        doc_nums, tfs = MultiPostingList(parts).arrays()
+        if deleted:
+            live = ~deleted.contains(doc_nums)
+            doc_nums, tfs = doc_nums[live], tfs[live]
+            if not len(doc_nums):
+                continue
+        postings[term] = posting_list_class.from_arrays(doc_nums, tfs)
+    num_of_docs = sum(segment.num_of_docs for segment in segments)
+    return MemorySegment(segments[0].first_doc_num, num_of_docs, postings)
+
+
+class TieredMergePolicy(object):
+    """
+    Decides which segments to merge, log-structured style. A segment's tier is how many times it is merge_factor
+    times bigger than a freshly flushed segment. Whenever merge_factor adjacent segments sit on the same tier, they
+    are merged into one segment of the next tier. So there are at most merge_factor - 1 segments per tier, and every
+    document is rewritten about log(number of documents) times over the life of the index.
+    """
+
+    def __init__(self, merge_factor=10, min_segment_size=1):
+        if merge_factor < 2:
+            raise ValueError('merge_factor must be at least 2, got {}'.format(merge_factor))
+        self.merge_factor = merge_factor
+        self.min_segment_size = max(min_segment_size, 1)
+
+    def tier(self, segment):
+        size = float(max(segment.num_of_docs, 1)) / self.min_segment_size
+        return int(log(size) / log(self.merge_factor) + 1e-9) if size > 1 else 0
+
+    def find_merge(self, segments):
+        """
+        :param segments: The sealed segments, in order.
+        :return: A (start, end) slice of the segments that should be merged, or None.
+        """
+        run_start = 0
+        for position in xrange(1, len(segments) + 1):
+            if position == len(segments) or self.tier(segments[position]) != self.tier(segments[run_start]):
+                if position - run_start >= self.merge_factor:
+                    return run_start, run_start + self.merge_factor
+                run_start = position
+        return None
+
+
+class SegmentedPostings(Mapping):
+    """
+    A read-only {term: posting list} view over a sequence of segments, where the posting list of a term found in
+    more than one segment is a MultiPostingList.
+    """
+
+    def __init__(self, segments):
+        self._segments = segments
+
+    def __getitem__(self, term):
+        parts = [segment.posting_list(term) for segment in self._segments if term in segment]
+        if not parts:
+            raise KeyError(term)
+        return parts[0] if len(parts) == 1 else MultiPostingList(parts)
+
+    def __contains__(self, term):
+        return any(term in segment for segment in self._segments)
+
+    def __iter__(self):
+        if len(self._segments) == 1:
+            return self._segments[0].terms()
+        seen = set()
+        return (term for segment in self._segments for term in segment.terms()
+                if not (term in seen or seen.add(term)))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class StoredDocuments(MutableMapping):
+    """
+    The {doc_id: Document} mapping of an opened index. Stored documents are created from the memory-mapped texts
+    when they are looked up, without tokenizing them. Documents added after the index was opened are kept in memory.
+    doc_nums is shared with the engine, which removes deleted documents from it.
+    """
+
+    def __init__(self, reader, doc_ids, doc_nums, analyzer):
+        self._reader = reader
+        self._doc_ids = doc_ids
+        self._doc_nums = doc_nums
+        self._analyzer = analyzer
+        self._added = {}
+        self._num_of_removed = 0
+
+    def __getitem__(self, doc_id):
+        if doc_id in self._added:
+            return self._added[doc_id]
+        doc_num = self._doc_nums[doc_id]
+        return Document(doc_id, self._reader.text(doc_num), self._analyzer, lazy=True)
+
+    def __setitem__(self, doc_id, document):
+        self._added[doc_id] = document
+
+    def __delitem__(self, doc_id):
+        if doc_id in self._added:
+            del self._added[doc_id]
+        elif doc_id in self._doc_nums:
+            self._num_of_removed += 1
+        else:
+            raise KeyError(doc_id)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._added or doc_id in self._doc_nums
+
+    def __iter__(self):
+        stored_doc_ids = self._doc_ids[:self._reader.num_of_docs]
+        if self._num_of_removed:
+            doc_nums = self._doc_nums
+            stored_doc_ids = (doc_id for doc_num, doc_id in enumerate(stored_doc_ids)
+                              if doc_nums.get(doc_id) == doc_num)
+        return chain(stored_doc_ids, self._added)
+
+    def __len__(self):
+        return self._reader.num_of_docs - self._num_of_removed + len(self._added)
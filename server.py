@@ -0,0 +1,439 @@
+"""
+An HTTP/JSON server for the IR-Engine.
+Python 2 has no asyncio, so the event loop is asyncore's: one thread multiplexes every connection and never scores
+a query itself. Queries are scored on a pool of threads, a batch of queries per task, and the responses are handed
+back to the event loop through a socket pair. When too many queries are waiting, new ones are turned away with a 503
+instead of queueing without bound.
+
+    GET  /search?q=<text>&k=10&scoring=vectorized&ranking=cosine&operator=or&minimum_should_match=1
+    POST /search  {"q": <text>, "k": 10, ...}
+    POST /batch   {"queries": [{"q": <text>, ...}, ...]}
+    GET  /stats
+"""
+import asynchat
+import asyncore
+import json
+import socket
+import threading
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse, parse_qs
+
+from IREngine import OPERATORS, RANKINGS, SCORING_STRATEGIES
+
+DEFAULT_PORT = 8080
+DEFAULT_THREADS = 4
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_MAX_PENDING = 256
+MAX_RESULTS = 1000
+MAX_REQUEST_SIZE = 1024 * 1024
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Request Entity Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+def parse_query(options):
+    """
+    Validates the options of a search request.
+    :param options: A dictionary of the options: q (required), k, scoring, ranking, operator and
+    minimum_should_match (see IREngine.query_by_terms). Values may be strings, as they come in a query string.
+    :return: The query text, and a dictionary of the keyword arguments of IREngine.query_by_terms.
+    """
+    if not isinstance(options, dict):
+        raise RequestError(400, 'A query must be a JSON object')
+    query_text = options.get('q')
+    if not isinstance(query_text, basestring) or not query_text.strip():
+        raise RequestError(400, 'q is required')
+    try:
+        num_of_results = int(options.get('k', 5))
+    except (TypeError, ValueError):
+        raise RequestError(400, 'k must be an integer')
+    if not 1 <= num_of_results <= MAX_RESULTS:
+        raise RequestError(400, 'k must be between 1 and {}'.format(MAX_RESULTS))
+    query_options = {'num_of_results': num_of_results}
+    for name, choices, default in (('scoring', SCORING_STRATEGIES, 'vectorized'), ('ranking', RANKINGS, 'cosine'),
+                                   ('operator', OPERATORS, 'or')):
+        value = options.get(name, default)
+        if value not in choices:
+            raise RequestError(400, '{} must be one of {}'.format(name, ', '.join(choices)))
+        query_options[name] = str(value)
+    minimum_should_match = options.get('minimum_should_match')
+    if minimum_should_match is not None:
+        try:
+            if isinstance(minimum_should_match, basestring):
+                minimum_should_match = (float(minimum_should_match) if '.' in minimum_should_match
+                                        else int(minimum_should_match))
+            elif isinstance(minimum_should_match, bool) or not isinstance(minimum_should_match, (int, long, float)):
+                # JSON true and false are ints to isinstance, but not counts.
+                raise ValueError
+        except ValueError:
+            raise RequestError(400, 'minimum_should_match must be a number')
+        query_options['minimum_should_match'] = minimum_should_match
+    if isinstance(query_text, unicode):
+        query_text = query_text.encode('utf-8')
+    return query_text, query_options
+
+
+class _Job(object):
+    """
+    The queries of a single request, and their responses once they are scored.
+    """
+    __slots__ = ('connection', 'queries', 'batch', 'responses')
+
+    def __init__(self, connection, queries, batch):
+        self.connection = connection
+        self.queries = queries
+        self.batch = batch
+        self.responses = None
+
+
+class _Waker(asyncore.dispatcher):
+    """
+    Wakes the event loop up from another thread: the loop watches one end of a socket pair, and wake() writes a byte
+    into the other.
+    """
+
+    def __init__(self, callback, socket_map):
+        reader, self._writer = socket.socketpair()
+        self._writer.setblocking(False)
+        asyncore.dispatcher.__init__(self, reader, socket_map)
+        self._callback = callback
+
+    def wake(self):
+        try:
+            self._writer.send('x')
+        except socket.error:
+            pass  # The buffer is full, so the loop has a wake up pending anyway.
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self._callback()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self._writer.close()
+
+
+class _HTTPConnection(asynchat.async_chat):
+    """
+    A client connection. Requests are read one at a time: while a request is being scored, nothing more is read from
+    the connection, so a client that pipelines requests is slowed down by TCP instead of filling the server's memory.
+    """
+
+    def __init__(self, sock, server, socket_map):
+        asynchat.async_chat.__init__(self, sock, socket_map)
+        self._server = server
+        self._incoming = []
+        self._incoming_size = 0
+        self._request = None
+        self._keep_alive = True
+        self.awaiting_response = False
+        # Set once the last response of the connection is pushed; anything read after it is ignored.
+        self._closing = False
+        self.set_terminator('\r\n\r\n')
+
+    def readable(self):
+        return not self.awaiting_response and not self._closing and asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        if self._closing:
+            return
+        self._incoming.append(data)
+        self._incoming_size += len(data)
+        if self._incoming_size > MAX_REQUEST_SIZE:
+            self._incoming = []
+            self._keep_alive = False
+            self.respond(413, {'error': 'The request is too large'})
+
+    def found_terminator(self):
+        if self._closing:
+            return
+        data = ''.join(self._incoming)
+        self._incoming = []
+        self._incoming_size = 0
+        if self._request is None:
+            lines = data.split('\r\n')
+            try:
+                method, target, version = lines[0].split()
+            except ValueError:
+                self._keep_alive = False
+                self.respond(400, {'error': 'Malformed request line'})
+                return
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            connection = headers.get('connection', '').lower()
+            self._keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+            try:
+                content_length = int(headers.get('content-length', 0))
+            except ValueError:
+                content_length = -1
+            if not 0 <= content_length <= MAX_REQUEST_SIZE:
+                self._keep_alive = False
+                self.respond(413 if content_length > 0 else 400, {'error': 'Bad Content-Length'})
+                return
+            if content_length:
+                self._request = (method, target)
+                self.set_terminator(content_length)
+                return
+            body = ''
+        else:
+            (method, target), body = self._request, data
+            self._request = None
+            self.set_terminator('\r\n\r\n')
+        self.awaiting_response = True
+        self._server.handle_request(self, method, target, body)
+
+    def respond(self, status, payload, headers=()):
+        body = json.dumps(payload)
+        lines = ['HTTP/1.1 {} {}'.format(status, _REASONS[status]), 'Content-Type: application/json',
+                 'Content-Length: {}'.format(len(body)),
+                 'Connection: {}'.format('keep-alive' if self._keep_alive else 'close')]
+        lines.extend('{}: {}'.format(name, value) for name, value in headers)
+        self.push('\r\n'.join(lines) + '\r\n\r\n' + body)
+        self.awaiting_response = False
+        if not self._keep_alive:
+            # The rest of what was already read, like the remainder of a too large body, must not be parsed as
+            # another request: with no terminator, it all goes to collect_incoming_data, which drops it.
+            self._closing = True
+            self.set_terminator(None)
+            self.close_when_done()
+
+    def handle_error(self):
+        self._server.errors += 1
+        self.close()
+
+
+class QueryServer(asyncore.dispatcher):
+    """
+    Serves queries on an IREngine. The event loop only parses requests and writes responses; a pool of threads scores
+    the queries. Queued queries are handed to the pool batch_size at a time, so that under load a thread picks up
+    many queries per hand-off. Once max_pending queries are queued or being scored, new requests get a 503 with a
+    Retry-After header. A batch of more than max_pending queries is rejected with a 413 up front.
+    The engine's queries may run on several threads at once, while documents are added to it on another.
+    """
+
+    def __init__(self, engine, host='127.0.0.1', port=DEFAULT_PORT, threads=DEFAULT_THREADS,
+                 batch_size=DEFAULT_BATCH_SIZE, max_pending=DEFAULT_MAX_PENDING):
+        """
+        :param engine: The IREngine to query.
+        :param port: The port to listen on. 0 picks a free port; see address.
+        :param threads: Number of threads scoring queries.
+        :param batch_size: The most queries a thread is handed at once.
+        :param max_pending: The most queries that may be waiting for a thread or being scored.
+        """
+        self._socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self._socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+        self.address = self.socket.getsockname()
+        self._engine = engine
+        self._pool = ThreadPool(threads)
+        self._threads = threads
+        self._batch_size = batch_size
+        self._max_pending = max_pending
+        self._queued = deque()
+        self._num_pending = 0
+        self._batches_running = 0
+        self._completed = deque()
+        self._waker = _Waker(self._deliver, self._socket_map)
+        self._running = False
+        self.requests = 0
+        self.queries = 0
+        self.batches = 0
+        self.rejected = 0
+        self.errors = 0
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _HTTPConnection(pair[0], self, self._socket_map)
+
+    def handle_request(self, connection, method, target, body):
+        self.requests += 1
+        url = urlparse(target)
+        try:
+            if url.path == '/stats':
+                if method != 'GET':
+                    raise RequestError(405, 'Use GET')
+                connection.respond(200, self.stats())
+                return
+            if url.path == '/search':
+                if method == 'GET':
+                    options = {name: values[-1] for name, values in parse_qs(url.query).iteritems()}
+                elif method == 'POST':
+                    options = self._parse_json(body)
+                else:
+                    raise RequestError(405, 'Use GET or POST')
+                queries, batch = [parse_query(options)], False
+            elif url.path == '/batch':
+                if method != 'POST':
+                    raise RequestError(405, 'Use POST')
+                request = self._parse_json(body)
+                queries = request.get('queries') if isinstance(request, dict) else None
+                if not isinstance(queries, list) or not queries:
+                    raise RequestError(400, 'queries must be a non-empty list')
+                if len(queries) > self._max_pending:
+                    # It would be turned away however long the client waits, so a 503 would have it retry forever.
+                    raise RequestError(413, 'A batch may have at most {} queries'.format(self._max_pending))
+                queries, batch = [self._parse_batched_query(options) for options in queries], True
+            else:
+                raise RequestError(404, 'Unknown path {}'.format(url.path))
+        except RequestError as error:
+            connection.respond(error.status, {'error': str(error)})
+            return
+        if self._num_pending + len(queries) > self._max_pending:
+            self.rejected += 1
+            connection.respond(503, {'error': 'Too many pending queries'}, [('Retry-After', '1')])
+            return
+        self._num_pending += len(queries)
+        self._queued.append(_Job(connection, queries, batch))
+        self._dispatch()
+
+    @staticmethod
+    def _parse_batched_query(options):
+        """
+        An invalid query of a batch only fails itself: it is kept as (None, the error).
+        """
+        try:
+            return parse_query(options)
+        except RequestError as error:
+            return None, error
+
+    @staticmethod
+    def _parse_json(body):
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise RequestError(400, 'The body is not valid JSON')
+
+    def _dispatch(self):
+        """
+        Hands the queued jobs to idle threads, up to batch_size queries per thread (a job is never split).
+        """
+        while self._queued and self._batches_running < self._threads:
+            jobs = [self._queued.popleft()]
+            num_of_queries = len(jobs[0].queries)
+            while self._queued and num_of_queries + len(self._queued[0].queries) <= self._batch_size:
+                num_of_queries += len(self._queued[0].queries)
+                jobs.append(self._queued.popleft())
+            self._batches_running += 1
+            self.batches += 1
+            self._pool.apply_async(self._score, (jobs,), callback=self._complete)
+
+    def _score(self, jobs):
+        """
+        Runs on a pool thread.
+        """
+        for job in jobs:
+            job.responses = []
+            for query_text, query_options in job.queries:
+                if query_text is None:
+                    job.responses.append((query_options.status, {'error': str(query_options)}))
+                    continue
+                start = time.time()
+                try:
+                    query_terms = self._engine.analyzer.analyze(query_text)
+                    results = self._engine.query_by_terms(query_terms, **query_options)
+                except ValueError as error:
+                    job.responses.append((400, {'error': str(error)}))
+                except Exception as error:
+                    job.responses.append((500, {'error': repr(error)}))
+                else:
+                    job.responses.append((200, {'q': query_text, 'results': results,
+                                                'took_ms': (time.time() - start) * 1000}))
+        return jobs
+
+    def _complete(self, jobs):
+        """
+        Runs on the pool's result thread; the connections may only be touched by the event loop.
+        """
+        self._completed.append(jobs)
+        self._waker.wake()
+
+    def _deliver(self):
+        while self._completed:
+            jobs = self._completed.popleft()
+            self._batches_running -= 1
+            for job in jobs:
+                self._num_pending -= len(job.queries)
+                self.queries += len(job.queries)
+                if not job.connection.connected:
+                    continue
+                if job.batch:
+                    job.connection.respond(200, {'responses': [dict(payload, status=status)
+                                                               for status, payload in job.responses]})
+                else:
+                    job.connection.respond(*job.responses[0])
+        self._dispatch()
+
+    def stats(self):
+        stats = {'requests': self.requests, 'queries': self.queries, 'batches': self.batches,
+                 'rejected': self.rejected, 'errors': self.errors, 'pending': self._num_pending,
+                 'documents': len(self._engine.documents)}
+        for name, info in (('result_cache', self._engine.result_cache_info()),
+                           ('postings_cache', self._engine.postings_cache_info())):
+            stats[name] = info._asdict() if info is not None else None
+        return stats
+
+    def serve_forever(self):
+        """
+        Runs the event loop until shutdown() is called.
+        """
+        self._running = True
+        try:
+            while self._running:
+                asyncore.loop(timeout=30.0, use_poll=True, map=self._socket_map, count=1)
+        finally:
+            for dispatcher in self._socket_map.values():
+                dispatcher.close()
+            self._pool.close()
+            self._pool.join()
+
+    def shutdown(self):
+        """
+        Stops the event loop. May be called from any thread.
+        """
+        self._running = False
+        self._waker.wake()
+
+    def handle_error(self):
+        self.errors += 1
+
+
+def serve(engine, host='127.0.0.1', port=DEFAULT_PORT, **options):
+    """
+    Serves queries on the engine until interrupted.
+    :param options: Other QueryServer options (threads, batch_size, max_pending).
+    """
+    server = QueryServer(engine, host, port, **options)
+    print 'Serving on http://{}:{}/search?q=...'.format(*server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def start_in_background(engine, **options):
+    """
+    Starts a QueryServer on a daemon thread.
+    :return: The server, whose shutdown() stops it.
+    """
+    server = QueryServer(engine, **options)
+    thread = threading.Thread(target=server.serve_forever, name='QueryServer')
+    thread.daemon = True
+    thread.start()
+    return server
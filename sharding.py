@@ -0,0 +1,378 @@
+"""
+A collection of documents partitioned across IREngine shards, each in its own process.
+Every document goes to the shard its id hashes to. A query is scattered to all the shards and their top results are
+merged. The shards score with the statistics of the whole collection, so the scores of different shards are comparable:
+    'query' statistics - the document frequencies of the query terms, the number of documents and their total length
+                         are gathered from all the shards before every query. The scores are the same as a single
+                         engine's, at the cost of a second round trip.
+    'exact' statistics - the shards publish all their statistics, and are sent the global table (see
+                         term_statistics.py), once after any change of the collection; a query is a single round trip.
+    'sketch' statistics - like 'exact', but only the most frequent terms are counted exactly, and the long tail in a
+                          CountMinSketch, which bounds the table's size (at the price of approximate IDFs for rare
+                          terms).
+The shards are served over multiprocessing.connection (a socket, pickled messages), so they can run on other hosts
+too (see serve_shard).
+"""
+from IREngine import IREngine, CollectionStatistics, COLLECTION_SCORING_STRATEGIES, DEFAULT_BATCH_SIZE
+from document import Document
+from term_statistics import DEFAULT_SKETCH_DEPTH, DEFAULT_SKETCH_WIDTH, TermStatistics
+from tokenize_utils import default_analyzer
+from multiprocessing.connection import Client, Listener
+from operator import itemgetter
+from itertools import chain
+import heapq
+import multiprocessing
+import threading
+import zlib
+
+DEFAULT_SHARD_ADDRESS = ('127.0.0.1', 0)
+SHARD_COMMANDS = ('add_documents', 'delete_document', 'update_document', 'statistics', 'frequent_terms',
+                  'publish_statistics', 'set_statistics', 'top_documents', 'num_of_documents', 'close')
+STATISTICS_MODES = ('query', 'exact', 'sketch')
+DEFAULT_EXACT_TERMS = 10000
+
+
+class ShardError(Exception):
+    """
+    An error a shard raised while handling a request.
+    """
+
+
+def shard_of(doc_id, num_of_shards):
+    """
+    :return: The number of the shard the document belongs to. The hash is the same in every process and on every host.
+    """
+    if isinstance(doc_id, unicode):
+        doc_id = doc_id.encode('utf-8')
+    return (zlib.crc32(str(doc_id)) & 0xffffffff) % num_of_shards
+
+
+def merge_statistics(shard_statistics):
+    """
+    :param shard_statistics: The CollectionStatistics of the shards.
+    :return: The CollectionStatistics of the whole collection.
+    """
+    document_frequencies = {}
+    for statistics in shard_statistics:
+        for term, document_frequency in statistics.document_frequencies.iteritems():
+            document_frequencies[term] = document_frequencies.get(term, 0) + document_frequency
+    return CollectionStatistics(sum(statistics.num_of_docs for statistics in shard_statistics),
+                                sum(statistics.total_length for statistics in shard_statistics), document_frequencies)
+
+
+class ShardServer(object):
+    """
+    Serves an IREngine over a multiprocessing.connection Listener, one client connection at a time.
+    A request is a tuple of a command (one of SHARD_COMMANDS) and its arguments; the reply is ('ok', result) or
+    ('error', exception).
+    """
+
+    def __init__(self, engine, address=DEFAULT_SHARD_ADDRESS, authkey=None):
+        self.engine = engine
+        self._listener = Listener(address, authkey=authkey)
+        self._closed = False
+
+    @property
+    def address(self):
+        return self._listener.address
+
+    def serve_forever(self):
+        """
+        Handles client connections until a client sends 'close'.
+        """
+        try:
+            while not self._closed:
+                connection = self._listener.accept()
+                try:
+                    self._handle(connection)
+                finally:
+                    connection.close()
+        finally:
+            self._listener.close()
+
+    def _handle(self, connection):
+        while not self._closed:
+            try:
+                request = connection.recv()
+            except EOFError:
+                return
+            command, arguments = request[0], request[1:]
+            try:
+                if command not in SHARD_COMMANDS:
+                    raise ValueError('Unknown shard command {!r}, expected one of {}'.format(command, SHARD_COMMANDS))
+                reply = ('ok', getattr(self, '_' + command)(*arguments))
+            except Exception as error:
+                reply = ('error', error)
+            connection.send(reply)
+
+    def _add_documents(self, documents):
+        """
+        :param documents: A list of (doc_id, text) tuples.
+        """
+        return self.engine.add_documents(documents)
+
+    def _delete_document(self, doc_id):
+        return self.engine.delete_document(doc_id)
+
+    def _update_document(self, doc_id, text):
+        return self.engine.update_document(Document(doc_id, text, self.engine.analyzer))
+
+    def _statistics(self, terms):
+        return self.engine.collection_statistics(terms)
+
+    def _frequent_terms(self, num_of_terms):
+        return TermStatistics.of_engine(self.engine).frequent_terms(num_of_terms)
+
+    def _publish_statistics(self, exact_terms, sketch_width, sketch_depth):
+        return TermStatistics.of_engine(self.engine, exact_terms, sketch_width, sketch_depth)
+
+    def _set_statistics(self, global_statistics):
+        self.engine.set_global_statistics(global_statistics)
+
+    def _top_documents(self, query_terms, num_of_results, scoring, ranking, operator, minimum_should_match,
+                       statistics):
+        """
+        :return: A list of the shard's top (doc_id, text, similarity) tuples.
+        """
+        top_results = self.engine._top_documents(query_terms, num_of_results, scoring, ranking, operator,
+                                                 minimum_should_match, statistics)
+        return [(document.doc_id, document.text, similarity) for document, similarity in top_results]
+
+    def _num_of_documents(self):
+        return len(self.engine.documents)
+
+    def _close(self):
+        self.engine.close()
+        self._closed = True
+
+
+def serve_shard(address=DEFAULT_SHARD_ADDRESS, authkey=None, ready=None, **engine_options):
+    """
+    Runs a shard with a new, empty IREngine until a client sends 'close'. To run a shard on another host, run this
+    there and pass its address to ShardedEngine.
+    :param ready: A connection to send the address the shard listens on to, once it does.
+    :param engine_options: IREngine's options.
+    """
+    server = ShardServer(IREngine(**engine_options), address, authkey)
+    if ready is not None:
+        ready.send(server.address)
+        ready.close()
+    server.serve_forever()
+
+
+class ShardedEngine(object):
+    """
+    The free_text_query / query_by_terms interface of IREngine, over documents partitioned across shards (see the
+    module's docstring).
+    Requests are sent to all the shards before any reply is read, so the shards index and score in parallel. One
+    request is in flight at a time: the engine can be shared by threads, but their requests are serialized.
+    """
+
+    def __init__(self, num_of_shards=2, addresses=None, authkey=None, analyzer=None, statistics='query',
+                 exact_terms=DEFAULT_EXACT_TERMS, sketch_width=DEFAULT_SKETCH_WIDTH, sketch_depth=DEFAULT_SKETCH_DEPTH,
+                 **engine_options):
+        """
+        :param num_of_shards: Number of shard processes to start, if addresses is not given.
+        :param addresses: The addresses of running shards (see serve_shard) to connect to, instead of starting any.
+        :param authkey: The key the shards authenticate clients with. Started shards get this process's authkey by
+        default.
+        :param analyzer: The analyzer free text queries are tokenized with. Defaults to the shared Analyzer.
+        :param statistics: How the shards get the statistics of the collection, one of STATISTICS_MODES.
+        :param exact_terms: With 'sketch' statistics, the number of most frequent terms of every shard that are
+        counted exactly.
+        :param sketch_width: With 'sketch' statistics, the number of counters in every row of the sketch.
+        :param sketch_depth: With 'sketch' statistics, the number of rows of the sketch.
+        :param engine_options: IREngine's options, for the started shards.
+        """
+        if statistics not in STATISTICS_MODES:
+            raise ValueError('Unknown statistics mode {!r}, expected one of {}'.format(statistics, STATISTICS_MODES))
+        self.analyzer = analyzer or default_analyzer()
+        self._statistics_mode = statistics
+        self._exact_terms = exact_terms
+        self._sketch_width = sketch_width
+        self._sketch_depth = sketch_depth
+        self._global_statistics = None
+        self._processes = []
+        if addresses is None:
+            if num_of_shards < 1:
+                raise ValueError('num_of_shards must be positive, got {}'.format(num_of_shards))
+            if authkey is None:
+                authkey = multiprocessing.current_process().authkey
+            if analyzer is not None:
+                engine_options['analyzer'] = analyzer
+            addresses = []
+            for shard in xrange(num_of_shards):
+                receiver, sender = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=serve_shard, name='IREngine-shard-{}'.format(shard),
+                                                  args=(DEFAULT_SHARD_ADDRESS, authkey, sender), kwargs=engine_options)
+                process.daemon = True
+                process.start()
+                sender.close()
+                addresses.append(receiver.recv())
+                receiver.close()
+                self._processes.append(process)
+        self._connections = [Client(address, authkey=authkey) for address in addresses]
+        self._lock = threading.RLock()
+
+    @property
+    def num_of_shards(self):
+        return len(self._connections)
+
+    def _scatter(self, requests):
+        """
+        Sends the requests, then collects their replies.
+        :param requests: A list of (shard number, command, arguments...) tuples.
+        :return: A list of the results, in the order of the requests.
+        """
+        with self._lock:
+            for request in requests:
+                self._connections[request[0]].send(request[1:])
+            replies = [self._connections[request[0]].recv() for request in requests]
+        for (shard, command), (status, result) in zip((request[:2] for request in requests), replies):
+            if status != 'ok':
+                raise ShardError('Shard {} failed to {}: {!r}'.format(shard, command, result))
+        return [result for _, result in replies]
+
+    def _broadcast(self, command, *arguments):
+        return self._scatter([(shard, command) + arguments for shard in xrange(self.num_of_shards)])
+
+    def _scatter_changes(self, requests):
+        """
+        Like _scatter, for requests that change the collection. The global statistics are reset while the lock is
+        held, so a rebuild (see global_statistics) either finishes before the change or starts after it; it can't
+        install a table that misses the change.
+        """
+        with self._lock:
+            self._global_statistics = None
+            return self._scatter(requests)
+
+    def add_document(self, document):
+        """
+        :param document: The to-be-indexed document (Document object type).
+        :return: True if it was added, False if its id is already indexed.
+        """
+        shard = shard_of(document.doc_id, self.num_of_shards)
+        return self._scatter_changes([(shard, 'add_documents', [(document.doc_id, document.text)])])[0] == 1
+
+    def add_documents(self, documents, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Sends the documents to their shards in batches, all the shards' batches at once.
+        :param documents: An iterable of (doc_id, text) tuples.
+        :param batch_size: Number of documents sent to a shard at a time.
+        :return: The number of documents that were added.
+        """
+        num_added = 0
+        batches = [[] for _ in xrange(self.num_of_shards)]
+        for doc_id, text in documents:
+            shard = shard_of(doc_id, self.num_of_shards)
+            batches[shard].append((doc_id, text))
+            if len(batches[shard]) == batch_size:
+                num_added += self._send_batches(batches)
+                batches = [[] for _ in xrange(self.num_of_shards)]
+        return num_added + self._send_batches(batches)
+
+    def _send_batches(self, batches):
+        return sum(self._scatter_changes([(shard, 'add_documents', batch)
+                                          for shard, batch in enumerate(batches) if batch]))
+
+    def delete_document(self, doc_id):
+        """
+        :return: True if the document was deleted, False if it is not indexed.
+        """
+        return self._scatter_changes([(shard_of(doc_id, self.num_of_shards), 'delete_document', doc_id)])[0]
+
+    def update_document(self, document):
+        """
+        Replaces the indexed document that has the same id, or adds the document if it is not indexed.
+        """
+        shard = shard_of(document.doc_id, self.num_of_shards)
+        return self._scatter_changes([(shard, 'update_document', document.doc_id, document.text)])[0]
+
+    def __len__(self):
+        return sum(self._broadcast('num_of_documents'))
+
+    def collection_statistics(self, terms):
+        """
+        :return: The CollectionStatistics of all the shards, with the document frequencies of the terms.
+        """
+        return merge_statistics(self._broadcast('statistics', list(set(terms))))
+
+    def global_statistics(self):
+        """
+        With 'exact' or 'sketch' statistics, the global table is built the first time it is needed after the
+        collection changed: (with 'sketch') the shards send their most frequent terms, then every shard publishes its
+        TermStatistics, which keep the union of those terms exactly, and the merged table is sent to every shard.
+        :return: The term_statistics.TermStatistics the shards score with, or None with 'query' statistics.
+        """
+        if self._statistics_mode == 'query':
+            return None
+        with self._lock:
+            if self._global_statistics is None:
+                exact_terms = None
+                if self._statistics_mode == 'sketch':
+                    exact_terms = set(chain.from_iterable(self._broadcast('frequent_terms', self._exact_terms)))
+                global_statistics = TermStatistics.merge(self._broadcast('publish_statistics', exact_terms,
+                                                                         self._sketch_width, self._sketch_depth))
+                self._broadcast('set_statistics', global_statistics)
+                self._global_statistics = global_statistics
+            return self._global_statistics
+
+    def free_text_query(self, query_text, num_of_results=5, operator='or', minimum_should_match=None, **options):
+        """
+        Like IREngine.free_text_query.
+        :param options: Other options of query_by_terms.
+        """
+        return self.query_by_terms(self.analyzer.analyze(query_text), num_of_results, operator=operator,
+                                   minimum_should_match=minimum_should_match, **options)
+
+    def query_by_terms(self, query_terms, num_of_results=5, scoring='vectorized', ranking='cosine', operator='or',
+                       minimum_should_match=None):
+        """
+        Like IREngine.query_by_terms, with one of COLLECTION_SCORING_STRATEGIES. 'full_cosine' divides by the norms
+        of the documents' vectors within their shards.
+        :return: A list of the top `num_of_results` relevant documents.
+        """
+        top_results = self._top_documents(query_terms, num_of_results, scoring, ranking, operator,
+                                          minimum_should_match)
+        return [text for _, text, _ in top_results]
+
+    def _top_documents(self, query_terms, num_of_results, scoring='vectorized', ranking='cosine', operator='or',
+                       minimum_should_match=None):
+        """
+        Gathers the statistics of the query terms from all the shards (or makes sure they have the global table),
+        scatters the query, and merges the shards' top results.
+        :return: A list of the top (doc_id, text, similarity) tuples, in descending order of similarity.
+        """
+        if scoring not in COLLECTION_SCORING_STRATEGIES:
+            raise ValueError('Unknown scoring strategy {!r}, expected one of {}'.format(scoring,
+                                                                                     COLLECTION_SCORING_STRATEGIES))
+        if not query_terms or num_of_results <= 0:
+            return []
+        with self._lock:
+            # No document can be added between the rounds, so the statistics are those of the scored documents.
+            statistics = None
+            if self.global_statistics() is None:
+                statistics = self.collection_statistics(query_terms)
+            shard_results = self._broadcast('top_documents', query_terms, num_of_results, scoring, ranking, operator,
+                                            minimum_should_match, statistics)
+        return heapq.nlargest(num_of_results, chain.from_iterable(shard_results), key=itemgetter(2))
+
+    def close(self):
+        """
+        Stops the shards and waits for the started ones to exit.
+        """
+        with self._lock:
+            if self._connections:
+                self._broadcast('close')
+                for connection in self._connections:
+                    connection.close()
+                self._connections = []
+            for process in self._processes:
+                process.join()
+            self._processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,170 @@
+# Immutable snapshots of an index, which queries read while a writer keeps changing it (see IREngine.snapshot).
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 1024
+
+# A version of the index that never changes: the generation it is (see IREngine._publish), its segments (the sealed
+# ones and a BufferSnapshot of the write buffer), the number of documents that are not deleted, the lengths of all the
+# documents (deleted ones included), the Bitset of deleted document numbers, an ArraySnapshot of the document
+# frequencies by term id, and the global statistics, if any. cache holds the statistics derived from all of these
+# (the IDF table, the document norms, ...), computed the first time a query needs them.
+IndexSnapshot = namedtuple('IndexSnapshot', ['generation', 'segments', 'num_of_docs', 'doc_lengths', 'deleted',
+                                             'document_frequencies', 'global_statistics', 'cache'])
+
+
+class GrowableArray(object):
+    """
+    An append-only array of numbers, in a NumPy array with spare room. view() hands out the numbers appended so far
+    without copying them. The writer only writes past the end of the views it handed out, and when the array is full,
+    copies the numbers to a bigger one, leaving the old one to the readers that still hold views of it; so a view never
+    changes.
+    Only one thread may append and take views at a time.
+    """
+    __slots__ = ('_data', '_length')
+
+    def __init__(self, dtype, values=()):
+        """
+        :param dtype: The NumPy type of the numbers.
+        :param values: The initial numbers.
+        """
+        self._data = np.array(values, dtype=dtype)
+        self._length = len(self._data)
+
+    def _room(self, num_of_values):
+        if self._length + num_of_values > len(self._data):
+            data = np.zeros(max(self._length + num_of_values, 2 * len(self._data)), dtype=self._data.dtype)
+            data[:self._length] = self._data[:self._length]
+            self._data = data
+
+    def append(self, value):
+        self._room(1)
+        self._data[self._length] = value
+        self._length += 1
+
+    def extend(self, values):
+        """
+        :param values: A NumPy array of numbers.
+        """
+        self._room(len(values))
+        self._data[self._length:self._length + len(values)] = values
+        self._length += len(values)
+
+    def view(self):
+        """
+        :return: A NumPy array of the numbers appended so far, which stays the same whatever is appended next.
+        """
+        return self._data[:self._length]
+
+    def __getitem__(self, index):
+        return self.view()[index]
+
+    def __len__(self):
+        return self._length
+
+
+class CopyOnWriteArray(object):
+    """
+    An array of numbers the writer changes in place, while readers hold immutable versions of it (see publish). The
+    numbers are split in chunks. Publishing hands out the current chunks, and a chunk that was handed out is copied
+    before it is changed again, so publishing costs a reference per chunk, and a change copies at most a chunk.
+    The chunks are array.arrays rather than NumPy arrays: the writer changes a number at a time (the document
+    frequencies of a document's terms), which costs a small fraction of changing a NumPy array element, and a chunk
+    never changes size, so the NumPy views readers take of it stay valid.
+    Only one thread may change and publish the array at a time.
+    """
+
+    def __init__(self, dtype, values=(), chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param dtype: The NumPy type of the numbers.
+        :param values: The initial numbers.
+        :param chunk_size: Number of numbers per chunk.
+        """
+        values = np.asarray(values, dtype=dtype)
+        self._dtype = values.dtype
+        self._chunk_size = chunk_size
+        self._chunks = []
+        for start in xrange(0, len(values), chunk_size):
+            chunk = self._new_chunk()
+            part = values[start:start + chunk_size]
+            chunk[:len(part)] = array(self._dtype.char, part.tostring())
+            self._chunks.append(chunk)
+        self._length = len(values)
+        # The chunks that were created or copied since the last publish, which no reader holds.
+        self._owned = set(xrange(len(self._chunks)))
+
+    def _new_chunk(self):
+        return array(self._dtype.char, [0]) * self._chunk_size
+
+    def _writable_chunk(self, index):
+        """
+        :return: The chunk of the index'th number, copied first if a reader may hold it.
+        """
+        chunk_number = index // self._chunk_size
+        if chunk_number not in self._owned:
+            self._chunks[chunk_number] = self._chunks[chunk_number][:]
+            self._owned.add(chunk_number)
+        return self._chunks[chunk_number]
+
+    def append(self, value):
+        if self._length == len(self._chunks) * self._chunk_size:
+            self._owned.add(len(self._chunks))
+            self._chunks.append(self._new_chunk())
+        self._writable_chunk(self._length)[self._length % self._chunk_size] = value
+        self._length += 1
+
+    def add(self, index, value):
+        """
+        Adds value to the index'th number.
+        """
+        chunk_number, position = divmod(index, self._chunk_size)
+        if chunk_number in self._owned:
+            self._chunks[chunk_number][position] += value
+        else:
+            self._writable_chunk(index)[position] += value
+
+    def publish(self):
+        """
+        :return: An ArraySnapshot of the numbers now, which later changes don't affect.
+        """
+        self._owned = set()
+        return ArraySnapshot(tuple(self._chunks), self._length, self._chunk_size, self._dtype)
+
+    def __getitem__(self, index):
+        return self._chunks[index // self._chunk_size][index % self._chunk_size]
+
+    def __len__(self):
+        return self._length
+
+
+class ArraySnapshot(object):
+    """
+    An immutable version of a CopyOnWriteArray.
+    """
+    __slots__ = ('_chunks', '_length', '_chunk_size', '_dtype', '_array')
+
+    def __init__(self, chunks, length, chunk_size, dtype):
+        self._chunks = chunks
+        self._length = length
+        self._chunk_size = chunk_size
+        self._dtype = dtype
+        self._array = None
+
+    def array(self):
+        """
+        :return: A NumPy array of all the numbers, concatenated the first time it is needed.
+        """
+        if self._array is None:
+            chunks = [np.frombuffer(chunk, dtype=self._dtype) for chunk in self._chunks]
+            self._array = np.concatenate(chunks)[:self._length] if chunks else np.zeros(0, dtype=self._dtype)
+        return self._array
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        return self._chunks[index // self._chunk_size][index % self._chunk_size]
+
+    def __len__(self):
+        return self._length
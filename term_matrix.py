@@ -0,0 +1,97 @@
+# Sealed segments compiled into sparse document-term matrices, for linear algebra style scoring.
+import threading
+
+import numpy as np
+from scipy import sparse
+
+
+class SegmentMatrix(object):
+    """
+    A sealed segment compiled into a sparse (documents x terms) matrix in CSC form: a row per document of the segment
+    and a column per term id (see IREngine._term_ids), so that the columns of a query's terms are contiguous slices.
+    Only the term frequencies are compiled, once: they never change in a sealed segment. The weights that depend on
+    the whole index (IDFs, document norms, BM25 length normalization) change whenever a document is added or deleted,
+    so the weighted matrices are derived from the compiled one (in one vectorized pass over its entries) and cached
+    until the index changes again.
+    """
+
+    def __init__(self, segment, term_ids):
+        """
+        :param segment: A sealed segment.
+        :param term_ids: A dictionary of the term ids of (at least) all the segment's terms.
+        """
+        self.first_doc_num = segment.first_doc_num
+        self.num_of_docs = segment.num_of_docs
+        columns, doc_nums, tfs = [], [], []
+        for term in segment.terms():
+            term_doc_nums, term_tfs = segment.posting_list(term).arrays()
+            columns.append(np.full(len(term_doc_nums), term_ids[term], dtype=np.int64))
+            doc_nums.append(term_doc_nums)
+            tfs.append(term_tfs)
+        self.num_of_terms = len(term_ids)
+        if doc_nums:
+            rows = np.concatenate(doc_nums).astype(np.int64) - self.first_doc_num
+            matrix = sparse.csc_matrix((np.concatenate(tfs).astype(float), (rows, np.concatenate(columns))),
+                                       shape=(self.num_of_docs, self.num_of_terms))
+        else:
+            matrix = sparse.csc_matrix((self.num_of_docs, self.num_of_terms))
+        matrix.sort_indices()
+        self._tfs = matrix
+        # The document number and the term id of every entry, in the order of the entries.
+        self._entry_doc_nums = matrix.indices + self.first_doc_num
+        self._entry_term_ids = np.repeat(np.arange(self.num_of_terms), np.diff(matrix.indptr))
+        self._weighted = {}
+        self._weighted_generation = None
+        self._lock = threading.Lock()
+
+    def weighted(self, key, generation, weigh):
+        """
+        :param key: What the weights are, like the name of a ranking.
+        :param generation: The index generation the weights are computed for.
+        :param weigh: A function (term frequencies, document numbers, term ids) -> the weights, of NumPy arrays of
+        the entries.
+        :return: The matrix of the weights. Only the matrices of the latest generation are cached; a query on an older
+        snapshot of the index gets its weights computed again.
+        """
+        with self._lock:
+            if self._weighted_generation is None or self._weighted_generation < generation:
+                self._weighted = {}
+                self._weighted_generation = generation
+            matrix = self._weighted.get(key) if self._weighted_generation == generation else None
+            if matrix is None:
+                data = weigh(self._tfs.data, self._entry_doc_nums, self._entry_term_ids)
+                matrix = sparse.csc_matrix((data, self._tfs.indices, self._tfs.indptr), shape=self._tfs.shape)
+                if self._weighted_generation == generation:
+                    self._weighted[key] = matrix
+            return matrix
+
+    def columns(self, matrix, term_ids):
+        """
+        :param matrix: One of the segment's matrices.
+        :param term_ids: Term ids, which may be ones that were handed out after the segment was compiled.
+        :return: The (documents x terms) submatrix of the terms, with an empty column for a term the segment doesn't
+        have.
+        """
+        indptr = matrix.indptr
+        starts = [indptr[term_id] if term_id < self.num_of_terms else 0 for term_id in term_ids]
+        ends = [indptr[term_id + 1] if term_id < self.num_of_terms else 0 for term_id in term_ids]
+        entries = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] or [[]]).astype(np.int64)
+        sub_indptr = np.concatenate(([0], np.cumsum(np.subtract(ends, starts))))
+        return sparse.csc_matrix((matrix.data[entries], matrix.indices[entries], sub_indptr),
+                                 shape=(self.num_of_docs, len(term_ids)))
+
+    def padded(self, matrix, num_of_terms):
+        """
+        :return: The matrix with empty columns appended, up to num_of_terms columns.
+        """
+        indptr = np.concatenate((matrix.indptr, np.full(num_of_terms - self.num_of_terms, matrix.indptr[-1],
+                                                        dtype=matrix.indptr.dtype)))
+        return sparse.csc_matrix((matrix.data, matrix.indices, indptr), shape=(self.num_of_docs, num_of_terms))
+
+    def memory_size(self):
+        """
+        :return: The number of bytes of the compiled matrix and the weighted matrices.
+        """
+        matrices = [self._tfs] + self._weighted.values()
+        return (sum(matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes for matrix in matrices) +
+                self._entry_doc_nums.nbytes + self._entry_term_ids.nbytes)
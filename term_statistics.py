@@ -0,0 +1,132 @@
+"""
+The term statistics of a collection split across several indexes (see sharding.py), so that every index can score
+with the IDFs of the whole collection.
+Every shard publishes its TermStatistics (TermStatistics.of_engine): its number of documents, their total length and
+its document frequencies; a coordinator adds them up (TermStatistics.merge) into the global table, and installs it in
+every shard (IREngine.set_global_statistics).
+An exact table holds every term of the collection, most of them rare. Instead, only the most frequent terms can be
+kept exactly, and the long tail counted in a CountMinSketch, which takes a fixed amount of memory. Its estimates can
+only be too high, which makes a rare term look a bit less rare than it is. The shards must keep the same terms exactly
+for their tables to be merged, so the coordinator first collects the most frequent terms of every shard
+(TermStatistics.frequent_terms) and asks all the shards for exact counts of all of them.
+"""
+from cache_utils import CountMinSketch
+from IREngine import CollectionStatistics
+from operator import itemgetter
+import heapq
+import sys
+import zlib
+
+DEFAULT_SKETCH_WIDTH = 1 << 16
+DEFAULT_SKETCH_DEPTH = 4
+
+
+def _sketch_key(term):
+    """
+    :return: The key the term is counted under in a sketch. Unlike hash(), it is the same in every process and on
+    every host, so the sketches of different shards can be merged.
+    """
+    if isinstance(term, unicode):
+        term = term.encode('utf-8')
+    return zlib.crc32(term) & 0xffffffff
+
+
+class TermStatistics(object):
+    """
+    The number of documents of a collection, their total length, and the document frequency of every term: exact
+    for the terms in document_frequencies, and estimated by the sketch (if any) for the rest.
+    """
+
+    def __init__(self, num_of_docs, total_length, document_frequencies, sketch=None):
+        """
+        :param document_frequencies: A dictionary of the exact document frequencies of terms.
+        :param sketch: A CountMinSketch of the document frequencies of the other terms.
+        """
+        self.num_of_docs = num_of_docs
+        self.total_length = total_length
+        self.document_frequencies = document_frequencies
+        self.sketch = sketch
+
+    @classmethod
+    def of_engine(cls, engine, exact_terms=None, sketch_width=DEFAULT_SKETCH_WIDTH, sketch_depth=DEFAULT_SKETCH_DEPTH):
+        """
+        :param engine: An IREngine.
+        :param exact_terms: The terms to keep exactly (see compacted). None keeps all of them.
+        :return: The TermStatistics of the engine's index.
+        """
+        statistics = engine.collection_statistics()
+        return cls(statistics.num_of_docs, statistics.total_length,
+                   statistics.document_frequencies).compacted(exact_terms, sketch_width, sketch_depth)
+
+    @classmethod
+    def merge(cls, tables):
+        """
+        :param tables: The TermStatistics of disjoint sets of documents, which keep the same terms exactly. Their
+        sketches, if any, must have the same width, depth and seed.
+        :return: The TermStatistics of all the documents.
+        """
+        document_frequencies = {}
+        sketch = None
+        for table in tables:
+            for term, document_frequency in table.document_frequencies.iteritems():
+                document_frequencies[term] = document_frequencies.get(term, 0) + document_frequency
+            if table.sketch is not None:
+                if sketch is None:
+                    sketch = CountMinSketch(table.sketch.width, table.sketch.depth, table.sketch.seed)
+                sketch.merge(table.sketch)
+        return cls(sum(table.num_of_docs for table in tables), sum(table.total_length for table in tables),
+                   document_frequencies, sketch)
+
+    def compacted(self, exact_terms, sketch_width=DEFAULT_SKETCH_WIDTH, sketch_depth=DEFAULT_SKETCH_DEPTH):
+        """
+        :param exact_terms: The terms to keep exactly. None keeps all of them.
+        :return: A TermStatistics with only the exact_terms kept exactly (those that some document has), and the
+        other terms added to the sketch (a new one of sketch_width x sketch_depth counters, if there is none yet).
+        """
+        if exact_terms is None:
+            return self
+        exact_terms = set(exact_terms)
+        sketch = CountMinSketch(sketch_width, sketch_depth)
+        if self.sketch is not None:
+            sketch.merge(self.sketch)
+        exact = {}
+        for term, document_frequency in self.document_frequencies.iteritems():
+            if term in exact_terms:
+                exact[term] = document_frequency
+            else:
+                sketch.add(_sketch_key(term), document_frequency)
+        return TermStatistics(self.num_of_docs, self.total_length, exact, sketch)
+
+    def frequent_terms(self, num_of_terms):
+        """
+        :return: A list of the num_of_terms most frequent of the terms that are kept exactly.
+        """
+        return [term for term, _ in heapq.nlargest(num_of_terms, self.document_frequencies.iteritems(),
+                                                   key=itemgetter(1))]
+
+    def document_frequency(self, term):
+        """
+        :return: The term's document frequency, or an upper bound of it if it is not kept exactly.
+        """
+        document_frequency = self.document_frequencies.get(term)
+        if document_frequency is not None:
+            return document_frequency
+        if self.sketch is None:
+            return 0
+        # A term no document has usually gets 0, but may get the counts of the terms it collides with.
+        return min(self.sketch.estimate(_sketch_key(term)), self.num_of_docs)
+
+    def statistics(self, terms):
+        """
+        :return: The CollectionStatistics of the terms (see IREngine._top_documents).
+        """
+        return CollectionStatistics(self.num_of_docs, self.total_length,
+                                    {term: self.document_frequency(term) for term in set(terms)})
+
+    def memory_size(self):
+        """
+        :return: An estimate of the number of bytes the table takes: the exact dictionary, its terms and the sketch.
+        """
+        size = sys.getsizeof(self.document_frequencies) + sum(sys.getsizeof(term)
+                                                              for term in self.document_frequencies)
+        return size + (self.sketch.memory_size() if self.sketch is not None else 0)
@@ -1,10 +1,169 @@
 # A small package that will include tokenizing functions. We can import whatever tokenizing function we want from here
 import string
+import threading
 
 from nltk import word_tokenize
 from nltk.corpus import stopwords
 from nltk.stem import PorterStemmer
 
+from cache_utils import LRUCache
+
+DEFAULT_TERM_CACHE_SIZE = 100000
+DEFAULT_STEM_CACHE_SIZE = 200000
+
+# Deletion tables for stripping punctuation, built once. Byte strings and unicode strings translate differently.
+_PUNCTUATION_TABLE = {ord(char): None for char in string.punctuation}
+_MISSING = object()
+
+# Stemming is by far the most expensive part of tokenizing, and natural language vocabularies are Zipfian:
+# the same few thousand words make up most of the text. So a single stemmer is shared by the whole process,
+# behind a bounded cache, and stemming a corpus costs roughly one stem per distinct word.
+# The cache is shared by every thread that tokenizes (query server threads, writers), so it is used under a lock.
+_stemmer = PorterStemmer()
+_stem_cache = LRUCache(DEFAULT_STEM_CACHE_SIZE)
+_stem_cache_lock = threading.Lock()
+
+
+def _strip_punctuation(text):
+    if isinstance(text, unicode):
+        return text.translate(_PUNCTUATION_TABLE)
+    return text.translate(None, string.punctuation)
+
+
+def stem(word):
+    """
+    Stems a word with the process-wide stemmer, going through the stem cache.
+    :param word: A (lowercase) word.
+    :return: The stem of the word.
+    """
+    with _stem_cache_lock:
+        stemmed = _stem_cache.get(word)
+    if stemmed is None:
+        stemmed = _stemmer.stem(word)
+        with _stem_cache_lock:
+            _stem_cache.put(word, stemmed)
+    return stemmed
+
+
+def stem_cache_info():
+    """
+    :return: A CacheInfo tuple (hits, misses, evictions, maxsize, currsize) of the stem cache.
+    A high eviction count relative to the misses means the cache is too small for the vocabulary.
+    """
+    with _stem_cache_lock:
+        return _stem_cache.info()
+
+
+def resize_stem_cache(maxsize):
+    """
+    Changes the number of stems the stem cache holds.
+    """
+    with _stem_cache_lock:
+        _stem_cache.resize(maxsize)
+
+
+class Analyzer(object):
+    """
+    A compiled version of `simpler_tokenization`.
+    The stopwords are loaded once into a frozenset instead of being re-read from the NLTK corpus for every word,
+    and the normalized form of each raw word is memoized in a bounded LRU cache, so a word that shows up
+    a million times in the corpus is normalized only once.
+    Subclasses change how text is split into words (_split) and how a word becomes a term (_normalize).
+    Safe to use from several threads: the cache is only touched under a lock, and words are normalized outside it.
+    """
+
+    def __init__(self, language="english", cache_size=DEFAULT_TERM_CACHE_SIZE):
+        self._stopwords = frozenset(stopwords.words(language))
+        self._term_cache = LRUCache(cache_size)
+        self._lock = threading.Lock()
+
+    def __call__(self, text):
+        return self.analyze(text)
+
+    def analyze(self, text):
+        """
+        Tokenizes text into terms.
+        :param text: A string represents the document text.
+        :return: A tokenized list of strings (the terms).
+        """
+        terms = []
+        cache = self._term_cache
+        lock = self._lock
+        for word in self._split(text):
+            with lock:
+                term = cache.get(word, _MISSING)
+            if term is _MISSING:
+                term = self._normalize(word)
+                with lock:
+                    cache.put(word, term)
+            if term is not None:
+                terms.append(term)
+        return terms
+
+    def cache_info(self):
+        with self._lock:
+            return self._term_cache.info()
+
+    def __getstate__(self):
+        # Analyzers are sent to indexing worker processes; the cache is large and only worth anything locally.
+        state = self.__dict__.copy()
+        state['_term_cache'] = self._term_cache.info().maxsize
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._term_cache = LRUCache(state['_term_cache'])
+        self._lock = threading.Lock()
+
+    def _split(self, text):
+        return _strip_punctuation(text).split()
+
+    def _normalize(self, word):
+        """
+        :return: The term for a raw word, or None if the word should be dropped (a stopword).
+        """
+        if not isinstance(word, unicode):
+            word = unicode(word, 'utf-8', errors='ignore')
+        word = word.strip().encode('ascii', 'ignore').lower()
+        return None if word in self._stopwords else word
+
+
+class NltkAnalyzer(Analyzer):
+    """
+    A compiled version of `simple_tokenization`, which splits words with NLTK's word tokenizer.
+    """
+
+    def _split(self, text):
+        return word_tokenize(text)
+
+    def _normalize(self, word):
+        return None if word in self._stopwords else word.lower()
+
+
+class StemmingAnalyzer(Analyzer):
+    """
+    A compiled version of `smart_tokenizer`, which stems every term with the shared, cached stemmer.
+    """
+
+    def _normalize(self, word):
+        return None if word in self._stopwords else stem(word.lower())
+
+
+_default_analyzers = {}
+
+
+def default_analyzer(analyzer_class=Analyzer):
+    """
+    Returns the process-wide instance of an analyzer class, creating it on first use so the stopwords corpus
+    is only loaded when something is actually tokenized.
+    :param analyzer_class: One of the Analyzer classes.
+    :return: An analyzer instance, shared by everyone who asks for the same class.
+    """
+    if analyzer_class not in _default_analyzers:
+        _default_analyzers[analyzer_class] = analyzer_class()
+    return _default_analyzers[analyzer_class]
+
 
 def simple_tokenization(text):
     """
@@ -12,19 +171,11 @@ def simple_tokenization(text):
     :param text: A string represents the document text.
     :return: A tokenized list of strings (the words).
     """
-    words = word_tokenize(text)
-    return [word.lower() for word in words if word not in stopwords.words("english")]
+    return default_analyzer(NltkAnalyzer).analyze(text)
 
 
 def simpler_tokenization(text):
-    words = text.translate(None, string.punctuation).split()
-    terms = []
-    for word in words:
-        word = unicode(word, 'utf-8', errors='ignore').strip()
-        word = word.encode('ascii', 'ignore').lower()
-        if word not in stopwords.words("english"):
-            terms.append(word)
-    return terms
+    return default_analyzer(Analyzer).analyze(text)
 
 
 def smart_tokenizer(text):
@@ -33,6 +184,4 @@ def smart_tokenizer(text):
     :param text: The input text.
     :return: Tokenized, stemmed words from input text (List of strings)
     """
-    words = text.translate(None, string.punctuation).split()
-    stemmer = PorterStemmer()
-    return [stemmer.stem(word.lower()) for word in words if word not in stopwords.words("english")]
+    return default_analyzer(StemmingAnalyzer).analyze(text)